@@ -0,0 +1,100 @@
+"""Maintenance commands for the portal.
+
+Usage:
+    python manage.py build_matrix_store Ens218
+    python manage.py build_matrix_store Ens1 -m snATAC
+    python manage.py build_sample_rank Ens218 -s cluster_mCH_lv_npc50_k30
+    python manage.py build_cluster_summary Ens218 -g cluster,annotation,dataset
+    python manage.py build_catalog Ens218
+    python manage.py build_cell_digests
+    python manage.py publish_cell_metadata Ens218
+    python manage.py build_tiles Ens218 -t mCH_ndim2_perp20
+    python manage.py clear_cache
+"""
+from flask import current_app
+from flask_script import Manager
+
+from scmdb_py import cache, create_app
+from scmdb_py import catalog, cell_cache, matrix_store, precompute, tiles
+
+manager = Manager(create_app)
+
+
+@manager.option('ensemble', help='Ensemble table name. ie. Ens218')
+@manager.option('-m', '--modality', dest='modality', default='methylation',
+                help="'methylation', 'snATAC' or 'RNA'")
+def build_matrix_store(ensemble, modality):
+    """Export an ensemble's gene tables into MATRIX_STORE_DIR."""
+    matrix_store.build_store(ensemble, modality)
+
+
+@manager.option('ensemble', help='Ensemble table name. ie. Ens218')
+@manager.option('-m', '--modality', dest='modality', default='methylation',
+                help="'methylation', 'snATAC' or 'RNA'")
+@manager.option('--seed', dest='seed', type=int, default=0)
+@manager.option('-s', '--stratify', dest='stratify', default=None,
+                help='Cluster column to stratify the sample by')
+def build_sample_rank(ensemble, modality, seed, stratify):
+    """Precompute the order in which cells are sampled for max_points."""
+    precompute.build_sample_rank(ensemble, modality, seed, stratify)
+
+
+
+@manager.option('ensemble', help='Ensemble table name. ie. Ens218')
+@manager.option('-m', '--modality', dest='modality', default='methylation',
+                help="'methylation', 'snATAC' or 'RNA'")
+@manager.option('-g', '--groupings', dest='groupings', default='cluster,annotation',
+                help='Comma separated groupings to summarize')
+@manager.option('-t', '--methylation-types', dest='methylation_types', default='mCH,mCG',
+                help='Comma separated methylation contexts to summarize')
+def build_cluster_summary(ensemble, modality, groupings, methylation_types):
+    """Precompute per-cluster gene summaries read by the heatmaps."""
+    precompute.build_cluster_summary(ensemble, modality, groupings.split(','), methylation_types.split(','))
+
+
+@manager.option('ensemble', help='Ensemble table name. ie. Ens218')
+def build_catalog(ensemble):
+    """Write the tSNE, clustering and metadata options of an ensemble to CATALOG_DIR."""
+    catalog.build_catalog(ensemble)
+
+
+@manager.command
+def build_cell_digests():
+    """Fingerprint the cells of every ensemble for duplicate ensemble requests."""
+    precompute.build_cell_digests()
+
+
+@manager.option('ensemble', help='Ensemble table name. ie. Ens218')
+@manager.option('-m', '--modality', dest='modality', default='methylation',
+                help="'methylation', 'snATAC' or 'RNA'")
+def publish_cell_metadata(ensemble, modality):
+    """Reload an ensemble's cell metadata into CELL_METADATA_DIR; workers switch on their next request."""
+    cell_cache.publish_ensemble(ensemble, modality)
+
+
+@manager.option('ensemble', help='Ensemble table name. ie. Ens218')
+@manager.option('-t', '--tsne-type', dest='tsne_type', default='mCH_ndim2_perp20',
+                help='tSNE column suffix. ie. mCH_ndim2_perp20, or ATAC / RNA')
+@manager.option('-m', '--modality', dest='modality', default='methylation',
+                help="'methylation', 'snATAC' or 'RNA'")
+@manager.option('-g', '--group-column', dest='group_column', default=None,
+                help='Column to color cells by. Defaults to the cluster column')
+@manager.option('-z', '--max-zoom', dest='max_zoom', type=int, default=5)
+def build_tiles(ensemble, tsne_type, modality, group_column, max_zoom):
+    """Render the tile pyramid of an ensemble's tSNE embedding into TILE_DIR."""
+    tiles.build_tiles(ensemble, tsne_type, modality, group_column, max_zoom)
+
+
+@manager.command
+def clear_cache():
+    """Remove all cached results of the current DATA_VERSION from a shared cache backend."""
+    if current_app.config.get('CACHE_TYPE', 'simple') in ['simple', 'null']:
+        # Each server process has its own cache, which this process cannot reach.
+        print("CACHE_TYPE '{}' is not shared with the server; bump DATA_VERSION or restart it instead.".format(
+            current_app.config.get('CACHE_TYPE', 'simple')))
+        return
+    cache.clear()
+
+
+if __name__ == '__main__':
+    manager.run()
@@ -28,7 +28,7 @@ class MiniJSONEncoder(JSONEncoder):
     item_separator = ','
     key_separator = ':'
 
-cache = Cache(config={'CACHE_TYPE': 'simple', 'CACHE_THRESHOLD': 1000})
+cache = Cache()
 nav = Nav()
 mail = Mail()
 db = SQLAlchemy()
@@ -58,6 +58,12 @@ def create_app(configfile=None):
     app.config['RQ_DEFAULT_DB'] = 0
 
     # EAM : Set limit on the number of items in cache (RAM)
+    # CACHE_TYPE can point at a shared backend in cache_backends.py instead.
+    app.config.setdefault('CACHE_TYPE', 'simple')
+    app.config.setdefault('CACHE_THRESHOLD', 1000)
+    # Namespace cache keys by data version, so bumping DATA_VERSION after reloading
+    # the databases never serves results computed from the old data.
+    app.config.setdefault('CACHE_KEY_PREFIX', 'scmdb:{}:'.format(app.config.get('DATA_VERSION', 1)))
     cache.init_app(app)
 
     # Set up asset pipeline
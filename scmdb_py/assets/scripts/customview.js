@@ -25,6 +25,81 @@ function delayLoad(f) {
     setTimeout(f, 50);
 }
 
+// Figures from the ./api/ routes carry large numeric arrays as
+// {dtype: 'f8', bdata: <base64>}; turn them back into typed arrays.
+var typedArrayTypes = {'i4': Int32Array, 'f8': Float64Array, 'f4': Float32Array, 'u2': Uint16Array};
+
+function decodeTypedArrays(obj) {
+    if (Array.isArray(obj)) {
+        for (let i = 0; i < obj.length; i++) {
+            obj[i] = decodeTypedArrays(obj[i]);
+        }
+        return obj;
+    }
+    if (obj === null || typeof obj !== 'object') {
+        return obj;
+    }
+    if (typeof obj.bdata === 'string' && obj.dtype in typedArrayTypes) {
+        let binary = atob(obj.bdata);
+        let bytes = new Uint8Array(binary.length);
+        for (let i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+        }
+        return new typedArrayTypes[obj.dtype](bytes.buffer);
+    }
+    for (let key in obj) {
+        obj[key] = decodeTypedArrays(obj[key]);
+    }
+    return obj;
+}
+
+// Scatter traces from the ./api/ routes carry their hover labels as category codes
+// ({codes, categories}) or values per field; build the customdata their hovertemplate reads.
+function expandHoverData(trace) {
+    let columns = trace.hoverdata;
+    delete trace.hoverdata;
+    let customdata = new Array(trace.x.length);
+    for (let i = 0; i < customdata.length; i++) {
+        let row = new Array(columns.length);
+        for (let j = 0; j < columns.length; j++) {
+            row[j] = columns[j].codes ? columns[j].categories[columns[j].codes[i]] : columns[j].values[i];
+        }
+        customdata[i] = row;
+    }
+    trace.customdata = customdata;
+}
+
+function renderFigure(divId, figure) {
+    let div = document.getElementById(divId);
+    if (!figure || figure.error) {
+        Plotly.purge(div);
+        $(div).html(figure ? figure.error : 'Failed to load plot. Contact maintainer.');
+        return;
+    }
+    let data = decodeTypedArrays(figure.data);
+    for (let i = 0; i < data.length; i++) {
+        if (data[i].hoverdata) {
+            expandHoverData(data[i]);
+        }
+    }
+    if (div.children.length === 0) {
+        Plotly.newPlot(div, data, figure.layout, {showLink: false});
+    } else {
+        // Plotly.react diffs against the plot already in the div instead of rebuilding it.
+        Plotly.react(div, data, figure.layout, {showLink: false});
+    }
+}
+
+// Empty a plot div. Plotly keeps the plot's state on the div, which the next renderFigure
+// would diff against, so it is purged as well.
+function clearPlot(divId) {
+    let div = document.getElementById(divId);
+    if (div) {
+        Plotly.purge(div);
+    }
+    $(div).html("");
+}
+
 function save3DData(trace, layout){
     trace_3d = trace;
     layout_3d = layout;
@@ -100,7 +175,8 @@ function initGeneNameSearch() {
             delay: 500,
             data: function(params) {
                 return {
-                    q: params.term
+                    q: params.term,
+                    ensemble: ensemble
                 };
             },
             processResults: function(data) {
@@ -109,7 +185,8 @@ function initGeneNameSearch() {
                     results: $.map(data, function(gene) {
                         return {
                             text: gene.gene_name,
-                            id: gene.gene_id
+                            id: gene.gene_id,
+                            disabled: gene.has_data === false
                         }
                     })
                 }
@@ -700,7 +777,7 @@ function updateMCHScatterPlot(onlyUpdatetSNEandClustering=false) {
         $.ajax({
         //$.getJSON({
             type: "GET",
-            url: './plot/methylation/scatter/'+ensemble+'/'+tsne_setting+'/' +methylationType+ '/'+levelType+'/'+grouping+'/'+clustering+'/'+methylation_color_percentile_Values[0]+'/'+methylation_color_percentile_Values[1]+'/'+tsneOutlierOption+'/'+max_points+'?q='+genes_query,
+            url: './api/methylation/scatter/'+ensemble+'/'+tsne_setting+'/' +methylationType+ '/'+levelType+'/'+grouping+'/'+clustering+'/'+methylation_color_percentile_Values[0]+'/'+methylation_color_percentile_Values[1]+'/'+tsneOutlierOption+'/'+max_points+'?q='+genes_query,
             beforeSend: function() {
                 $("#mch-scatter-loader").show();
                 $("#methylation-tsneUpdateBtn, #methylation-tsneUpdateBtn-top").attr('disabled', true);
@@ -709,9 +786,11 @@ function updateMCHScatterPlot(onlyUpdatetSNEandClustering=false) {
             complete: function() {
                 $("#mch-scatter-loader").hide();
             },
+            error: function(xhr) {
+                renderFigure('plot-mch-scatter', xhr.responseJSON);
+            },
             success: function(data) {
-                //Plotly.newPlot('plot-mch-scatter', data);
-                $('#plot-mch-scatter').html(data);
+                renderFigure('plot-mch-scatter', data);
                 $("#methylation-tsneUpdateBtn, #methylation-tsneUpdateBtn-top").attr('disabled', false);
             }
         });
@@ -756,7 +835,7 @@ function updatesnATACScatterPlot(onlyUpdatetSNEandClustering=false) {
         $.ajax({
         //$.getJSON({
             type: "GET",
-            url: './plot/snATAC/scatter/'+ensemble+'/'+grouping+'/'+snATAC_color_percentile_Values[0]+'/'+snATAC_color_percentile_Values[1]+'/'+tsneOutlierOption+'/'+smoothing+'/'+max_points+'?q='+genes_query,
+            url: './api/snATAC/scatter/'+ensemble+'/'+grouping+'/'+snATAC_color_percentile_Values[0]+'/'+snATAC_color_percentile_Values[1]+'/'+tsneOutlierOption+'/'+smoothing+'/'+max_points+'?q='+genes_query,
             beforeSend: function() {
                 $("#snATAC-scatter-loader").show();
                 $("#methylation-tsneUpdateBtn, #methylation-tsneUpdateBtn-top").attr("disabled", true);
@@ -764,9 +843,11 @@ function updatesnATACScatterPlot(onlyUpdatetSNEandClustering=false) {
             complete: function() {
                 $("#snATAC-scatter-loader").hide();
             },
+            error: function(xhr) {
+                renderFigure('plot-snATAC-scatter', xhr.responseJSON);
+            },
             success: function(data) {
-                //Plotly.newPlot('plot-mch-scatter', data);
-                $('#plot-snATAC-scatter').html(data);
+                renderFigure('plot-snATAC-scatter', data);
                 $("#methylation-tsneUpdateBtn, #methylation-tsneUpdateBtn-top").attr("disabled", false);
             }
         });
@@ -810,7 +891,7 @@ function updateRNAScatterPlot(onlyUpdatetSNEandClustering=false) {
         $.ajax({
         //$.getJSON({
             type: "GET",
-            url: './plot/RNA/scatter/'+ensemble+'/'+grouping+'/'+RNA_color_percentile_Values[0]+'/'+RNA_color_percentile_Values[1]+'/'+tsneOutlierOption+'/'+max_points+'?q='+genes_query,
+            url: './api/RNA/scatter/'+ensemble+'/'+grouping+'/'+RNA_color_percentile_Values[0]+'/'+RNA_color_percentile_Values[1]+'/'+tsneOutlierOption+'/'+max_points+'?q='+genes_query,
             beforeSend: function() {
                 $("#RNA-scatter-loader").show();
                 $("#methylation-tsneUpdateBtn, #methylation-tsneUpdateBtn-top").attr("disabled", true);
@@ -818,9 +899,11 @@ function updateRNAScatterPlot(onlyUpdatetSNEandClustering=false) {
             complete: function() {
                 $("#RNA-scatter-loader").hide();
             },
+            error: function(xhr) {
+                renderFigure('plot-RNA-scatter', xhr.responseJSON);
+            },
             success: function(data) {
-                //Plotly.newPlot('plot-mch-scatter', data);
-                $('#plot-RNA-scatter').html(data);
+                renderFigure('plot-RNA-scatter', data);
                 $("#methylation-tsneUpdateBtn, #methylation-tsneUpdateBtn-top").attr("disabled", false);
             }
         });
@@ -982,17 +1065,20 @@ function updateMCHBoxPlot() {
 
     $.ajax({
         type: "GET",
-        url: './plot/methylation/box/'+ensemble+'/'+methylationType+'/'+geneSelected+'/'+grouping+'/'+clustering+'/'+levelType+'/'+outlierOption+'/'+max_points,
+        url: './api/methylation/box/'+ensemble+'/'+methylationType+'/'+geneSelected+'/'+grouping+'/'+clustering+'/'+levelType+'/'+outlierOption+'/'+max_points,
         beforeSend: function() {
             $("#mch-box-loader").show();
-            $("#plot-mch-heat").html("");
+            clearPlot("plot-mch-heat");
             $("#methylation-tsneUpdateBtn, #methylation-tsneUpdateBtn-top, #methylation-box-heat-outlierToggle").attr("disabled", true);
         },
         complete: function() {
             $('#mch-box-loader').hide();
         },
+        error: function(xhr) {
+            renderFigure('plot-mch-box', xhr.responseJSON);
+        },
         success: function(data) {
-            $("#plot-mch-box").html(data);
+            renderFigure('plot-mch-box', data);
             $("#methylation-tsneUpdateBtn, #methylation-tsneUpdateBtn-top, #methylation-box-heat-outlierToggle").attr("disabled", false);
         }
     });
@@ -1006,17 +1092,20 @@ function updateClustersBarPlot() {
 
     $.ajax({
         type: "GET",
-        url: './plot/clusters/bar/'+ensemble+'/'+grouping+'/'+clustering+'/'+normalize,
+        url: './api/clusters/bar/'+ensemble+'/'+grouping+'/'+clustering+'/'+normalize,
         beforeSend: function() {
             $("#clusters-bar-loader").show();
-            $("#plot-clusters-bar").html("");
+            clearPlot("plot-clusters-bar");
             $("#methylation-tsneUpdateBtn, #methylation-tsneUpdateBtn-top").attr("disabled", true);
         },
         complete: function() {
             $('#clusters-bar-loader').hide();
         },
+        error: function(xhr) {
+            renderFigure('plot-clusters-bar', xhr.responseJSON);
+        },
         success: function(data) {
-            $("#plot-clusters-bar").html(data);
+            renderFigure('plot-clusters-bar', data);
             $("#methylation-tsneUpdateBtn, #methylation-tsneUpdateBtn-top").attr("disabled", false);
         }
     });
@@ -1034,17 +1123,20 @@ function updatesnATACBoxPlot() {
 
     $.ajax({
         type: "GET",
-        url: './plot/snATAC/box/'+ensemble+'/'+geneSelected+'/'+grouping+'/'+outlierOption,
+        url: './api/snATAC/box/'+ensemble+'/'+geneSelected+'/'+grouping+'/'+outlierOption,
         beforeSend: function() {
             // $("#snATAC-box-heat-UpdateBtn").attr("disabled", true);
             $("#snATAC-box-loader").show();
-            $("#plot-snATAC-heat").html("");
+            clearPlot("plot-snATAC-heat");
         },
         complete: function() {
             $("#snATAC-box-loader").hide();
         },
+        error: function(xhr) {
+            renderFigure('plot-snATAC-box', xhr.responseJSON);
+        },
         success: function(data) {
-            $('#plot-snATAC-box').html(data);
+            renderFigure('plot-snATAC-box', data);
             // $("#snATAC-box-heat-UpdateBtn").attr("disabled", false);
         }
     });
@@ -1064,17 +1156,20 @@ function updateRNABoxPlot() {
 
     $.ajax({
         type: "GET",
-        url: './plot/RNA/box/'+ensemble+'/'+geneSelected+'/'+grouping+'/'+outlierOption,
+        url: './api/RNA/box/'+ensemble+'/'+geneSelected+'/'+grouping+'/'+outlierOption,
         beforeSend: function() {
             $("#RNA-box-heat-UpdateBtn").attr("disabled", true);
             $("#RNA-box-loader").show();
-            $("#plot-RNA-heat").html("");
+            clearPlot("plot-RNA-heat");
         },
         complete: function() {
             $("#RNA-box-loader").hide();
         },
+        error: function(xhr) {
+            renderFigure('plot-RNA-box', xhr.responseJSON);
+        },
         success: function(data) {
-            $('#plot-RNA-box').html(data);
+            renderFigure('plot-RNA-box', data);
             $("#RNA-box-heat-UpdateBtn").attr("disabled", false);
         }
     });
@@ -1095,9 +1190,10 @@ function updateMCHCombinedBoxPlot(mmu_gid, hsa_gid) {
         type: "GET",
         url: './plot/box_combined/'+methylationType+'/'+mmu_gid+'/'+hsa_gid+'/'+levelType+'/'+outlierOption,
         success: function(data) {
-            $('#plot-mch-heat').html("");
+            clearPlot("plot-mch-heat");
             $('#mch_box_div').addClass("col-md-9");
             $('#gene_table_div').show();
+            clearPlot("plot-mch-box");
             $('#plot-mch-box').html(data);
         }
     });
@@ -1127,19 +1223,22 @@ function updateMethylationHeatmap() {
 
     $.ajax({
         type: "GET",
-        url: './plot/methylation/heat/'+ensemble+'/'+methylationType+'/'+grouping+'/'+clustering+'/'+levelType+'/'+methylation_box_color_percentile_Values[0]+'/'+methylation_box_color_percentile_Values[1]+'?q='+genes_query+'&normalize='+normalize,
+        url: './api/methylation/heat/'+ensemble+'/'+methylationType+'/'+grouping+'/'+clustering+'/'+levelType+'/'+methylation_box_color_percentile_Values[0]+'/'+methylation_box_color_percentile_Values[1]+'?q='+genes_query+'&normalize='+normalize,
         beforeSend: function() {
             $("#mch-box-loader").show();
-            $("#plot-mch-box").html("");
+            clearPlot("plot-mch-box");
             $("#methylation-tsneUpdateBtn, #methylation-tsneUpdateBtn-top").attr("disabled", true);
         },
         complete: function() {
             $("#mch-box-loader").hide();
         },
+        error: function(xhr) {
+            renderFigure('plot-mch-heat', xhr.responseJSON);
+        },
         success: function(data) {
             $('#gene_table_div').hide();
             $('#mch_box_div').removeClass("col-md-9");
-            $('#plot-mch-heat').html(data);
+            renderFigure('plot-mch-heat', data);
             $("#methylation-tsneUpdateBtn, #methylation-tsneUpdateBtn-top").attr("disabled", false);
             $('#methylation-box-heat-outlierToggle').bootstrapToggle('disable');
         }
@@ -1167,17 +1266,20 @@ function updatesnATACHeatmap() {
 
     $.ajax({
         type: "GET",
-        url: './plot/snATAC/heat/'+ensemble+'/'+grouping+'/'+snATAC_color_percentile_Values[0]+'/'+snATAC_color_percentile_Values[1]+'?q='+genes_query+'&normalize='+normalize,
+        url: './api/snATAC/heat/'+ensemble+'/'+grouping+'/'+snATAC_color_percentile_Values[0]+'/'+snATAC_color_percentile_Values[1]+'?q='+genes_query+'&normalize='+normalize,
         beforeSend: function() {
             $("#snATAC-box-loader").show();
-            $("#plot-snATAC-box").html("");
+            clearPlot("plot-snATAC-box");
             // $("#snATAC-box-heat-UpdateBtn").attr("disabled", true);
         },
         complete: function() {
             $("#snATAC-box-loader").hide();
         },
+        error: function(xhr) {
+            renderFigure('plot-snATAC-heat', xhr.responseJSON);
+        },
         success: function(data) {
-            $('#plot-snATAC-heat').html(data);
+            renderFigure('plot-snATAC-heat', data);
             $('#methylation-box-heat-outlierToggle').bootstrapToggle('disable');
             // $("#snATAC-box-heat-UpdateBtn").attr("disabled", false);
         }
@@ -1206,17 +1308,20 @@ function updateRNAHeatmap() {
 
     $.ajax({
         type: "GET",
-        url: './plot/RNA/heat/'+ensemble+'/'+grouping+'/'+RNA_color_percentile_Values[0]+'/'+RNA_color_percentile_Values[1]+'?q='+genes_query+'&normalize='+normalize,
+        url: './api/RNA/heat/'+ensemble+'/'+grouping+'/'+RNA_color_percentile_Values[0]+'/'+RNA_color_percentile_Values[1]+'?q='+genes_query+'&normalize='+normalize,
         beforeSend: function() {
             $("#RNA-box-loader").show();
-            $("#plot-RNA-box").html("");
+            clearPlot("plot-RNA-box");
             $("#RNA-box-heat-UpdateBtn").attr("disabled", true);
         },
         complete: function() {
             $("#RNA-box-loader").hide();
         },
+        error: function(xhr) {
+            renderFigure('plot-RNA-heat', xhr.responseJSON);
+        },
         success: function(data) {
-            $('#plot-RNA-heat').html(data);
+            renderFigure('plot-RNA-heat', data);
             $('#RNA-box-heat-outlierToggle').bootstrapToggle('disable');
             $("#RNA-box-heat-UpdateBtn").attr("disabled", false);
         }
@@ -1246,9 +1351,10 @@ function updateMethylationHeatmapTwoSpecies() {
         type: "GET",
         url: './plot/heat_two_ensemble/'+ensemble+'/'+methylationType+'/'+levelType+'/'+methylation_color_percentile_Values[0]+'/'+methylation_color_percentile_Values[1]+'?q='+genes_query+'&normalize='+normalize,
         success: function(data) {
-            $('#plot-mch-box').html("");
+            clearPlot("plot-mch-box");
             $('#gene_table_div').hide();
             $('#mch_box_div').removeClass("col-md-9");
+            clearPlot("plot-mch-heat");
             $('#plot-mch-heat').html(data);
             $('#methylation-box-heat-outlierToggle').bootstrapToggle('disable');
         }
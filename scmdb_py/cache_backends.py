@@ -0,0 +1,108 @@
+"""Shared Flask-Cache backends.
+
+The default 'simple' cache lives in the memory of each WSGI process, so it is
+duplicated per worker and lost on reload. Set CACHE_TYPE in default_config.py
+to one of these to share memoized results between processes:
+
+    scmdb_py.cache_backends.redis       CACHE_REDIS_URL, or CACHE_REDIS_FAKE = True
+                                        for an in-process fakeredis server
+    scmdb_py.cache_backends.filesystem  CACHE_DIR, at most CACHE_THRESHOLD entries
+
+DataFrames are stored as Arrow IPC bytes when pyarrow is installed; other values,
+and frames Arrow cannot represent, are pickled as before.
+"""
+import os
+
+import pandas as pd
+from werkzeug.contrib.cache import FileSystemCache, RedisCache
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+ARROW_MARKER = b'arrow:'
+
+
+class ArrowFrame(bytes):
+    """Arrow IPC stream of a DataFrame, as kept in a FileSystemCache."""
+
+
+def dump_frame(value):
+    """Arrow IPC bytes of a DataFrame, or None if value is not one or cannot be converted."""
+    if pa is None or not isinstance(value, pd.DataFrame):
+        return None
+    try:
+        table = pa.Table.from_pandas(value)
+        sink = pa.BufferOutputStream()
+        writer = pa.RecordBatchStreamWriter(sink, table.schema)
+        writer.write_table(table)
+        writer.close()
+    except (pa.ArrowException, TypeError, ValueError):
+        return None
+    return sink.getvalue().to_pybytes()
+
+
+def load_frame(data):
+    return pa.RecordBatchStreamReader(pa.BufferReader(data)).read_all().to_pandas()
+
+
+class ArrowRedisCache(RedisCache):
+
+    def dump_object(self, value):
+        frame = dump_frame(value)
+        if frame is not None:
+            return ARROW_MARKER + frame
+        return super().dump_object(value)
+
+    def load_object(self, value):
+        if value is not None and value.startswith(ARROW_MARKER):
+            return load_frame(value[len(ARROW_MARKER):])
+        return super().load_object(value)
+
+
+class ArrowFileSystemCache(FileSystemCache):
+
+    def _encode(self, value):
+        frame = dump_frame(value)
+        return value if frame is None else ArrowFrame(frame)
+
+    def get(self, key):
+        value = super().get(key)
+        if isinstance(value, ArrowFrame):
+            return load_frame(value)
+        return value
+
+    def set(self, key, value, timeout=None):
+        return super().set(key, self._encode(value), timeout)
+
+    def add(self, key, value, timeout=None):
+        return super().add(key, self._encode(value), timeout)
+
+
+def redis(app, config, args, kwargs):
+    """Flask-Cache factory for CACHE_TYPE = 'scmdb_py.cache_backends.redis'."""
+    if config.get('CACHE_REDIS_FAKE'):
+        import fakeredis
+        kwargs['host'] = fakeredis.FakeStrictRedis()
+    elif config.get('CACHE_REDIS_URL'):
+        from redis import from_url
+        kwargs['host'] = from_url(config['CACHE_REDIS_URL'])
+    else:
+        kwargs.update(host=config.get('CACHE_REDIS_HOST', 'localhost'),
+                      port=config.get('CACHE_REDIS_PORT', 6379),
+                      password=config.get('CACHE_REDIS_PASSWORD'),
+                      db=config.get('CACHE_REDIS_DB', 0))
+    kwargs['key_prefix'] = config.get('CACHE_KEY_PREFIX')
+    return ArrowRedisCache(*args, **kwargs)
+
+
+def filesystem(app, config, args, kwargs):
+    """Flask-Cache factory for CACHE_TYPE = 'scmdb_py.cache_backends.filesystem'.
+
+    FileSystemCache has no key prefix, so each CACHE_KEY_PREFIX (one per DATA_VERSION)
+    gets its own subdirectory of CACHE_DIR, which clear() empties.
+    """
+    prefix = (config.get('CACHE_KEY_PREFIX') or 'default').replace(':', '_').strip('_')
+    kwargs['threshold'] = config['CACHE_THRESHOLD']
+    return ArrowFileSystemCache(os.path.join(config['CACHE_DIR'], prefix), *args, **kwargs)
@@ -0,0 +1,102 @@
+"""Per-ensemble catalog of plot options, materialized as JSON at ingest time.
+
+The ensemble page and the tSNE option menus need the tSNE and clustering
+columns of an ensemble, the number of clusters of each clustering, the
+metadata fields of each modality and which modality databases include the
+ensemble. Computing these takes a MAX() over every clustering column (a full
+table scan) and several queries per modality, so they are written once per
+ensemble to
+
+    <CATALOG_DIR>/<ensemble>.json
+
+and read back with a single file read. Ensembles without a catalog file, or
+with CATALOG_DIR not configured, are still introspected from MySQL.
+"""
+import datetime
+import json
+import os
+from collections import OrderedDict
+
+from flask import current_app
+
+CATALOG_FORMAT_VERSION = 1
+
+_catalogs = {}
+
+
+def catalog_path(ensemble, root=None):
+    root = root or current_app.config.get('CATALOG_DIR') or None
+    if root is None:
+        return None
+    return os.path.join(root, ensemble + '.json')
+
+
+def ensemble_catalog(ensemble):
+    """Read the catalog of an ensemble if it has been built.
+
+    Catalogs are cached per process and re-read when the file changes.
+
+    Arguments:
+        ensemble (str): Ensemble table name. ie. Ens218
+
+    Returns:
+        dict or None.
+    """
+    if not ensemble or os.path.sep in ensemble:
+        return None
+    path = catalog_path(ensemble)
+    if path is None:
+        return None
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+
+    cached = _catalogs.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(path) as f:
+        catalog = json.load(f, object_pairs_hook=OrderedDict)
+    if catalog.get('format') != CATALOG_FORMAT_VERSION:
+        return None
+    _catalogs[path] = (mtime, catalog)
+    return catalog
+
+
+def build_catalog(ensemble, root=None, log=print):
+    """Introspect an ensemble in every modality database and write its catalog.
+
+    Arguments:
+        ensemble (str): Ensemble table name. ie. Ens218
+        root (str): Catalog directory. Defaults to CATALOG_DIR.
+
+    Returns:
+        str: Path of the written catalog.
+    """
+    from .content import ensemble_exists, query_metadata_options, query_snATAC_tsne_options
+
+    if ';' in ensemble or os.path.sep in ensemble:
+        raise ValueError('Invalid ensemble name: {}'.format(ensemble))
+    path = catalog_path(ensemble, root)
+    if path is None:
+        raise ValueError('CATALOG_DIR is not configured.')
+
+    ensemble_id = ensemble.lower().replace('ens', '')
+    catalog = OrderedDict([
+        ('format', CATALOG_FORMAT_VERSION),
+        ('ensemble', ensemble),
+        ('built', str(datetime.datetime.now())),
+        ('modalities', OrderedDict((modality, ensemble_exists(ensemble_id, modality=modality))
+                                   for modality in ['methylation', 'snATAC', 'RNA'])),
+        ('metadata_options', query_metadata_options(ensemble)),
+        ('snATAC_tsne_options', query_snATAC_tsne_options(ensemble)),
+    ])
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + '.building', 'w') as f:
+        json.dump(catalog, f)
+    os.rename(path + '.building', path)
+    log('{}: wrote {}'.format(ensemble, path))
+
+    return path
@@ -0,0 +1,362 @@
+"""Per-ensemble cell metadata held in memory for gene queries against MySQL.
+
+Every single-gene query used to repeat the cells/Ens/datasets/ABA_regions
+JOINs only to fetch the same cell ids, clusters, annotations, tSNE
+coordinates and dataset columns. For ensembles that have not been exported to
+the matrix store, those columns are read once (string columns dictionary
+encoded, tSNE coordinates as float32), and a gene then costs one narrow
+
+    SELECT gene.cell_id, gene.mCH, gene.CH FROM gene JOIN <ensemble>
+
+whose rows are aligned to the cached cells by a binary search of their sorted
+cell ids. CachedEnsemble has the
+same interface as matrix_store.EnsembleStore, so content.py reads both the
+same way; open_ensemble() returns whichever is available.
+
+When CELL_METADATA_DIR is set, the arrays are published there once and every
+WSGI worker memory-maps the same files instead of holding its own copy:
+
+    <CELL_METADATA_DIR>/<modality>/<ensemble>/
+        CURRENT                   {"generation": 3, "data_version": 1, "format": 2}
+        g3/meta.json              column descriptions
+        g3/<column>.npy           one array per cell metadata column, cells sorted by cell_id
+
+A reload writes the next generation directory and then replaces CURRENT, so
+workers switch atomically on their next request and never see a partial
+generation. Older generations are removed; workers still mapping them keep
+reading their (unlinked) files until they switch.
+
+Set CELL_METADATA_CACHE = False to query MySQL as before. At most
+CELL_METADATA_ENSEMBLES ensembles (default 8) are kept per process, and all
+are reloaded when DATA_VERSION changes.
+"""
+import datetime
+import json
+import os
+import shutil
+import sys
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from flask import current_app
+from sqlalchemy import exc
+
+from . import db
+from .gene_index import gene_index
+from .matrix_store import cell_metadata, open_store
+from .table_catalog import table_catalog
+
+# Layout of published generations. CURRENT files of another format are republished.
+CELL_METADATA_FORMAT = 2
+
+# Attempts to attach the current generation of a shared ensemble while it is being replaced.
+ATTACH_RETRIES = 5
+
+_ensembles = OrderedDict()
+
+
+def _encode_columns(cells):
+    """Cell metadata columns as arrays, with the cells sorted by cell_id.
+
+    String columns become (int32 codes, categories), code -1 for NULL, except for cell_id and
+    other columns of mostly distinct values without NULLs (ie. cell_name), which are stored as
+    fixed-width UTF-8 bytes so that they can be memory-mapped instead of copied per worker.
+    Sorted cell ids let gene rows be aligned with np.searchsorted.
+    """
+    if cells['cell_id'].dtype == object:
+        cells = cells.assign(cell_id=cells['cell_id'].map(str))
+    cells = cells.iloc[np.argsort(cells['cell_id'].values, kind='mergesort')]
+    columns = OrderedDict()
+    for column in cells.columns:
+        values = cells[column]
+        if values.dtype == object and (column == 'cell_id' or (
+                values.notnull().all() and values.nunique() > len(values) // 2)):
+            columns[column] = np.array([str(value).encode('utf-8') for value in values], dtype=bytes)
+        elif values.dtype == object:
+            categorical = pd.Categorical(values.map(lambda v: None if pd.isnull(v) else str(v)))
+            # The trailing None is picked by code -1 (NULL).
+            categories = np.array(categorical.categories.tolist() + [None], dtype=object)
+            columns[column] = (categorical.codes.astype(np.int32), categories)
+        elif column.startswith('tsne_'):
+            columns[column] = values.values.astype(np.float32)
+        else:
+            columns[column] = values.values
+    return columns
+
+
+class CachedEnsemble(object):
+    """Cells of one ensemble/modality read from MySQL once. Gene values are queried per gene.
+
+    Arguments:
+        ensemble (str): Ensemble table name. ie. Ens218
+        modality (str): 'methylation', 'snATAC' or 'RNA'.
+        columns (OrderedDict): Column name to array, or to (codes, categories) for strings.
+    """
+
+    def __init__(self, ensemble, modality, columns):
+        self.ensemble = ensemble
+        self.modality = modality
+        self.columns = columns
+        # Sorted by _encode_columns. Memory-mapped, not copied, for shared ensembles.
+        self.cell_ids = self.columns['cell_id']
+        self.n_cells = len(self.cell_ids)
+        # Column names, for sample_rows and the code paths shared with EnsembleStore.
+        self.meta = {'columns': self.columns}
+
+    @property
+    def cell_columns(self):
+        return list(self.columns.keys())
+
+    @property
+    def has_correlated_genes(self):
+        return False
+
+    def has_gene(self, gene_id):
+        table = gene_index(self.modality).table_name(gene_id)
+        return table is not None and table_catalog(self.modality).has_table(table)
+
+    def cell_column(self, column, rows=None):
+        """Return a cell metadata column. String columns are object arrays with None for NULL, like read_sql."""
+        values = self.columns[column]
+        if isinstance(values, tuple):
+            codes, categories = values
+            if rows is not None:
+                codes = codes[rows]
+            return categories[np.asarray(codes)]
+        if rows is not None:
+            values = values[rows]
+        if values.dtype.kind == 'S':
+            return np.array([value.decode('utf-8') for value in values], dtype=object)
+        return np.asarray(values)
+
+    def cell_positions(self, cell_ids):
+        """Positions of cell ids among the ensemble's cells, -1 for cells not in the ensemble."""
+        if self.cell_ids.dtype.kind == 'S':
+            keys = np.array([str(cell_id).encode('utf-8') for cell_id in cell_ids], dtype=bytes)
+        else:
+            keys = np.asarray(cell_ids)
+        positions = np.searchsorted(self.cell_ids, keys)
+        positions[positions >= self.n_cells] = 0
+        found = np.zeros(len(keys), dtype=bool)
+        if self.n_cells:
+            found = self.cell_ids[positions] == keys
+        return np.where(found, positions, -1)
+
+    def gene_frame(self, gene_id, columns, rows=None):
+        """Query some of a gene's value columns and align them to the cells.
+
+        Returns:
+            dict: column to float32 array, NaN for cells the gene table has no row for.
+        """
+        table = gene_index(self.modality).table_name(gene_id)
+        if table is None:
+            raise KeyError(gene_id)
+        query = "SELECT {0}.cell_id, {1} FROM {0} INNER JOIN {2} ON {2}.cell_id = {0}.cell_id".format(
+            table, ', '.join(table+'.'+column for column in columns), self.ensemble)
+        df = pd.read_sql(query, db.get_engine(current_app, self.modality+'_data'))
+
+        positions = self.cell_positions(df['cell_id'].values)
+        found = positions >= 0
+        values = OrderedDict()
+        for column in columns:
+            aligned = np.full(self.n_cells, np.nan, dtype=np.float32)
+            aligned[positions[found]] = pd.to_numeric(df[column]).values[found]
+            values[column] = aligned if rows is None else aligned[rows]
+        return values
+
+    def gene_values(self, gene_id, column, rows=None):
+        """Return one gene's values for every cell (or the given rows) as float32."""
+        return self.gene_frame(gene_id, [column], rows)[column]
+
+    def frame(self, cell_columns, gene_id=None, gene_columns=(), rows=None):
+        """Assemble a DataFrame of cell metadata followed by one gene's values, like EnsembleStore.frame."""
+        data = [(column, self.cell_column(column, rows)) for column in cell_columns]
+        if gene_columns:
+            sources = [column[1] if isinstance(column, tuple) else column for column in gene_columns]
+            values = self.gene_frame(gene_id, list(OrderedDict.fromkeys(sources)), rows)
+            for column, source in zip(gene_columns, sources):
+                name = column[0] if isinstance(column, tuple) else column
+                data.append((name, values[source]))
+        return pd.DataFrame(OrderedDict(data))
+
+
+def shared_path(ensemble, modality='methylation'):
+    root = current_app.config.get('CELL_METADATA_DIR') or None
+    if root is None:
+        return None
+    return os.path.join(root, modality, ensemble)
+
+
+def _read_current(directory):
+    """Contents and mtime of a shared ensemble's CURRENT file, or (None, None)."""
+    current_file = os.path.join(directory, 'CURRENT')
+    try:
+        mtime = os.path.getmtime(current_file)
+        with open(current_file) as f:
+            return json.load(f), mtime
+    except (OSError, ValueError):
+        return None, None
+
+
+def publish(ensemble, modality, columns, directory):
+    """Write cell metadata columns as the next generation of a shared ensemble and make it current.
+
+    Returns:
+        int: The published generation.
+    """
+    current, _ = _read_current(directory)
+    generation = current['generation'] + 1 if current else 1
+    final_path = os.path.join(directory, 'g{}'.format(generation))
+    tmp_path = '{}.building.{}'.format(final_path, os.getpid())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    column_info = OrderedDict()
+    for column, values in columns.items():
+        if isinstance(values, tuple):
+            codes, categories = values
+            np.save(os.path.join(tmp_path, column + '.npy'), codes)
+            column_info[column] = {'kind': 'categorical', 'categories': categories[:-1].tolist()}
+        elif values.dtype.kind == 'S':
+            np.save(os.path.join(tmp_path, column + '.npy'), values)
+            column_info[column] = {'kind': 'bytes', 'dtype': str(values.dtype)}
+        else:
+            np.save(os.path.join(tmp_path, column + '.npy'), values)
+            column_info[column] = {'kind': 'numeric', 'dtype': str(values.dtype)}
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'ensemble': ensemble, 'modality': modality, 'built': str(datetime.datetime.now()),
+                   'columns': column_info}, f)
+
+    try:
+        os.rename(tmp_path, final_path)
+    except OSError:
+        # Another worker published this generation first.
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return generation
+
+    current_file = os.path.join(directory, 'CURRENT')
+    with open(current_file + '.building.{}'.format(os.getpid()), 'w') as f:
+        json.dump({'generation': generation, 'data_version': current_app.config.get('DATA_VERSION'),
+                   'format': CELL_METADATA_FORMAT}, f)
+    os.replace(current_file + '.building.{}'.format(os.getpid()), current_file)
+
+    for name in os.listdir(directory):
+        if name.startswith('g') and name != 'g{}'.format(generation) and '.building.' not in name:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    return generation
+
+
+def attach(ensemble, modality, directory, generation):
+    """Memory-map a published generation of a shared ensemble."""
+    path = os.path.join(directory, 'g{}'.format(generation))
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f, object_pairs_hook=OrderedDict)
+    columns = OrderedDict()
+    for column, info in meta['columns'].items():
+        values = np.load(os.path.join(path, column + '.npy'), mmap_mode='r')
+        if info['kind'] == 'categorical':
+            values = (values, np.array(info['categories'] + [None], dtype=object))
+        columns[column] = values
+    return CachedEnsemble(ensemble, modality, columns)
+
+
+def load_columns(ensemble, modality='methylation'):
+    """Read and encode an ensemble's cell metadata from MySQL, or None on errors."""
+    try:
+        cells = cell_metadata(db.get_engine(current_app, modality+'_data'), ensemble, modality)
+    except exc.ProgrammingError as e:
+        now = datetime.datetime.now()
+        print("[{}] ERROR in app(cached_ensemble): {}".format(str(now), e))
+        sys.stdout.flush()
+        return None
+    return _encode_columns(cells)
+
+
+def publish_ensemble(ensemble, modality='methylation', log=print):
+    """Re-read an ensemble's cell metadata and publish it as a new generation in CELL_METADATA_DIR."""
+    if ';' in ensemble:
+        raise ValueError('Invalid ensemble name: {}'.format(ensemble))
+    directory = shared_path(ensemble, modality)
+    if directory is None:
+        raise ValueError('CELL_METADATA_DIR is not configured.')
+    columns = load_columns(ensemble, modality)
+    if columns is None:
+        raise ValueError('Could not read the cells of {} ({})'.format(ensemble, modality))
+    generation = publish(ensemble, modality, columns, directory)
+    log('{}: published generation {} in {}'.format(ensemble, generation, directory))
+
+
+def _remember(key, entry):
+    _ensembles[key] = entry
+    while len(_ensembles) > current_app.config.get('CELL_METADATA_ENSEMBLES', 8):
+        _ensembles.popitem(last=False)
+    return entry[2]
+
+
+def cached_ensemble(ensemble, modality='methylation'):
+    """Cell metadata of an ensemble read from MySQL on first use, or None if disabled or unavailable."""
+    if not current_app.config.get('CELL_METADATA_CACHE', True):
+        return None
+    if modality not in ['methylation', 'snATAC', 'RNA'] or ';' in ensemble:
+        return None
+
+    key = (modality, ensemble)
+    version = current_app.config.get('DATA_VERSION')
+    directory = shared_path(ensemble, modality)
+    cached = _ensembles.get(key)
+
+    if directory is None:
+        if cached is not None and cached[0] == version:
+            _ensembles.move_to_end(key)
+            return cached[2]
+    else:
+        for attempt in range(ATTACH_RETRIES):
+            current, mtime = _read_current(directory)
+            if current is None or current.get('data_version') != version or current.get('format') != CELL_METADATA_FORMAT:
+                # Not published for this DATA_VERSION yet; read MySQL and publish below.
+                break
+            if cached is not None and cached[0] == version and cached[1] == mtime:
+                _ensembles.move_to_end(key)
+                return cached[2]
+            try:
+                return _remember(key, (version, mtime, attach(ensemble, modality, directory, current['generation'])))
+            except (OSError, ValueError):
+                # Replaced by a newer generation while attaching; attach that one instead.
+                continue
+        else:
+            # Generations keep changing under us. Query MySQL directly for this request rather than
+            # publishing yet another generation, which would remove the one others are attaching.
+            now = datetime.datetime.now()
+            print("[{}] ERROR in app(cached_ensemble): could not attach {} in {}".format(str(now), ensemble, directory))
+            sys.stdout.flush()
+            return None
+
+    if not table_catalog(modality).has_table(ensemble):
+        return None
+    columns = load_columns(ensemble, modality)
+    if columns is None:
+        return None
+
+    if directory is not None:
+        try:
+            generation = publish(ensemble, modality, columns, directory)
+            _, mtime = _read_current(directory)
+            return _remember(key, (version, mtime, attach(ensemble, modality, directory, generation)))
+        except (OSError, ValueError) as e:
+            now = datetime.datetime.now()
+            print("[{}] ERROR in app(cached_ensemble): could not publish to {}: {}".format(str(now), directory, e))
+            sys.stdout.flush()
+    return _remember(key, (version, None, CachedEnsemble(ensemble, modality, columns)))
+
+
+def open_ensemble(ensemble, modality='methylation'):
+    """The ensemble's matrix store if it has been built, otherwise its cached cell metadata.
+
+    Returns:
+        EnsembleStore, CachedEnsemble or None.
+    """
+    store = open_store(ensemble, modality)
+    if store is not None:
+        return store
+    return cached_ensemble(ensemble, modality)
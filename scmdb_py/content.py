@@ -1,4 +1,5 @@
 """Functions used to generate content. """
+import base64
 import datetime
 import json
 import math
@@ -28,10 +29,22 @@ from scipy.cluster import hierarchy
 from multiprocessing import Pool
 
 from . import cache, db
+from .catalog import ensemble_catalog
+from .cell_cache import open_ensemble
+from .correlation import correlation_matrix
+from .gene_index import gene_index
+from .matrix_store import open_store, sample_rows
+from .precompute import cell_digest, table_versions
+from .raster import RASTER_SIZE, rasterize
+from .spatial_index import cell_gene_values, spatial_index
+from .table_catalog import table_catalog
 from os import path
 
 content = Blueprint('content', __name__) # Flask "bootstrap"
 
+# Tabular summaries are cached until one of the tables they are built from changes.
+SUMMARY_TIMEOUT = 1800
+
 cluster_annotation_order = ['mL2/3', 'mL4', 'mL5-1', 'mL5-2', 'mDL-1', 'mDL-2', \
 							'mL6-1', 'mL6-2', 'mDL-3', 'mVip', 'mNdnf-1', \
 							'mNdnf-2', 'mPv', 'mSst-1', 'mSst-2', 'None']
@@ -44,6 +57,101 @@ class FailToGraphException(Exception):
 	"""Fail to generate data or graph due to an internal error."""
 	pass
 
+# Numeric trace arrays at least this long are sent as typed arrays by figure_json.
+TYPED_ARRAY_MIN_LENGTH = 32
+
+def typed_array(values, float32=False):
+	"""Encode numbers as {'dtype': ..., 'bdata': base64 of the little-endian values}.
+
+	This is the typed array format decoded by decodeTypedArrays in customview.js. Integers are
+	sent as uint16 when they fit and int32 otherwise, floats as float64, or float32 if asked.
+	Missing values (None) become NaN.
+
+	Arguments:
+		values (list or numpy array): Numbers to encode.
+		float32 (bool): Send floats as float32, half the size. Enough for coordinates and colors.
+
+	Returns:
+		dict, or None if values is short or not all numbers.
+	"""
+	if len(values) < TYPED_ARRAY_MIN_LENGTH:
+		return None
+	if isinstance(values, np.ndarray):
+		if values.ndim != 1 or values.dtype.kind not in 'iuf':
+			return None
+		array = values
+	elif not all(value is None or (isinstance(value, (int, float)) and not isinstance(value, bool)) for value in values):
+		return None
+	elif all(isinstance(value, int) for value in values):
+		array = np.asarray(values)
+	else:
+		array = np.asarray([nan if value is None else value for value in values], dtype=float)
+
+	if array.dtype.kind in 'iu' and array.min() >= 0 and array.max() < 2**16:
+		array = array.astype('<u2')
+	elif array.dtype.kind in 'iu' and array.min() >= -2**31 and array.max() < 2**31:
+		array = array.astype('<i4')
+	else:
+		array = array.astype('<f4' if float32 else '<f8')
+	return {'dtype': array.dtype.str[1:], 'bdata': base64.b64encode(array.tobytes()).decode('ascii')}
+
+def _encode_arrays(obj, float32=False):
+	if isinstance(obj, dict):
+		return dict((key, _encode_arrays(value, float32)) for key, value in obj.items())
+	if isinstance(obj, (list, tuple, np.ndarray)):
+		encoded = typed_array(obj, float32)
+		if encoded is not None:
+			return encoded
+		if isinstance(obj, np.ndarray):
+			obj = obj.tolist()
+		return [_encode_arrays(value, float32) for value in obj]
+	return obj
+
+def figure_json(figure, float32=False):
+	"""Plain JSON-serializable figure for Plotly.react, with long numeric trace arrays as typed arrays.
+
+	Arrays are encoded before the figure is serialized, so traces built from numpy arrays (rather
+	than .tolist()) never go through a list of Python floats.
+
+	Arguments:
+		figure: Figure, or dict with 'data' and 'layout', as passed to plotly.offline.plot.
+		float32 (bool): Send float arrays as float32 (see typed_array).
+
+	Returns:
+		dict: {'data': [...], 'layout': {...}}
+	"""
+	if not isinstance(figure, dict):
+		figure = figure.to_plotly_json()
+	data = [trace.to_plotly_json() if hasattr(trace, 'to_plotly_json') else trace for trace in figure.get('data', [])]
+	figure = {'data': [_encode_arrays(trace, float32) for trace in data],
+			  'layout': figure.get('layout', {})}
+	return json.loads(json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder))
+
+def render_figure(figure, output='html', float32=False, hover=None):
+	"""Render a figure as the plot routes' HTML div or, for the /api/ routes, as figure JSON.
+
+	Arguments:
+		figure: Figure, or dict with 'data' and 'layout'.
+		output (str): 'html' or 'json'.
+		float32 (bool): For 'json', send float arrays as float32 (see typed_array).
+		hover (list): For 'json', set_hover's result for each trace, or None. Sent as the traces' 'hoverdata'.
+
+	Returns:
+		str: HTML generated by Plot.ly, or dict from figure_json.
+	"""
+	if output == 'json':
+		figure = figure_json(figure, float32)
+		for trace, columns in zip(figure['data'], hover or []):
+			if columns is not None:
+				# Short value columns stay lists, whose NaN the Plot.ly encoder writes as null.
+				trace['hoverdata'] = json.loads(json.dumps(_encode_arrays(columns), cls=plotly.utils.PlotlyJSONEncoder))
+		return figure
+	return plotly.offline.plot(
+		figure_or_data=figure,
+		output_type='div',
+		show_link=False,
+		include_plotlyjs=False)
+
 # @content.route('/content/metadata/')
 # def get_metadata():
 # 	result = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM cells LIMIT 1;").fetchall()
@@ -51,19 +159,39 @@ class FailToGraphException(Exception):
 # 	return json.dumps({"data": result})
 
 
-@content.route('/content/ensembles')
-def get_ensembles_summary():
-	""" Retrieve data to be displayed in the "Ensembles" summary tabular page.
-		"/tabular/ensemble"
+def cached_summary(name, tables, build):
+	"""Return build(), cached under the create/update times of the tables it reads.
+
+	Arguments:
+		name (str): Cache key prefix.
+		tables ([str]): Tables of the methylation and snATAC databases the summary is built from.
+		build (function): Builds the summary.
+	"""
+	try:
+		versions = [table_versions(db.get_engine(current_app, modality+'_data'), tables)
+					for modality in ['methylation', 'snATAC']]
+	except exc.ProgrammingError as e:
+		now = datetime.datetime.now()
+		print("[{}] ERROR in app(cached_summary): {}".format(str(now), e))
+		sys.stdout.flush()
+		return build()
+
+	key = '{}:{}'.format(name, json.dumps(versions))
+	summary = cache.get(key)
+	if summary is None:
+		summary = build()
+		cache.set(key, summary, timeout=SUMMARY_TIMEOUT)
+	return summary
+
+
+def build_ensembles_summary():
+	"""Build the rows of the "Ensembles" summary tabular page, for every ensemble.
+
+	Uses one query per table and joins in memory instead of querying per ensemble.
+
+	Returns:
+		list: dict per ensemble with at least one cell.
 	"""
-	regions = request.args.get('region', '').split()
-	regions = [ region.lower() for region in regions ]
-	# Remove suffix after "-" -- for compatibility with Dong lab iConnectome
-	regions = [ re.sub(r'-.*','',region) for region in regions ]
-	regions_tgt = request.args.get('region_tgt', '').split()
-	regions_tgt = [ region_tgt.lower() for region_tgt in regions_tgt ]
-	
-	ensemble_list=[]
 	ensemble_list = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM ensembles").fetchall()
 
 	total_methylation_cell_each_dataset = db.get_engine(current_app, 'methylation_data').execute("SELECT dataset, COUNT(*) as `num` FROM cells GROUP BY dataset").fetchall()
@@ -71,159 +199,153 @@ def get_ensembles_summary():
 	total_methylation_cell_each_dataset = pd.DataFrame(total_methylation_cell_each_dataset, columns=['dataset','num']).set_index('dataset')
 	total_snATAC_cell_each_dataset = pd.DataFrame(total_snATAC_cell_each_dataset, columns=['dataset','num']).set_index('dataset')
 
-	ensembles_cell_counts = []
-	for ensemble in ensemble_list:
-		datasets = ensemble['datasets'].split(',')
-		methylation_cell_counts=total_methylation_cell_each_dataset.filter(datasets,axis=0)['num'].to_dict()
-		snATAC_cell_counts=total_snATAC_cell_each_dataset.filter(datasets,axis=0)['num'].to_dict()
-		annoj_exists = ensemble_annoj_exists(ensemble['ensemble_id'])
-		ensembles_cell_counts.append( {"id": ensemble['ensemble_id'],
-									   "ensemble": ensemble['ensemble_name'],
-									   "ens_methylation_counts": methylation_cell_counts,
-									   "ens_snATAC_counts": snATAC_cell_counts,
-									   "public_access": ensemble['public_access'],
-									   "description": ensemble['description'],
-									   "annoj_exists": annoj_exists,
-									   "datasets": datasets
-									   })
-
-	# aba_regions = db.get_engine(current_app, 'methylation_data').execute('SELECT * FROM ABA_regions').fetchall()
+	# Target regions of all RS2 datasets, looked up per ensemble below.
+	target_regions_query = "SELECT DISTINCT datasets.dataset, datasets.target_region, ABA_regions.ABA_description \
+		FROM datasets \
+		INNER JOIN ABA_regions ON ABA_regions.ABA_acronym=datasets.target_region \
+		WHERE datasets.dataset LIKE 'CEMBA_RS2_%%'"
+	target_regions = {}
+	for row in db.get_engine(current_app, 'methylation_data').execute(target_regions_query).fetchall():
+		target_regions.setdefault(row['dataset'], []).append((row['target_region'], row['ABA_description']))
+
 	aba_regions = pd.read_sql('SELECT * FROM ABA_regions', db.get_engine(current_app, 'methylation_data'))
-	aba_regions = aba_regions
-	
+	aba_regions_by_code = aba_regions.set_index('code')
+
 	ensembles_json_list = []
-	for ens in ensembles_cell_counts:
+	for ensemble in ensemble_list:
+		datasets = ensemble['datasets'].split(',')
+		methylation_cell_counts = total_methylation_cell_each_dataset.filter(datasets,axis=0)['num'].to_dict()
+		snATAC_cell_counts = total_snATAC_cell_each_dataset.filter(datasets,axis=0)['num'].to_dict()
+
 		total_methylation_cells = 0
 		total_snATAC_cells = 0
 		datasets_in_ensemble_cell_count = []
 		datasets_in_ensemble = []
 		snATAC_datasets_in_ensemble = []
 		ens_dict = {}
-		if ens['ens_methylation_counts'] is not None:
-			for dataset, count in ens['ens_methylation_counts'].items():
-				ens_dict[dataset] = str(count)
-				total_methylation_cells += count
-				datasets_in_ensemble.append(dataset)
-				datasets_in_ensemble_cell_count.append(dataset+" ("+str(count)+" cells)")
-				# ens_dict[dataset] = str(count) + '/' + str(total_methylation_cell_each_dataset[dataset])
-		if ens['ens_snATAC_counts'] is not None:
-			for dataset, count in ens['ens_snATAC_counts'].items():
-				total_snATAC_cells += count
-				datasets_in_ensemble.append('CEMBA_'+dataset)
-				snATAC_datasets_in_ensemble.append(dataset+" ("+str(count)+" cells)")
-
+		for dataset, count in methylation_cell_counts.items():
+			ens_dict[dataset] = str(count)
+			total_methylation_cells += count
+			datasets_in_ensemble.append(dataset)
+			datasets_in_ensemble_cell_count.append(dataset+" ("+str(count)+" cells)")
+		for dataset, count in snATAC_cell_counts.items():
+			total_snATAC_cells += count
+			datasets_in_ensemble.append('CEMBA_'+dataset)
+			snATAC_datasets_in_ensemble.append(dataset+" ("+str(count)+" cells)")
 
 		# Do not display ensembles that contain less than 200 total cells. (mainly RS2 data)
-		if total_methylation_cells>0 or total_snATAC_cells>0:
-
-			ens_dict["ensemble_id"] = ens['id']
-			ens_dict["ensemble_name"] = ens['ensemble']
-			ens_dict["description"] = ens['description']
-			ens_dict["datasets_rs1"] = ",  ".join(sorted([x for x in datasets_in_ensemble_cell_count if 'RS2' not in x]))
-			ens_dict["datasets_rs2"] = ",  ".join(sorted([x for x in datasets_in_ensemble_cell_count if 'RS2' in x]))
-			rs2_datasets_in_ensemble = sorted([x for x in datasets_in_ensemble if 'RS2' in x])
-			ens_dict["target_regions_rs2_acronym"] = ""
-			ens_dict["target_regions_rs2_descriptive"] = ""
-			ens_dict["ABA_regions_acronym"] = ''
-			ens_dict["ABA_regions_description"] = ''
-
-			# TODO: 
-			if len(rs2_datasets_in_ensemble) != 0:
-				target_regions_query = "SELECT DISTINCT datasets.target_region, ABA_regions.ABA_description \
-					FROM datasets \
-					INNER JOIN ABA_regions ON ABA_regions.ABA_acronym=datasets.target_region \
-					AND datasets.dataset in (" + ",".join(("%s",) * len(rs2_datasets_in_ensemble)) + ")"
-				target_regions_result = db.get_engine(current_app, 'methylation_data').execute(target_regions_query, tuple(rs2_datasets_in_ensemble,)).fetchall()
-				ens_dict["target_regions_rs2_acronym"] = ", ".join([ x.target_region for x in target_regions_result ])
-				ens_dict["target_regions_rs2_descriptive"] = ", ".join([ x.ABA_description for x in target_regions_result ])
-
-				# target_regions_result = aba_regions.loc[rs2_datasets_in_ensemble,'ABA_description']
-
-			ens_dict["snATAC_datasets_rs1"] = ",  ".join(sorted([x for x in snATAC_datasets_in_ensemble if 'RS2' not in x]))
-			ens_dict["snATAC_datasets_rs2"] = ",  ".join(sorted([x for x in snATAC_datasets_in_ensemble if 'RS2' in x]))
-			ens_dict["num_datasets"] = len(datasets_in_ensemble_cell_count)+len(snATAC_datasets_in_ensemble)
-
-			slices_list_rs1 = re.findall('CEMBA_([0-9]+[A-Z])',','.join(ens['datasets']))
-			slices_list_rs2 = re.findall('CEMBA_RS2_[A-Z][mf]([0-9]+[A-Z])',','.join(ens['datasets']))
-			slices_set = set(slices_list_rs1)
-			slices_set.update(slices_list_rs2)
-			ens_dict["slices"] = ",  ".join(sorted(list(slices_set)))
-			ens_dict["total_methylation_cells"] = total_methylation_cells
-			ens_dict["total_snATAC_cells"] = total_snATAC_cells
-
-			if slices_set:
-				ens_regions_acronyms = aba_regions.set_index('code').loc[list(slices_set),'ABA_acronym'].values
-				ens_regions_descriptions = aba_regions.set_index('code').loc[list(slices_set),'ABA_description'].values
-				ens_dict["ABA_regions_acronym"] = ", ".join(ens_regions_acronyms).replace('+',', ')
-				ens_dict["ABA_regions_description"] = ", ".join(ens_regions_descriptions).replace('+',', ')
-
-			if ens['public_access'] == 0:
-				ens_dict["public_access_icon"] = "fas fa-lock"
-				ens_dict["public_access_color"] = "black"
-			else:
-				ens_dict["public_access_icon"] = "fas fa-lock-open"
-				ens_dict["public_access_color"] = "green"
+		if total_methylation_cells == 0 and total_snATAC_cells == 0:
+			continue
+
+		ens_dict["ensemble_id"] = ensemble['ensemble_id']
+		ens_dict["ensemble_name"] = ensemble['ensemble_name']
+		ens_dict["description"] = ensemble['description']
+		ens_dict["datasets_rs1"] = ",  ".join(sorted([x for x in datasets_in_ensemble_cell_count if 'RS2' not in x]))
+		ens_dict["datasets_rs2"] = ",  ".join(sorted([x for x in datasets_in_ensemble_cell_count if 'RS2' in x]))
+		rs2_datasets_in_ensemble = sorted([x for x in datasets_in_ensemble if 'RS2' in x])
+		ens_dict["ABA_regions_acronym"] = ''
+		ens_dict["ABA_regions_description"] = ''
+
+		ensemble_target_regions = OrderedDict()
+		for dataset in rs2_datasets_in_ensemble:
+			for target_region in target_regions.get(dataset, []):
+				ensemble_target_regions[target_region] = True
+		ens_dict["target_regions_rs2_acronym"] = ", ".join([ x[0] for x in ensemble_target_regions ])
+		ens_dict["target_regions_rs2_descriptive"] = ", ".join([ x[1] for x in ensemble_target_regions ])
+
+		ens_dict["snATAC_datasets_rs1"] = ",  ".join(sorted([x for x in snATAC_datasets_in_ensemble if 'RS2' not in x]))
+		ens_dict["snATAC_datasets_rs2"] = ",  ".join(sorted([x for x in snATAC_datasets_in_ensemble if 'RS2' in x]))
+		ens_dict["num_datasets"] = len(datasets_in_ensemble_cell_count)+len(snATAC_datasets_in_ensemble)
+
+		slices_list_rs1 = re.findall('CEMBA_([0-9]+[A-Z])',','.join(datasets))
+		slices_list_rs2 = re.findall('CEMBA_RS2_[A-Z][mf]([0-9]+[A-Z])',','.join(datasets))
+		slices_set = set(slices_list_rs1)
+		slices_set.update(slices_list_rs2)
+		ens_dict["slices"] = ",  ".join(sorted(list(slices_set)))
+		ens_dict["total_methylation_cells"] = total_methylation_cells
+		ens_dict["total_snATAC_cells"] = total_snATAC_cells
+
+		if slices_set:
+			ens_regions = aba_regions_by_code.loc[list(slices_set)]
+			ens_dict["ABA_regions_acronym"] = ", ".join(ens_regions['ABA_acronym'].values).replace('+',', ')
+			ens_dict["ABA_regions_description"] = ", ".join(ens_regions['ABA_description'].values).replace('+',', ')
+
+		if ensemble['public_access'] == 0:
+			ens_dict["public_access_icon"] = "fas fa-lock"
+			ens_dict["public_access_color"] = "black"
+		else:
+			ens_dict["public_access_icon"] = "fas fa-lock-open"
+			ens_dict["public_access_color"] = "green"
 
-			ens_dict["annoj_exists"] = ens['annoj_exists']
+		ens_dict["annoj_exists"] = ensemble_annoj_exists(ensemble['ensemble_id'])
 
+		ensembles_json_list.append(ens_dict)
 
-			use_region=True
-			if regions!=['none']:
-				use_region = use_region and (len([region for region in regions if region in ens_dict["ABA_regions_acronym"].lower()])>0)
-			if regions_tgt!=['none']:
-				use_region = use_region and (len([region_tgt for region_tgt in regions_tgt if region_tgt in ens_dict["target_regions_rs2_acronym"].lower()])>0)
-			if use_region:
-				ensembles_json_list.append(ens_dict)
+	return ensembles_json_list
+
+
+@content.route('/content/ensembles')
+def get_ensembles_summary():
+	""" Retrieve data to be displayed in the "Ensembles" summary tabular page.
+		"/tabular/ensemble"
+	"""
+	regions = request.args.get('region', '').split()
+	regions = [ region.lower() for region in regions ]
+	# Remove suffix after "-" -- for compatibility with Dong lab iConnectome
+	regions = [ re.sub(r'-.*','',region) for region in regions ]
+	regions_tgt = request.args.get('region_tgt', '').split()
+	regions_tgt = [ region_tgt.lower() for region_tgt in regions_tgt ]
+
+	ensembles_json_list = []
+	for ens_dict in cached_summary('ensembles_summary', ['ensembles', 'datasets', 'cells', 'ABA_regions'], build_ensembles_summary):
+		use_region=True
+		if regions!=['none']:
+			use_region = use_region and (len([region for region in regions if region in ens_dict["ABA_regions_acronym"].lower()])>0)
+		if regions_tgt!=['none']:
+			use_region = use_region and (len([region_tgt for region_tgt in regions_tgt if region_tgt in ens_dict["target_regions_rs2_acronym"].lower()])>0)
+		if use_region:
+			ensembles_json_list.append(ens_dict)
 
 	ens_json = json.dumps(ensembles_json_list)
 
 	return ens_json
 
 
-@content.route('/content/datasets/<rs>')
-def get_datasets_summary(rs):
-	""" Retrieve data to be displayed in the RS1 and RS2 summmary tabular page.
-		"/tabular/dataset/rs1"
-		"/tabular/dataset/rs2"
+def build_datasets_summary(rs):
+	"""Build the rows of the RS1, RS2 or combined datasets summary tabular page.
 
-		Arguments:
-			rs = Research Segment. Either "rs1" or "rs2"
-	"""
+	Arguments:
+		rs (str): Research Segment. "rs1", "rs2" or "all".
 
+	Returns:
+		list: dict per dataset.
+	"""
+	methylation_datasets = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM datasets").fetchall()
+	snATAC_datasets = db.get_engine(current_app, 'snATAC_data').execute("SELECT * FROM datasets").fetchall()
 	if rs == "rs1":
-		dataset_list = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM datasets WHERE dataset NOT LIKE 'CEMBA_RS2_%%'").fetchall()
-		dataset_list += db.get_engine(current_app, 'snATAC_data').execute("SELECT * FROM datasets WHERE dataset NOT LIKE 'CEMBA_RS2_%%'").fetchall()
-
-		# This is a hack to get unique values in a list of dictionaries
-		dataset_list = list({x['dataset']:x for x in dataset_list}.values());
-		total_methylation_cell_each_dataset = db.get_engine(current_app, 'methylation_data').execute("SELECT dataset, COUNT(*) as `num` FROM cells WHERE dataset NOT LIKE 'CEMBA_RS2_%%' GROUP BY dataset").fetchall()
-		total_snATAC_cell_each_dataset = db.get_engine(current_app, 'snATAC_data').execute("SELECT dataset, COUNT(*) as `num` FROM cells WHERE dataset NOT LIKE 'CEMBA_RS2_%%' GROUP BY dataset").fetchall()
+		dataset_list = [ x for x in methylation_datasets + snATAC_datasets if not x['dataset'].startswith('CEMBA_RS2_') ]
 	elif rs == "rs2":
-		dataset_list = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM datasets WHERE dataset LIKE 'CEMBA_RS2_%%'").fetchall()
-		total_methylation_cell_each_dataset = db.get_engine(current_app, 'methylation_data').execute("SELECT dataset, COUNT(*) as `num` FROM cells WHERE dataset LIKE 'CEMBA_RS2_%%' GROUP BY dataset").fetchall()
-		total_snATAC_cell_each_dataset = db.get_engine(current_app, 'snATAC_data').execute("SELECT dataset, COUNT(*) as `num` FROM cells WHERE dataset LIKE 'CEMBA_RS2_%%' GROUP BY dataset").fetchall()
-	elif rs == "all":
-		dataset_list = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM datasets").fetchall()
-		dataset_list += db.get_engine(current_app, 'snATAC_data').execute("SELECT * FROM datasets").fetchall()
-		# This is a hack to get unique values in a list of dictionaries
-		dataset_list = list({x['dataset']:x for x in dataset_list}.values());
-		total_methylation_cell_each_dataset = db.get_engine(current_app, 'methylation_data').execute("SELECT dataset, COUNT(*) as `num` FROM cells GROUP BY dataset").fetchall()
-		total_snATAC_cell_each_dataset = db.get_engine(current_app, 'snATAC_data').execute("SELECT dataset, COUNT(*) as `num` FROM cells GROUP BY dataset").fetchall()
+		dataset_list = [ x for x in methylation_datasets if x['dataset'].startswith('CEMBA_RS2_') ]
 	else:
-		return
+		dataset_list = methylation_datasets + snATAC_datasets
+	# This is a hack to get unique values in a list of dictionaries
+	dataset_list = list(OrderedDict((x['dataset'], x) for x in dataset_list).values())
+
+	total_methylation_cell_each_dataset = dict(db.get_engine(current_app, 'methylation_data').execute("SELECT dataset, COUNT(*) as `num` FROM cells GROUP BY dataset").fetchall())
+	total_snATAC_cell_each_dataset = dict(db.get_engine(current_app, 'snATAC_data').execute("SELECT dataset, COUNT(*) as `num` FROM cells GROUP BY dataset").fetchall())
+
+	# MySQL compares acronyms case insensitively, so the lookup does too.
+	aba_descriptions = db.get_engine(current_app, 'methylation_data').execute("SELECT ABA_acronym, ABA_description FROM ABA_regions").fetchall()
+	aba_descriptions = { str(acronym).lower(): description for acronym, description in aba_descriptions }
 
-	total_methylation_cell_each_dataset = [ {d['dataset']: d['num']} for d in total_methylation_cell_each_dataset ]
-	total_methylation_cell_each_dataset = { k: v for d in total_methylation_cell_each_dataset for k, v in d.items() }
-	total_snATAC_cell_each_dataset = [ {d['dataset']: d['num']} for d in total_snATAC_cell_each_dataset ]
-	total_snATAC_cell_each_dataset = { k: v for d in total_snATAC_cell_each_dataset for k, v in d.items() }
+	def describe(acronym):
+		description = aba_descriptions.get(str(acronym).lower())
+		if description is None:
+			return ""
+		return description.replace('+', ', ')
 
 	dataset_cell_counts = []
 	for dataset in dataset_list:
-		try:
-			num_snATAC_cells = total_snATAC_cell_each_dataset[dataset['dataset']]
-		except KeyError as e:
-			num_snATAC_cells = 0
-
 		if "RS2" not in dataset['dataset']:
 			brain_region_code = dataset['dataset'].split('_')[1]
 			research_segment = "RS1"
@@ -232,68 +354,38 @@ def get_datasets_summary(rs):
 			brain_region_code = brain_region_code[-2:]
 			research_segment = "RS2"
 
-		regions_sql = db.get_engine(current_app, 'methylation_data').execute("SELECT ABA_description FROM ABA_regions WHERE ABA_acronym='%s'" % dataset['brain_region']).fetchone()
-		if regions_sql is not None:
-			ABA_regions_descriptive = regions_sql['ABA_description'].replace('+', ', ')
-		else:
-			ABA_regions_descriptive = ""
+		dataset_dict = {"dataset_name": dataset['dataset'],
+						"sex": dataset['sex'],
+						"methylation_cell_count": total_methylation_cell_each_dataset.get(dataset['dataset'], 0),
+						"snATAC_cell_count": total_snATAC_cell_each_dataset.get(dataset['dataset'], 0),
+						"ABA_regions_acronym": dataset['brain_region'].replace('+', ', '),
+						"ABA_regions_descriptive": describe(dataset['brain_region']),
+						"slice": brain_region_code,
+						"date_added": str(dataset['date_online']),
+						"description": dataset['description'] }
+		if rs != "rs1":
+			dataset_dict["research_segment"] = research_segment
+			dataset_dict["target_region_acronym"] = dataset['target_region']
+			dataset_dict["target_region_descriptive"] = describe(dataset['target_region'])
+		dataset_cell_counts.append(dataset_dict)
 
-		if rs == "rs1":
-			try:
-				dataset_cell_counts.append( {"dataset_name": dataset['dataset'],
-											 "sex": dataset['sex'],
-											 "methylation_cell_count": total_methylation_cell_each_dataset[dataset['dataset']],
-											 "snATAC_cell_count": num_snATAC_cells,
-											 "ABA_regions_acronym": dataset['brain_region'].replace('+', ', '),
-											 "ABA_regions_descriptive": ABA_regions_descriptive,
-											 "slice": brain_region_code,
-											 "date_added": str(dataset['date_online']),
-											 "description": dataset['description'] })
-			except:
-				dataset_cell_counts.append( {"dataset_name": dataset['dataset'],
-											 "sex": dataset['sex'],
-											 "methylation_cell_count": 0,
-											 "snATAC_cell_count": num_snATAC_cells,
-											 "ABA_regions_acronym": dataset['brain_region'].replace('+', ', '),
-											 "ABA_regions_descriptive": ABA_regions_descriptive,
-											 "slice": brain_region_code,
-											 "date_added": str(dataset['date_online']),
-											 "description": dataset['description'] })
-		else:
-			target_region_sql = db.get_engine(current_app, 'methylation_data').execute("SELECT ABA_description FROM ABA_regions WHERE ABA_acronym='%s'" % dataset['target_region']).fetchone()
-			if target_region_sql is not None:
-				target_region_descriptive = target_region_sql['ABA_description'].replace('+', ', ')
-			else:
-				target_region_descriptive = ""
+	return dataset_cell_counts
 
-			try:
-				dataset_cell_counts.append( {"dataset_name": dataset['dataset'],
-											 "research_segment": research_segment,
-											 "sex": dataset['sex'],
-											 "methylation_cell_count": total_methylation_cell_each_dataset[dataset['dataset']],
-											 "snATAC_cell_count": num_snATAC_cells,
-											 "ABA_regions_acronym": dataset['brain_region'].replace('+', ', '),
-											 "ABA_regions_descriptive": ABA_regions_descriptive,
-											 "slice": brain_region_code,
-											 "date_added": str(dataset['date_online']),
-											 "description": dataset['description'],
-											 "target_region_acronym": dataset['target_region'],
-											 "target_region_descriptive": target_region_descriptive})
-			except:
-				dataset_cell_counts.append( {"dataset_name": dataset['dataset'],
-											 "research_segment": research_segment,
-											 "sex": dataset['sex'],
-											 "methylation_cell_count": 0,
-											 "snATAC_cell_count": num_snATAC_cells,
-											 "ABA_regions_acronym": dataset['brain_region'].replace('+', ', '),
-											 "ABA_regions_descriptive": ABA_regions_descriptive,
-											 "slice": brain_region_code,
-											 "date_added": str(dataset['date_online']),
-											 "description": dataset['description'],
-											 "target_region_acronym": dataset['target_region'],
-											 "target_region_descriptive": target_region_descriptive})
-
-	return json.dumps(dataset_cell_counts)
+
+@content.route('/content/datasets/<rs>')
+def get_datasets_summary(rs):
+	""" Retrieve data to be displayed in the RS1 and RS2 summmary tabular page.
+		"/tabular/dataset/rs1"
+		"/tabular/dataset/rs2"
+
+		Arguments:
+			rs = Research Segment. Either "rs1", "rs2" or "all"
+	"""
+	if rs not in ["rs1", "rs2", "all"]:
+		return
+
+	return json.dumps(cached_summary('datasets_summary_'+rs, ['datasets', 'cells', 'ABA_regions'],
+									 lambda: build_datasets_summary(rs)))
 
 @content.route("/content/check_ensembles/<new_ensemble_name>/<new_ensemble_datasets>")
 def check_ensemble_similarities(new_ensemble_name, new_ensemble_datasets):
@@ -311,11 +403,11 @@ def check_ensemble_similarities(new_ensemble_name, new_ensemble_datasets):
 
 	new_ensemble_datasets = new_ensemble_datasets.split('+')
 
-	query = "SELECT cell_id FROM cells WHERE dataset IN (" + ",".join(('%s',)*len(new_ensemble_datasets)) + ")"
-	cells_in_new_ensemble = db.get_engine(current_app, 'methylation_data').execute(query, tuple(new_ensemble_datasets)).fetchall()
-	cells_in_new_ensemble_set = set([ cell['cell_id'] for cell in cells_in_new_ensemble ])
+	engine = db.get_engine(current_app, 'methylation_data')
+	new_ensemble_digest = cell_digest(engine, 'cells', "dataset IN (" + ",".join(('%s',)*len(new_ensemble_datasets)) + ")", new_ensemble_datasets)
+	num_cells_in_new_ensemble = int(new_ensemble_digest.split('-')[0])
 
-	if len(cells_in_new_ensemble_set) <= 200:
+	if num_cells_in_new_ensemble <= 200:
 		return json.dumps({"result": "failure", "reason": "Ensembles must contain more than 200 cells."})
 
 	same_datasets_in_both = []
@@ -327,13 +419,13 @@ def check_ensemble_similarities(new_ensemble_name, new_ensemble_datasets):
 			same_datasets_in_both.append(existing_ensemble)
 
 	for similar_ensemble in same_datasets_in_both:
-		query = "SELECT cell_id FROM Ens{}".format(similar_ensemble['ensemble_id'])
-		cells_in_similar_ensemble = db.get_engine(current_app, 'methylation_data').execute(query).fetchall()
-		cells_in_similar_ensemble_set = set([ cell['cell_id'] for cell in cells_in_similar_ensemble ])
-		different_cells = cells_in_new_ensemble_set ^ cells_in_similar_ensemble_set
+		# Digests are stored by "manage.py build_cell_digests"; ensembles added since are fingerprinted here.
+		similar_ensemble_digest = similar_ensemble.get('cell_digest')
+		if not similar_ensemble_digest:
+			similar_ensemble_digest = cell_digest(engine, 'Ens{}'.format(similar_ensemble['ensemble_id']))
 
 		# If a pre-existing ensemble with the same datasets also has the same exact cells as the new ensemble, tell user a duplicate ensemble exists
-		if len(different_cells) == 0:
+		if similar_ensemble_digest == new_ensemble_digest:
 			return json.dumps({"result": "failure", "reason": "Another ensemble with the same cells already exists: {}.".format(similar_ensemble['ensemble_name'])})
 
 	# If none of the pre-existing ensembles with the same datasets has the same exact cells as the new ensemble, warn user that similar ensembles exist.
@@ -345,12 +437,11 @@ def check_ensemble_similarities(new_ensemble_name, new_ensemble_datasets):
 					   "reason": "Click submit to finalize request.",
 					   "new_ensemble_name": new_ensemble_name,
 					   "new_ensemble_datasets": new_ensemble_datasets,
-					   "new_ensemble_cells": list(cells_in_new_ensemble_set)})
+					   "num_cells": num_cells_in_new_ensemble})
 
 # Utilities
-@cache.memoize(timeout=1800)
 def ensemble_exists(ensemble, modality='methylation'):
-	"""Check if data for a given ensemble exists
+	"""Check if data for a given ensemble exists, in the catalog of the modality's database.
 
 	Arguments:
 		ensemble (str): Name of ensemble.
@@ -360,16 +451,24 @@ def ensemble_exists(ensemble, modality='methylation'):
 		bool: Whether if given ensemble exists
 	"""
 
-	if modality=='methylation':
-		ensemble_name = 'ensemble_id'
+	if table_catalog(modality).has_ensemble(ensemble):
+		return 1
 	else:
-		ensemble_name = 'snmc_ensemble_id'
-	result = db.get_engine(current_app, modality+'_data').execute("SELECT * FROM ensembles WHERE "+ensemble_name+"='%s'" % str(ensemble)).fetchone()
-
-	if result is None:
 		return 0
-	else:
-		return 1
+
+def ensemble_modalities(ensemble_id):
+	"""Which modality databases include an ensemble. Read from the ensemble catalog when it has been built.
+
+	Arguments:
+		ensemble_id (int): Ensemble id. ie. 218
+
+	Returns:
+		dict: 'methylation', 'snATAC' and 'RNA' to 0 or 1.
+	"""
+	catalog = ensemble_catalog('Ens{}'.format(ensemble_id))
+	if catalog is not None:
+		return catalog['modalities']
+	return OrderedDict((modality, ensemble_exists(ensemble_id, modality=modality)) for modality in ['methylation', 'snATAC', 'RNA'])
 
 # Utilities
 @cache.memoize(timeout=1800)
@@ -392,9 +491,8 @@ def ensemble_annoj_exists(ensemble):
 
 	return result
 
-@cache.memoize(timeout=1800)
 def gene_exists(ensemble, methylation_type, gene):
-	"""Check if data for a given gene of ensemble exists by looking for its data directory.
+	"""Check if data for a given gene of ensemble exists by looking for its table in the catalog.
 
 	Arguments:
 		ensemble (str): Name of ensemble.
@@ -405,8 +503,7 @@ def gene_exists(ensemble, methylation_type, gene):
 		bool: Whether if given gene exists
 	"""
 
-	gene_table_name = 'gene_' + gene.replace(".", "_")
-	return len(db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM information_schema.tables WHERE table_name = '%s'"%gene_table_name).fetchall()) > 0
+	return table_catalog('methylation').has_gene(gene)
 
 
 def build_hover_text(labels):
@@ -431,6 +528,60 @@ def build_hover_text(labels):
 	return text.strip('<br>')
 
 
+def hover_data(points, fields):
+	"""Per-point hover values as category codes and lookup tables, for the /api/ scatter plots.
+
+	Each distinct annotation, cluster or dataset string is sent once instead of once per point.
+	expandHoverData in customview.js turns the columns back into the trace's customdata.
+
+	Arguments:
+		points (DataFrame): The trace's points, in trace order.
+		fields ([tuple]): (label, column) for category columns, (label, column, decimals) for values.
+
+	Returns:
+		list: {'codes': array, 'categories': [str]} or {'values': array} per field.
+	"""
+	columns = []
+	for field in fields:
+		if len(field) > 2:
+			columns.append({'values': points[field[1]].round(field[2]).values.astype(float)})
+			continue
+		codes, categories = pd.factorize(points[field[1]])
+		categories = [str(category) for category in categories]
+		if (codes < 0).any():
+			codes[codes < 0] = len(categories)
+			categories.append('')
+		columns.append({'codes': codes, 'categories': categories})
+	return columns
+
+
+def set_hover(trace, points, fields, output='html'):
+	"""Set the hover labels of a scatter trace, one line per field.
+
+	The HTML plots get one build_hover_text string per point. For output='json' the trace gets a
+	hovertemplate over customdata instead, and the values are returned to be sent with the figure
+	(see render_figure).
+
+	Arguments:
+		trace: Scatter or Scatter3d.
+		points (DataFrame): The trace's points, in trace order.
+		fields ([tuple]): As for hover_data.
+		output (str): 'html' or 'json'.
+
+	Returns:
+		list from hover_data for output='json', otherwise None.
+	"""
+	if output == 'json':
+		trace['hovertemplate'] = '<br>'.join('{}: %{{customdata[{}]}}'.format(field[0], i)
+			for i, field in enumerate(fields)) + '<extra></extra>'
+		return hover_data(points, fields)
+
+	columns = [points[field[1]].round(field[2]) if len(field) > 2 else points[field[1]] for field in fields]
+	labels = [field[0] for field in fields]
+	trace['text'] = [build_hover_text(OrderedDict(zip(labels, values))) for values in zip(*columns)]
+	return None
+
+
 def generate_cluster_colors(num, grouping):
 	"""Generate a list of colors given number needed.
 
@@ -456,27 +607,208 @@ def generate_cluster_colors(num, grouping):
 	return c
 
 
-def set_color_by_percentile(this, start, end):
-	"""Set color below or above percentiles to their given values.
+def percentile_colors(values, ptile_start, ptile_end):
+	"""Clamp values to their percentiles for a continuous color scale.
+
+	Percentiles are taken over the values that are not NaN. Missing values stay NaN; scatter plots
+	draw them grey in a trace of their own (see split_missing_points).
+
+	Arguments:
+		values (Series or array): Values to color points by.
+		ptile_start (float): Lower end of percentile. [0, 1].
+		ptile_end (float): Upper end of percentile. [0, 1].
+
+	Returns:
+		tuple: (numpy array of clamped values, lower end, upper end).
+	"""
+	values = np.asarray(values, dtype=float)
+	present = values[~np.isnan(values)]
+	if len(present) == 0:
+		start, end = 0.0, 0.0
+	else:
+		start, end = np.percentile(present, [ptile_start * 100, ptile_end * 100]).tolist()
+	end = max(end, start+0.01)
+	return np.clip(values, start, end), start, end
+
+
+def colorbar_ticks(start, end):
+	"""Colorbar tick values and labels for a color scale clamped to [start, end].
+
+	Returns:
+		tuple: (tickvals, ticktext). The end labels read '<start' and '>end'.
+	"""
+	tickvals = list(arange(start, end, (end - start) / 4))
+	ticktext = [str(round(x, num_sigfigs_ticklabels)) for x in tickvals]
+	tickvals[0] = start
+	tickvals.append(end)
+	ticktext[0] = '<' + str(round(start, num_sigfigs_ticklabels))
+	ticktext.append('>' + str(round(end, num_sigfigs_ticklabels)))
+	return tickvals, ticktext
+
+
+def split_missing_points(trace, missing):
+	"""Move the points of a colored scatter trace that have no value into a grey trace.
+
+	Plot.ly would draw NaN colors in its dark default line color.
+
+	Arguments:
+		trace: Scatter or Scatter3d colored by a numeric array. Modified in place.
+		missing (numpy bool array): Points with no value.
+
+	Returns:
+		Trace of the same type and axes with the missing points.
+	"""
+	trace_missing = type(trace)(trace)
+	for axis in ['x', 'y', 'z']:
+		if axis in trace:
+			values = np.asarray(trace[axis])
+			trace[axis] = values[~missing]
+			trace_missing[axis] = values[missing]
+	trace['marker']['color'] = np.asarray(trace['marker']['color'])[~missing]
+	trace_missing['marker'] = {'color': 'grey',
+							   'size': trace['marker']['size'],
+							   'opacity': trace['marker']['opacity']}
+	return trace_missing
+
+
+def point_sample(max_points):
+	"""max_points for plots without a density raster mode, where 'raster' means the default sample."""
+	if max_points == 'raster':
+		return '10000'
+	return max_points
 
-	Since the Plot.ly library handles coloring, we work directly with mCH values in this function. The two percentiles
-	are generated by the pd library from the plot-generating method.
+
+def raster_scatter(points, x_column, y_column, bounds, group_column, unique_groups, group_names, colors,
+	value_column, value_title, ptile_start, ptile_end, title, grouping, output='html'):
+	"""Plot every cell of a 2D tSNE scatter as heatmaps of pixels instead of points (see raster.py).
+
+	The left panel is colored by the most frequent group of each pixel (by the number of cells for
+	continuous groupings), the right panel by the mean gene value of each pixel.
 
 	Arguments:
-		this (float): mCH value to be compared.
-		start (float): Lower end of percentile.
-		end (float): Upper end of percentile.
+		points (DataFrame): All cells.
+		x_column, y_column (str): Columns of the tSNE coordinates.
+		bounds (tuple): ((bottom_x, top_x), (bottom_y, top_y)) plot range.
+		group_column (str): Column of the cell groups.
+		unique_groups (list): Groups in color order, or ['All cells'] for continuous groupings.
+		group_names ([str]): Legend name of each group.
+		colors ([str]): Color of each group.
+		value_column (str): Column of the gene values.
+		value_title (str): Colorbar title.
+		ptile_start (float): Lower end of color percentile. [0, 1].
+		ptile_end (float): Upper end of color percentile. [0, 1].
+		title (str): Title of the gene value panel.
+		grouping (str): Grouping name for the left panel title.
+		output (str): 'html' or 'json'.
 
 	Returns:
-		int: Value of `this`, if it is within percentile limits. Otherwise return one of two percentiles.
+		str: HTML generated by Plot.ly, or dict for output='json'.
 	"""
-	if str(this) == 'nan':
-		return 'grey'
-	if this < start:
-		return start
-	elif this > end:
-		return end
-	return this
+	size = current_app.config.get('RASTER_SIZE', RASTER_SIZE)
+	values = points[value_column].values.astype(float)
+	categorical = unique_groups != ['All cells']
+	groups = None
+	if categorical:
+		# Categories cannot be null; cells without a group get code -1 and are left out of the majority.
+		kept = [i for i, group in enumerate(unique_groups) if pd.notnull(group)]
+		unique_groups = [unique_groups[i] for i in kept]
+		group_names = [group_names[i] for i in kept]
+		colors = [colors[i] for i in kept]
+		groups = pd.Categorical(points[group_column], categories=unique_groups).codes
+	raster = rasterize(points[x_column].values, points[y_column].values, bounds, (size, size),
+					   values=values, groups=groups, n_groups=len(unique_groups))
+
+	# Pixels without cells are NaN, which Plot.ly leaves transparent.
+	empty = raster.counts == 0
+	grid = {'x0': raster.x0, 'dx': raster.dx, 'y0': raster.y0, 'dy': raster.dy}
+	if categorical:
+		n = len(unique_groups)
+		colorscale = []
+		for i in range(n):
+			colorscale += [[float(i) / n, colors[i]], [float(i + 1) / n, colors[i]]]
+		trace_groups = Heatmap(
+			z=np.where(empty, nan, raster.majority.astype(float)),
+			zmin=-0.5,
+			zmax=n - 0.5,
+			colorscale=colorscale,
+			showscale=False,
+			text=raster.counts,
+			hovertemplate='Cells: %{text}<extra></extra>',
+			**grid)
+	else:
+		trace_groups = Heatmap(
+			z=np.where(empty, nan, raster.counts.astype(float)),
+			colorscale='Greys',
+			showscale=False,
+			hovertemplate='Cells: %{z}<extra></extra>',
+			**grid)
+
+	_, start, end = percentile_colors(values, ptile_start, ptile_end)
+	colorbar_tickval, colorbar_ticktext = colorbar_ticks(start, end)
+	trace_values = Heatmap(
+		z=np.clip(raster.means, start, end),
+		zmin=start,
+		zmax=end,
+		colorscale='Viridis',
+		colorbar={
+			'x': 1.05,
+			'len': 0.5,
+			'thickness': 10,
+			'title': value_title,
+			'titleside': 'right',
+			'tickmode': 'array',
+			'tickvals': colorbar_tickval,
+			'ticktext': colorbar_ticktext,
+			'tickfont': {'size': 10}
+		},
+		text=raster.counts,
+		hovertemplate=value_title + ': %{z:.3f}<br>Cells: %{text}<extra></extra>',
+		**grid)
+
+	fig = tools.make_subplots(
+			rows=1,
+			cols=2,
+			shared_xaxes=False,
+			shared_yaxes=True,
+			print_grid=False,
+			subplot_titles=("tSNE colored by "+grouping, title),
+			)
+	fig.append_trace(trace_groups, 1, 1)
+	if categorical:
+		# Heatmaps have no legend entries; empty scatter traces stand in for the groups.
+		for color, name in zip(colors, group_names):
+			fig.append_trace(Scatter(x=[None], y=[None], mode='markers', name=name,
+									 marker={'color': color, 'size': 8}), 1, 1)
+	fig.append_trace(trace_values, 1, 2)
+
+	axis = {
+		'type': 'linear',
+		'ticks': '',
+		'showticklabels': False,
+		'showline': True,
+		'showgrid': False,
+		'zeroline': False,
+		'linecolor': 'black',
+		'linewidth': 0.5,
+		'mirror': False,
+	}
+	fig['layout'].update(Layout(
+		autosize=True,
+		height=550,
+		width=1000,
+		legend={'x': -.14,
+				'y': 0.95,
+				'tracegroupgap': 0.5,
+				'bgcolor': 'rgba(0,0,0,0)',},
+		margin={'l': 0,
+				'r': 0,
+				'b': 30,
+				't': 50,},
+		xaxis=dict(axis, domain=[0, 0.49], scaleanchor='x2', range=list(bounds[0])),
+		xaxis2=dict(axis, domain=[0.51, 1], scaleanchor='y', range=list(bounds[0])),
+		yaxis=dict(axis, domain=[0, 1], side='right', range=list(bounds[1])),
+		hovermode='closest',))
+	return render_figure(fig, output, float32=True)
 
 @cache.cached(timeout=3600)
 def all_gene_modules():
@@ -550,75 +882,160 @@ def get_cluster_marker_genes(ensemble, clustering):
 
 	return to_json
 
-@cache.memoize(timeout=3600)
-def median_cluster_mch(gene_info, grouping, clustering):
-	"""Returns median mch level of a gene for each cluster.
+def cell_groups(gene_info, grouping, suffix, modality='methylation'):
+	"""Returns the group of each cell, without modifying gene_info.
 
 		Arguments:
-			gene_info (dict): mCH data for each sample. Keys are samp(cell), tsne_x, tsne_y, cluster_label, cluster_ordered, original, normalized.
-			level (str): "original" or "normalized" methylation values.
+			gene_info (DataFrame): Cells returned by get_gene_methylation, get_gene_snATAC or get_gene_RNA.
+			grouping (str): Variable to group cells by. "cluster", "annotation", "dataset", "target_region", "slice" or "sex".
+			suffix (str): Suffix of the cluster and annotation columns. Clustering for methylation, 'ATAC' or 'RNA'.
+			modality (str): 'methylation', 'snATAC' or 'RNA'.
 
 		Returns:
-			dict: Cluster_label (key) : median mCH level (value).
-	"""
-
-	if gene_info is not None:
-		if grouping == 'annotation':
-			gene_info.fillna({'annotation_'+clustering: 'None'}, inplace=True)
-			return gene_info.groupby('annotation_'+clustering, sort=False)[gene_info.columns[-1]].median()
-		elif grouping == 'cluster':
-			gene_info.fillna({'cluster_'+clustering: 'None'}, inplace=True)
-			return gene_info.groupby('cluster_'+clustering, sort=False)[gene_info.columns[-1]].median()
-		elif grouping == 'dataset':
-			gene_info.fillna({'dataset': 'None'}, inplace=True)
-			return gene_info.groupby('dataset', sort=False)[gene_info.columns[-1]].median()
-		elif grouping == 'target_region':
-			gene_info['target_region'].fillna('N/A', inplace=True)
-			return gene_info.groupby('target_region', sort=False)[gene_info.columns[-1]].median()
-		elif grouping == 'slice':
-			datasets_all_cells = gene_info['dataset'].tolist()
-			slices_list = [d.split('_')[1] if 'RS2' not in d else d.split('_')[2][2:4] for d in datasets_all_cells]
-			gene_info['slice'] = slices_list
-			return gene_info.groupby('slice', sort=False)[gene_info.columns[-2]].median()
-		elif grouping == 'sex':
-			return gene_info.groupby('sex', sort=False)[gene_info.columns[-1]].median()
-		else:
-			return None
+			Series aligned with gene_info, named after the grouping column. None for unsupported groupings.
+	"""
+
+	methylation = modality == 'methylation'
+	if grouping in ['annotation', 'cluster']:
+		groups = gene_info[grouping+'_'+suffix]
+		if grouping == 'annotation' or methylation:
+			groups = groups.fillna('None')
+		return groups
+	elif grouping == 'dataset':
+		return gene_info['dataset'].fillna('None') if methylation else gene_info['dataset']
+	elif grouping == 'target_region':
+		return gene_info['target_region'].fillna('N/A')
+	elif grouping == 'slice' and methylation:
+		return gene_info['dataset'].map(lambda d: d.split('_')[1] if 'RS2' not in d else d.split('_')[2][2:4]).rename('slice')
+	elif grouping == 'sex' and methylation:
+		return gene_info['sex']
 	else:
 		return None
 
 @cache.memoize(timeout=3600)
-def mean_cluster(gene_info, grouping, modality='ATAC'):
-	"""Returns median mch level of a gene for each cluster.
+def get_cluster_summary(ensemble, gene, grouping, modality='methylation', methylation_type='mCH', clustering='mCH_lv_npc50_k5',
+	level='original', max_points='all'):
+	"""Returns summary statistics of a gene's values in each group of cells.
+
+		Memoized by identifiers, so the cells are fetched and grouped once per gene for all heatmaps.
 
 		Arguments:
-			gene_info (dict): mCH data for each sample. Keys are samp(cell), tsne_x, tsne_y, cluster_label, cluster_ordered, original, normalized.
-			level (str): "original" or "normalized" methylation values.
-			modality (str): 'ATAC','RNA'
+			ensemble (str): Name of ensemble.
+			gene (str): Ensembl ID of gene.
+			grouping (str): Variable to group cells by. "cluster", "annotation", "dataset", etc.
+			modality (str): 'methylation', 'snATAC' or 'RNA'.
+			methylation_type (str): "mCH", "mCG", or "mCA". Methylation only.
+			clustering (str): Clustering algorithm and parameters. Methylation only.
+			level (str): "original" or "normalized" methylation values. Methylation only.
+			max_points (str): Cells summarized, as in the scatter plots. All cells by default, like the precomputed summaries.
+
 		Returns:
-			dict: Cluster_label (key) : mean mCH level (value).
+			DataFrame: One row per group, with columns median, mean, q25, q75 and n_cells. None if there is no data.
 	"""
 
-	# if grouping == 'annotation':
-	# 	gene_info.fillna({'annotation_'+modality: 'None'}, inplace=True)
-	# if grouping != 'dataset':
-	# 	return gene_info.groupby(grouping+'_'+modality, sort=False)['normalized_counts'].mean()
-	# else:
-	# 	return gene_info.groupby(grouping, sort=False)['normalized_counts'].mean()
-
-	if grouping == 'annotation':
-		gene_info.fillna({'annotation_'+modality: 'None'}, inplace=True)
-		return gene_info.groupby('annotation_'+modality, sort=False)['normalized_counts'].mean()
-	elif grouping == 'cluster':
-		return gene_info.groupby('cluster_'+modality, sort=False)['normalized_counts'].mean()
-	elif grouping == 'dataset':
-		return gene_info.groupby('dataset', sort=False)['normalized_counts'].mean()
-	elif grouping == 'target_region':
-		gene_info['target_region'].fillna('N/A', inplace=True)
-		return gene_info.groupby('target_region', sort=False)['normalized_counts'].mean()
+	if modality == 'methylation':
+		gene_info = get_gene_methylation(ensemble, methylation_type, gene, grouping, clustering, level, True,
+			max_points=max_points)
+		value_column = methylation_type + '/' + methylation_type[1:] + '_' + level
+		suffix = clustering
+	elif modality == 'snATAC':
+		gene_info = get_gene_snATAC(ensemble, gene, grouping, True, max_points=max_points)
+		value_column = 'normalized_counts'
+		suffix = 'ATAC'
 	else:
+		gene_info = get_gene_RNA(ensemble, gene, grouping, True, max_points=max_points)
+		value_column = 'normalized_counts'
+		suffix = 'RNA'
+
+	if gene_info is None:
+		return None
+	groups = cell_groups(gene_info, grouping, suffix, modality)
+	if groups is None:
 		return None
 
+	grouped = gene_info[value_column].astype(float).groupby(groups, sort=False)
+	return pd.DataFrame(OrderedDict([('median', grouped.median()),
+									 ('mean', grouped.mean()),
+									 ('q25', grouped.quantile(0.25)),
+									 ('q75', grouped.quantile(0.75)),
+									 ('n_cells', grouped.count())]))
+
+def has_cluster_summary(ensemble, modality='methylation'):
+	"""Whether precompute.build_cluster_summary has been run for an ensemble."""
+	return table_catalog(modality).has_table(ensemble+'_cluster_summary')
+
+def group_label(label):
+	"""A group label stored as text by precompute.build_cluster_summary, as the int or float it was written from if numeric."""
+	for number_type in (int, float):
+		try:
+			return number_type(label)
+		except (ValueError, TypeError):
+			pass
+	return label
+
+def precomputed_cluster_summaries(ensemble, genes, measure, group_column, modality='methylation'):
+	"""Read the precomputed summaries of several genes with one indexed query.
+
+		Returns:
+			dict: Versionless gene ID (key) : DataFrame indexed by group_column, like get_cluster_summary (value).
+	"""
+
+	if not genes or ";" in ensemble or not has_cluster_summary(ensemble, modality):
+		return {}
+
+	query = "SELECT gene_id, group_label, median, mean, q25, q75, n_cells FROM %(ensemble)s_cluster_summary \
+		WHERE measure = %%s AND group_column = %%s AND gene_id IN (%(genes)s)" % {'ensemble': ensemble,
+			'genes': ', '.join(['%s'] * len(genes))}
+	try:
+		df = pd.read_sql(query, db.get_engine(current_app, modality+'_data'),
+			params=[measure, group_column] + [gene.split('.')[0] for gene in genes])
+	except exc.ProgrammingError as e:
+		now = datetime.datetime.now()
+		print("[{}] ERROR in app(precomputed_cluster_summaries): {}".format(str(now), e))
+		sys.stdout.flush()
+		return {}
+
+	# Group labels are stored as text; restore numeric cluster ids and keep the others, such as 'None'.
+	df['group_label'] = [group_label(label) for label in df['group_label']]
+
+	summaries = {}
+	for gene_id, summary in df.groupby('gene_id', sort=False):
+		summaries[gene_id] = summary.drop('gene_id', axis=1).set_index('group_label').rename_axis(group_column)
+	return summaries
+
+@cache.memoize(timeout=3600)
+def get_cluster_summaries(ensemble, genes, grouping, modality='methylation', methylation_type='mCH', clustering='mCH_lv_npc50_k5',
+	level='original'):
+	"""Returns the cluster summaries of several genes for a heatmap.
+
+		Genes found in the ensemble's precomputed {ensemble}_cluster_summary table are read in one query,
+		the others are computed from their cells by get_cluster_summary.
+
+		Arguments:
+			genes ([str]): Ensembl IDs of genes.
+			Others as in get_cluster_summary.
+
+		Returns:
+			dict: Gene ID as given (key) : DataFrame from get_cluster_summary or None (value).
+	"""
+
+	if modality == 'methylation':
+		measure = methylation_type + '/' + methylation_type[1:] + '_' + level
+		suffix = clustering
+	else:
+		measure = 'normalized_counts'
+		suffix = modality.replace('snATAC', 'ATAC')
+	group_column = grouping+'_'+suffix if grouping in ['annotation', 'cluster'] else grouping
+
+	precomputed = precomputed_cluster_summaries(ensemble, genes, measure, group_column, modality)
+	summaries = {}
+	for gene in genes:
+		summary = precomputed.get(gene.split('.')[0])
+		if summary is None:
+			summary = get_cluster_summary(ensemble, gene, grouping, modality, methylation_type, clustering, level)
+		summaries[gene] = summary
+	return summaries
+
 @cache.memoize(timeout=3600)
 def get_ensemble_info(ensemble_id='Ens218'):
 	"""
@@ -651,6 +1068,16 @@ def get_ensemble_info(ensemble_id='Ens218'):
 def get_metadata_options(ensemble):
 	"""
 	Get all available options for tsne plot for selected ensemble.
+	Read from the ensemble catalog when it has been built (see catalog.py).
+	"""
+	catalog = ensemble_catalog(ensemble)
+	if catalog is not None:
+		return catalog['metadata_options']
+	return query_metadata_options(ensemble)
+
+def query_metadata_options(ensemble):
+	"""
+	Introspect the ensemble table and the modality databases for get_metadata_options.
 	"""
 
 	if ";" in ensemble: # Prevent SQL injection since table names aren't parameterizable
@@ -729,6 +1156,16 @@ def get_metadata_options(ensemble):
 def get_snATAC_tsne_options(ensemble):
 	"""
 	Get all available options for tsne plot for selected ensemble.
+	Read from the ensemble catalog when it has been built (see catalog.py).
+	"""
+	catalog = ensemble_catalog(ensemble)
+	if catalog is not None:
+		return catalog['snATAC_tsne_options']
+	return query_snATAC_tsne_options(ensemble)
+
+def query_snATAC_tsne_options(ensemble):
+	"""
+	Introspect the snATAC ensemble table for get_snATAC_tsne_options.
 	"""
 
 	if ";" in ensemble: # Prevent SQL injection since table names aren't parameterizable
@@ -779,28 +1216,27 @@ def get_snATAC_tsne_options(ensemble):
 			'clustering_npc': list_npc_clustering,
 			'clustering_k': list_k_clustering,}
 
-@cache.memoize(timeout=3600)
-def get_gene_by_name(gene_query):
+def get_gene_by_name(gene_query, limit=50, modalities=None):
 	"""Retrieve gene information by name. Mainly used to fill gene search bar.
-	Does not search for exact matches.
+	Does not search for exact matches only; exact matches are listed first, then prefix and substring matches.
 
 	Arguments:
 		gene_query (list): List of gene name strings
+		limit (int): Maximum number of genes returned.
+		modalities (list): Databases to look for gene tables in, ie. those of the current ensemble.
+			Defaults to all of 'methylation', 'snATAC' and 'RNA'.
 
 	Returns:
-		DataFrame: Info for queried gene(s). Columns are gene_id, gene_name, chr, start, end, strand, gene_type.
+		list: Info for queried gene(s). Keys are gene_id, gene_name, chr, start, end, strand, gene_type,
+			and has_data, whether the gene has a gene table in any of the modalities.
 	"""
 
-	gene_query = [ gene.lower()+"%" for gene in gene_query ]
-
-	sql_query = "SELECT * FROM genes WHERE " + "lower(gene_name) LIKE %s OR " * len(gene_query)
-	sql_query = sql_query[:-3]
-
-	df = pd.read_sql(sql_query, params=(gene_query,), con=db.get_engine(current_app, 'methylation_data'))
+	genes = gene_index().search_names(gene_query, limit)
+	catalogs = [table_catalog(modality) for modality in (modalities or ['methylation', 'snATAC', 'RNA'])]
+	for gene in genes:
+		gene['has_data'] = any(catalog.has_gene(gene['gene_id']) for catalog in catalogs)
+	return genes
 
-	return df.to_dict('records')
-
-@cache.memoize(timeout=3600)
 def get_gene_by_name_exact(gene_query):
 	"""Same as get_gene_by_name but for exact matches only.
 
@@ -808,76 +1244,267 @@ def get_gene_by_name_exact(gene_query):
 		gene_query (list): List of gene name strings
 
 	Returns:
-		DataFrame: Info for queried gene(s). Columns are gene_id, gene_name, chr, start, end, strand, gene_type.
+		list: Info for queried gene(s), in query order. Keys are gene_id, gene_name, chr, start, end, strand, gene_type.
 	"""
 
-	gene_query = [ gene.lower() for gene in gene_query ]
-	placeholders_str = "%s, " * len(gene_query)
-	placeholders_str = placeholders_str[:-2]
-	sql_query = "SELECT * FROM genes WHERE " + "lower(gene_name) IN (" + placeholders_str+ ")"
-	sql_query += " ORDER BY CASE lower(gene_name) "
+	return gene_index().exact_names(gene_query)
 
-	for i, gene in enumerate(gene_query):
-		sql_query += "WHEN '{}' THEN {} ".format(gene, i+1)
-	sql_query += "END"
-
-	df = pd.read_sql(sql_query, params=(gene_query,), con=db.get_engine(current_app, 'methylation_data'))
-
-	return df.to_dict('records')
-
-@cache.memoize(timeout=3600)
 def get_gene_by_id(gene_query):
-	"""Retrieve gene information by gene id.
+	"""Retrieve gene information by gene id, with or without the Ensembl version number.
 
 	Arguments:
 		gene_query (list): list of gene_id strings.
 
 	Returns:
-		DataFrame: Info for queried gene. Columns are gene_id, gene_name, chr, start, end, strand, gene_type.
+		list: Info for queried genes, in query order. Keys are gene_id, gene_name, chr, start, end, strand, gene_type.
 	"""
 
-	gene_query_wildcard = [ gene+'%' for gene in gene_query ]
-	sql_query = "SELECT * FROM genes WHERE " + "gene_id LIKE %s OR " * len(gene_query_wildcard)
-	sql_query = sql_query[:-3]
-
-	df = pd.read_sql(sql_query, params=(gene_query_wildcard,), con=db.get_engine(current_app, 'methylation_data'))
+	if isinstance(gene_query, str):
+		gene_query = [gene_query]
 
-	#reorder genes to original order since SQL doesn't keep order.
-	new_index = []
-	for index, row in df.iterrows():
-		for i, gene_id in enumerate(gene_query):
-			if gene_id in row['gene_id']:
-				new_index.append(i)
-				break
-	df.index = new_index
-	df.sort_index(inplace=True)
-
-	return df.to_dict('records')
+	return [dict(record) for record in gene_index().records_for(gene_query)]
 
 @cache.memoize(timeout=3600)
-def get_corr_genes(ensemble, query):
+def get_corr_genes(ensemble, query, limit=50, min_correlation=None, method='pearson'):
 	"""Get correlated genes of a certain gene of a ensemble.
 
+	Read from the matrix store when the ensemble's correlated genes were exported with it,
+	otherwise from the {ensemble}_correlated_genes table. Ensembles without that table are
+	correlated on demand over their cluster summaries (see correlation.py). Gene names come
+	from the gene index.
+
 		Arguments:
 			ensemble(str): Ensemble identifier. (Eg. Ens0, Ens1, Ens2...).
 			query(str): Gene ID.
+			limit(int): Maximum number of correlated genes.
+			min_correlation(float): Only return genes correlated at least this much.
+			method(str): 'pearson' or 'spearman', for correlations computed on demand.
 
 		Returns:
 			dict: information of genes that are correlated with target gene.
 	"""
-	if ";" in query:
+	if ";" in query or ";" in ensemble:
 		return []
 
-	try:
-		corr_genes = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM {}_correlated_genes WHERE gene1 LIKE %s".format(ensemble), (query+'%%',)).fetchall()
-	except exc.ProgrammingError as e:
-		now = datetime.datetime.now()
-		print("[{}] ERROR in app(get_corr_genes): {}".format(str(now), e))
-		sys.stdout.flush()
-		return []
+	store = open_store(ensemble)
+	if store is not None and store.has_correlated_genes:
+		corr_genes = store.correlated_genes(query, limit, min_correlation)
+	elif not table_catalog('methylation').has_table(ensemble+'_correlated_genes'):
+		matrix = correlation_matrix(ensemble)
+		if matrix is None:
+			return []
+		corr_genes = matrix.correlated(query, limit, min_correlation, method)
+	else:
+		corr_query = "SELECT gene2, correlation FROM {}_correlated_genes WHERE gene1 LIKE %s".format(ensemble)
+		params = [query+'%%']
+		if min_correlation is not None:
+			corr_query += " AND correlation >= %s"
+			params.append(min_correlation)
+		corr_query += " ORDER BY correlation DESC LIMIT %s"
+		params.append(int(limit))
+		try:
+			corr_genes = db.get_engine(current_app, 'methylation_data').execute(corr_query, tuple(params)).fetchall()
+		except exc.ProgrammingError as e:
+			now = datetime.datetime.now()
+			print("[{}] ERROR in app(get_corr_genes): {}".format(str(now), e))
+			sys.stdout.flush()
+			return []
+
+	genes = gene_index()
+	corr_genes = [ {"rank": i+1, "gene_name": (genes.get(gene_id) or {}).get('gene_name'), "correlation": correlation, "gene_id": gene_id}
+				   for i, (gene_id, correlation) in enumerate(corr_genes)]
+	return corr_genes
+
+def _store_grouping(store, grouping, clustering, rows=None):
+	"""Cell values of the grouping variable, as selected by `groupingu` in the MySQL queries."""
+	if grouping in ['annotation','cluster']:
+		return store.cell_column(grouping+'_'+clustering, rows)
+	elif grouping in ['NeuN']:
+		return ['NeuN'+str(x) for x in store.cell_column(grouping, rows)]
+	else:
+		return store.cell_column(grouping, rows)
+
+def gene_methylation_from_store(store, gene, methylation_type, clustering, tsne_type, grouping='cluster', max_points='10000'):
+	"""Read a gene's methylation information from the matrix store, or from the ensemble's
+	cached cell metadata and one query of the gene table (see cell_cache.py).
+
+	Returns the same columns, in the same order, as the MySQL queries in get_gene_methylation.
+
+	Returns:
+		DataFrame
+	"""
+	context = methylation_type[1:]
+	rows = sample_rows(store, max_points)
+
+	if tsne_type=='noTSNE':
+		return store.frame(['cell_id'], gene, [methylation_type, context], rows)
+	elif 'ndim2' in tsne_type:
+		columns = ['cell_id', 'dataset', 'cluster_'+clustering, 'target_region', 'annotation_'+clustering,
+			methylation_type, 'global_'+methylation_type, 'grouping', 'tsne_x_'+tsne_type, 'tsne_y_'+tsne_type,
+			context, 'sex']
+	else: # 3D tSNE
+		columns = ['cell_id', 'cell_name', 'dataset', 'global_'+methylation_type, 'annotation_'+clustering,
+			'cluster_'+clustering, 'tsne_x_'+tsne_type, 'tsne_y_'+tsne_type, 'tsne_z_'+tsne_type,
+			methylation_type, context, 'target_region', 'sex']
+
+	cell_columns = [c for c in columns if c not in (methylation_type, context, 'grouping')]
+	df = store.frame(cell_columns, gene, [methylation_type, context], rows)
+	if 'grouping' in columns:
+		df['grouping'] = _store_grouping(store, grouping, clustering, rows)
+	return df[columns]
+
+def gene_counts_from_store(store, gene, counts_type, modality, tsne=True, max_points='10000'):
+	"""Read a gene's snATAC or RNA counts from the matrix store, or from the ensemble's
+	cached cell metadata and one query of the gene table (see cell_cache.py).
+
+	Returns the same columns, in the same order, as the MySQL queries in get_gene_snATAC and get_gene_RNA.
+
+	Returns:
+		DataFrame
+	"""
+	rows = sample_rows(store, max_points)
+	if not tsne:
+		return store.frame(['cell_id'], gene, [('normalized_counts', counts_type)], rows)
+
+	df = store.frame(['cell_id', 'cell_name', 'dataset', 'annotation_'+modality, 'cluster_'+modality,
+		'tsne_x_'+modality, 'tsne_y_'+modality], gene, [('normalized_counts', counts_type)], rows)
+	df['target_region'] = store.cell_column('target_region', rows)
+	return df
+
+def has_sample_rank(ensemble, modality='methylation'):
+	"""Whether precompute.build_sample_rank has been run for an ensemble."""
+	return table_catalog(modality).has_column(ensemble, 'sample_rank')
+
+def sample_clause(ensemble, max_points, modality='methylation'):
+	"""SQL appended to a per-cell query to limit it to max_points cells.
+
+	Uses the ensemble's precomputed sample_rank column (an index range scan) when it exists,
+	otherwise a seeded ORDER BY RAND(). Either way the same cells are returned for every gene
+	and every request.
+
+	Arguments:
+		ensemble (str): Ensemble table name, which must appear in the query's FROM clause.
+		max_points (str): Number of cells to keep. Non-digit values keep all cells.
+		modality (str): 'methylation', 'snATAC' or 'RNA'.
+
+	Returns:
+		str
+	"""
+	if not str(max_points).isdigit():
+		return ""
+	if has_sample_rank(ensemble, modality):
+		return " WHERE %(ensemble)s.sample_rank < %(max_points)s" % {'ensemble': ensemble, 'max_points': max_points}
+	return " ORDER BY RAND(%(seed)s) LIMIT %(max_points)s" % {'seed': int(current_app.config.get('SAMPLE_SEED', 0)),
+		'max_points': max_points}
+
+def gene_values_query(ensemble, gene_table_name, columns, max_points, modality='methylation'):
+	"""SELECT of one gene's values for the ensemble's cells, to be combined with UNION ALL.
+
+	Restricted to the sampled cells when the ensemble has a sample_rank column. Otherwise every
+	cell of the ensemble is returned and callers align rows to their own cells by cell_id.
+
+	Returns:
+		str
+	"""
+	query = "SELECT %(gene_table_name)s.cell_id, %(columns)s \
+		FROM %(ensemble)s \
+		INNER JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id" % {'ensemble': ensemble,
+			'gene_table_name': gene_table_name,
+			'columns': ', '.join(gene_table_name+'.'+column for column in columns),}
+	if str(max_points).isdigit() and has_sample_rank(ensemble, modality):
+		query = query+" WHERE %(ensemble)s.sample_rank < %(max_points)s" % {'ensemble': ensemble, 'max_points': max_points}
+	return query
+
+class CellAverager(object):
+	"""Average per-gene values onto one fixed, ordered set of cells.
+
+	Rows of each gene are matched to the cells by cell_id and accumulated into preallocated
+	sum and count arrays, instead of concatenating per-gene DataFrames and grouping by cell_id.
+
+	Arguments:
+		cell_ids: Cells of the output, in order.
+		columns ([str]): Value columns to average.
+		fill_value (float): Value of cells missing from a gene's rows (0 for counts).
+			None leaves them out of that cell's average (methylation).
+	"""
+
+	def __init__(self, cell_ids, columns, fill_value=None):
+		self.index = pd.Index(cell_ids)
+		self.fill_value = fill_value
+		self.n_genes = 0
+		self.sums = dict((column, np.zeros(len(self.index))) for column in columns)
+		self.counts = dict((column, np.zeros(len(self.index))) for column in columns)
+
+	def _accumulate(self, column, positions, values):
+		values = np.asarray(pd.to_numeric(values), dtype=float)
+		keep = (positions >= 0) & ~np.isnan(values)
+		self.sums[column] += np.bincount(positions[keep], weights=values[keep], minlength=len(self.index))
+		self.counts[column] += np.bincount(positions[keep], minlength=len(self.index))
+
+	def add_rows(self, df, n_genes=1):
+		"""Add rows of one or more genes (ie. a UNION ALL result) with a cell_id column."""
+		positions = self.index.get_indexer(df['cell_id'])
+		for column in self.sums:
+			self._accumulate(column, positions, df[column])
+		self.n_genes += n_genes
+
+	def add_aligned(self, values):
+		"""Add one gene given as {column: array aligned with the cells}."""
+		positions = np.arange(len(self.index))
+		for column in self.sums:
+			self._accumulate(column, positions, values[column])
+		self.n_genes += 1
+
+	def mean(self, column):
+		"""Returns: ndarray aligned with the cells, NaN where a cell has no values."""
+		sums, counts = self.sums[column], self.counts[column]
+		if self.fill_value is not None:
+			sums = sums + self.fill_value * (self.n_genes - counts)
+			counts = np.full(len(counts), self.n_genes, dtype=float)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			return sums / counts
+
+def average_gene_counts(df_coords, ensemble, gene_ids, counts_type, modality, max_points, store=None):
+	"""Replace normalized_counts of df_coords, which holds gene_ids[0], by the average over gene_ids.
+
+	Cells without counts for a gene count as 0, as in the single gene plots.
+
+	Arguments:
+		df_coords (DataFrame): Cells of the plot, from get_gene_snATAC/get_gene_RNA style queries.
+		modality (str): Database and store name. 'snATAC' or 'RNA'.
+		store (EnsembleStore): Matrix store holding all genes, if any.
+
+	Returns:
+		DataFrame, or None on errors.
+	"""
+	averager = CellAverager(df_coords['cell_id'], ['normalized_counts'], fill_value=0)
+	averager.add_rows(df_coords)
+	if store is not None:
+		rows = sample_rows(store, max_points)
+		for gene_id in gene_ids[1:]:
+			averager.add_aligned({'normalized_counts': store.gene_values(gene_id, counts_type, rows)})
+	elif len(gene_ids) > 1:
+		query = " UNION ALL ".join(gene_values_query(ensemble, 'gene_'+gene_id.replace('.','_'), [counts_type], max_points, modality)
+			for gene_id in gene_ids[1:])
+		try:
+			df_all = pd.read_sql(query, db.get_engine(current_app, modality+'_data'))
+		except exc.ProgrammingError as e:
+			now = datetime.datetime.now()
+			print("[{}] ERROR in app(average_gene_counts): {}".format(str(now), e))
+			sys.stdout.flush()
+			return None
+		averager.add_rows(df_all.rename(columns={counts_type: 'normalized_counts'}), len(gene_ids)-1)
+
+	df_coords['normalized_counts'] = averager.mean('normalized_counts')
+	return df_coords
 
-	corr_genes = [ {"rank": i+1, "gene_name": get_gene_by_id(row.gene2)[0]['gene_name'], "correlation": row.correlation, "gene_id": row.gene2} for i, row in enumerate(corr_genes)]
-	return corr_genes
+def _store_error(function_name, e):
+	now = datetime.datetime.now()
+	if isinstance(e, KeyError):
+		print("[{}] ERROR in app({}): {} missing from matrix store".format(str(now), function_name, e))
+	else:
+		print("[{}] ERROR in app({}): {}".format(str(now), function_name, e))
+	sys.stdout.flush()
 
 @cache.memoize(timeout=3600)
 def get_gene_methylation(ensemble, methylation_type, gene, grouping, clustering, level, outliers, tsne_type='mCH_ndim2_perp20', 
@@ -904,68 +1531,74 @@ def get_gene_methylation(ensemble, methylation_type, gene, grouping, clustering,
 	if ";" in ensemble or ";" in methylation_type or ";" in grouping or ";" in clustering or ";" in tsne_type:
 		return None
 
-	# This query is just to fix gene id's missing the ensemble version number.
-	# Necessary because the table name must match exactly with whats on the MySQL database.
-	# Ex. ENSMUSG00000026787 is fixed to ENSMUSG00000026787.3 -> gene_ENSMUSG00000026787_3 (table name in MySQL)
-	result = db.get_engine(current_app, 'methylation_data').execute("SELECT gene_id FROM genes WHERE gene_id LIKE %s", (gene+"%",)).fetchone()
-	gene_table_name = 'gene_' + result.gene_id.replace('.','_')
-
 	context = methylation_type[1:]
-	if grouping in ['annotation','cluster']:
-		groupingu = ensemble+"."+grouping+"_"+clustering
-	elif grouping in ['NeuN']:
-		groupingu = "CONCAT('NeuN',cells."+grouping+")"
-	elif grouping in ['dataset','sex','brain_region','target_region']:
-		groupingu = "datasets."+grouping
-	elif grouping in ['broad_brain_region']:
-		groupingu = "ABA_regions.ABA_broad_acronym"
+	store = open_ensemble(ensemble.replace('EnsEns','Ens'), 'methylation')
+	if store is not None and store.has_gene(gene):
+		try:
+			df = gene_methylation_from_store(store, gene, methylation_type, clustering, tsne_type, grouping, max_points)
+		except (KeyError, exc.ProgrammingError) as e:
+			_store_error('get_gene_methylation', e)
+			return None
 	else:
-		groupingu = "cells."+grouping
-
-	ensemble = ensemble.replace('EnsEns','Ens')
+		# Gene ids may be missing the Ensembl version number, which the table name must include.
+		# Ex. ENSMUSG00000026787 -> gene_ENSMUSG00000026787_3 (table name in MySQL)
+		gene_table_name = gene_index('methylation').table_name(gene)
+		if gene_table_name is None:
+			return None
 
-	if 'ndim2' in tsne_type:
-		query = "SELECT cells.cell_id, cells.dataset, %(ensemble)s.cluster_%(clustering)s, datasets.target_region, \
-			%(ensemble)s.annotation_%(clustering)s, %(gene_table_name)s.%(methylation_type)s, \
-			cells.global_%(methylation_type)s, %(groupingu)s as grouping, \
-			%(ensemble)s.tsne_x_%(tsne_type)s, %(ensemble)s.tsne_y_%(tsne_type)s, \
-			%(gene_table_name)s.%(context)s, datasets.sex \
-			FROM cells \
-			INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
-			LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id \
-			LEFT JOIN datasets ON cells.dataset = datasets.dataset \
-			LEFT JOIN ABA_regions ON datasets.brain_region=ABA_regions.ABA_acronym" % {'ensemble': ensemble, 'groupingu': groupingu,
-																	   'gene_table_name': gene_table_name,
-																	   'tsne_type': tsne_type,
-																	   'methylation_type': methylation_type,
-																	   'context': context,
-																	   'clustering': clustering,}
-	else:
-		query = "SELECT cells.cell_id, cells.cell_name, cells.dataset, cells.global_%(methylation_type)s, \
-			%(ensemble)s.annotation_%(clustering)s, %(ensemble)s.cluster_%(clustering)s, \
-			%(ensemble)s.tsne_x_%(tsne_type)s, %(ensemble)s.tsne_y_%(tsne_type)s, %(ensemble)s.tsne_z_%(tsne_type)s, \
-			%(gene_table_name)s.%(methylation_type)s, %(gene_table_name)s.%(context)s, \
-			datasets.target_region, datasets.sex \
-			FROM cells \
-			INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
-			LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id \
-			LEFT JOIN datasets ON cells.dataset = datasets.dataset " % {'ensemble': ensemble,
-																	   'gene_table_name': gene_table_name,
-																	   'tsne_type': tsne_type,
-																	   'methylation_type': methylation_type,
-																	   'context': context,
-																	   'clustering': clustering,}
-	if max_points.isdigit():
-		query = query+" ORDER BY RAND() LIMIT %(max_points)s" % {'max_points': max_points}
-		# TODO: Check whether we need to randomize the rows
+		if grouping in ['annotation','cluster']:
+			groupingu = ensemble+"."+grouping+"_"+clustering
+		elif grouping in ['NeuN']:
+			groupingu = "CONCAT('NeuN',cells."+grouping+")"
+		elif grouping in ['dataset','sex','brain_region','target_region']:
+			groupingu = "datasets."+grouping
+		elif grouping in ['broad_brain_region']:
+			groupingu = "ABA_regions.ABA_broad_acronym"
+		else:
+			groupingu = "cells."+grouping
+
+		ensemble = ensemble.replace('EnsEns','Ens')
+
+		if 'ndim2' in tsne_type:
+			query = "SELECT cells.cell_id, cells.dataset, %(ensemble)s.cluster_%(clustering)s, datasets.target_region, \
+				%(ensemble)s.annotation_%(clustering)s, %(gene_table_name)s.%(methylation_type)s, \
+				cells.global_%(methylation_type)s, %(groupingu)s as grouping, \
+				%(ensemble)s.tsne_x_%(tsne_type)s, %(ensemble)s.tsne_y_%(tsne_type)s, \
+				%(gene_table_name)s.%(context)s, datasets.sex \
+				FROM cells \
+				INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
+				LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id \
+				LEFT JOIN datasets ON cells.dataset = datasets.dataset \
+				LEFT JOIN ABA_regions ON datasets.brain_region=ABA_regions.ABA_acronym" % {'ensemble': ensemble, 'groupingu': groupingu,
+																		   'gene_table_name': gene_table_name,
+																		   'tsne_type': tsne_type,
+																		   'methylation_type': methylation_type,
+																		   'context': context,
+																		   'clustering': clustering,}
+		else:
+			query = "SELECT cells.cell_id, cells.cell_name, cells.dataset, cells.global_%(methylation_type)s, \
+				%(ensemble)s.annotation_%(clustering)s, %(ensemble)s.cluster_%(clustering)s, \
+				%(ensemble)s.tsne_x_%(tsne_type)s, %(ensemble)s.tsne_y_%(tsne_type)s, %(ensemble)s.tsne_z_%(tsne_type)s, \
+				%(gene_table_name)s.%(methylation_type)s, %(gene_table_name)s.%(context)s, \
+				datasets.target_region, datasets.sex \
+				FROM cells \
+				INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
+				LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id \
+				LEFT JOIN datasets ON cells.dataset = datasets.dataset " % {'ensemble': ensemble,
+																		   'gene_table_name': gene_table_name,
+																		   'tsne_type': tsne_type,
+																		   'methylation_type': methylation_type,
+																		   'context': context,
+																		   'clustering': clustering,}
+		query = query+sample_clause(ensemble, max_points)
 
-	try:
-		df = pd.read_sql(query, db.get_engine(current_app, 'methylation_data'))
-	except exc.ProgrammingError as e:
-		now = datetime.datetime.now()
-		print("[{}] ERROR in app(get_gene_methylation): {}".format(str(now), e))
-		sys.stdout.flush()
-		return None
+		try:
+			df = pd.read_sql(query, db.get_engine(current_app, 'methylation_data'))
+		except exc.ProgrammingError as e:
+			now = datetime.datetime.now()
+			print("[{}] ERROR in app(get_gene_methylation): {}".format(str(now), e))
+			sys.stdout.flush()
+			return None
 
 	if df[context].isnull().all(): # If no data in column, return None
 		return None
@@ -997,7 +1630,8 @@ def get_gene_methylation(ensemble, methylation_type, gene, grouping, clustering,
 	return df
 
 def get_gene_from_mysql(ensemble, gene_table_name, methylation_type, clustering, tsne_type, grouping='cluster', max_points='10000'):
-	"""Helper function to fetch a gene's methylation information from mysql.
+	"""Helper function to fetch a gene's methylation information from mysql,
+	or from the matrix store when the ensemble has been exported.
 
 	TODO: Don't need to fetch tsne info, annotations etc. except once
 
@@ -1005,6 +1639,15 @@ def get_gene_from_mysql(ensemble, gene_table_name, methylation_type, clustering,
 		DataFrame
 	"""
 
+	store = open_ensemble(ensemble, 'methylation')
+	gene = gene_table_name.split('_')[1]
+	if store is not None and store.has_gene(gene):
+		try:
+			return gene_methylation_from_store(store, gene, methylation_type, clustering, tsne_type, grouping, max_points)
+		except (KeyError, exc.ProgrammingError) as e:
+			_store_error('get_gene_from_mysql', e)
+			return None
+
 	context = methylation_type[1:]
 	if grouping in ['annotation','cluster']:
 		groupingu = ensemble+"."+grouping+"_"+clustering
@@ -1021,7 +1664,7 @@ def get_gene_from_mysql(ensemble, gene_table_name, methylation_type, clustering,
 	t0=datetime.datetime.now()
 	# print(' Running get_gene_from_mysql for '+gene_table_name+' : '+str(t0)+'; ', file=open(log_file,'a'))# EAM - Profiling SQL
 	if tsne_type=='noTSNE':
-		query = "SELECT %(gene_table_name)s.%(methylation_type)s, %(gene_table_name)s.%(context)s \
+		query = "SELECT %(ensemble)s.cell_id, %(gene_table_name)s.%(methylation_type)s, %(gene_table_name)s.%(context)s \
 			FROM %(ensemble)s  \
 			LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id" % {'ensemble': ensemble,
 																	   'gene_table_name': gene_table_name,
@@ -1057,8 +1700,7 @@ def get_gene_from_mysql(ensemble, gene_table_name, methylation_type, clustering,
 																	   'methylation_type': methylation_type,
 																	   'context': context,
 																	   'clustering': clustering,}
-	if max_points.isdigit():
-		query = query+" ORDER BY RAND() LIMIT %(max_points)s" % {'max_points': max_points}
+	query = query+sample_clause(ensemble, max_points)
 
 	try:
 		df = pd.read_sql(query, db.get_engine(current_app, 'methylation_data'))
@@ -1094,38 +1736,48 @@ def get_mult_gene_methylation(ensemble, methylation_type, genes, grouping, clust
 		return None
 
 	context = methylation_type[1:]
-	genes = [gene+"%" for gene in genes]
-
-	# This query is just to fix gene id's missing the Ensembl version number.
-	# Necessary because the table name must match exactly with whats on the MySQL database.
-	# Ex. ENSMUSG00000026787 is fixed to ENSMUSG00000026787.3
-	first_query = "SELECT gene_id FROM genes WHERE gene_id LIKE %s" + " OR gene_id LIKE %s" * (len(genes)-1)
-	result = db.get_engine(current_app, 'methylation_data').execute(first_query, (genes,)).fetchall()
-
-	gene_table_names = ['gene_' + gene_id[0].replace('.','_') for gene_id in result]
-
-	df_all = pd.DataFrame()
 
-	t0=datetime.datetime.now()
-	df_list = []
-	for i, gene_table_name in enumerate(gene_table_names):
-		t0a=datetime.datetime.now()
-		if i>0:
-			tsne_typeu='noTSNE'
-		else:
-			tsne_typeu=tsne_type
-		df_all = df_all.append(get_gene_from_mysql(ensemble, gene_table_name, methylation_type, clustering, tsne_typeu, grouping, max_points))
-		if i==0:
-			df_coords=df_all
-		t1a=datetime.datetime.now()
-
-	t1=datetime.datetime.now()
+	# Add the Ensembl version number the table names need. Ex. ENSMUSG00000026787 -> ENSMUSG00000026787.3
+	gene_ids = gene_index('methylation').resolve(genes)
+	gene_table_names = ['gene_' + gene_id.replace('.','_') for gene_id in gene_ids]
+	if not gene_ids:
+		return None
 
-	df_all[[methylation_type, context]] = df_all[[methylation_type, context]].apply(pd.to_numeric)
+	# Coordinates and cell metadata are fetched once, together with the first gene. The other
+	# genes' values are then averaged onto those cells.
+	store = open_store(ensemble, 'methylation')
+	if store is not None and all(store.has_gene(gene_id) for gene_id in gene_ids):
+		try:
+			df_coords = gene_methylation_from_store(store, gene_ids[0], methylation_type, clustering, tsne_type, grouping, max_points)
+			averager = CellAverager(df_coords['cell_id'], [methylation_type, context])
+			averager.add_rows(df_coords)
+			rows = sample_rows(store, max_points)
+			for gene_id in gene_ids[1:]:
+				averager.add_aligned(dict((column, store.gene_values(gene_id, column, rows)) for column in [methylation_type, context]))
+		except KeyError as e:
+			_store_error('get_mult_gene_methylation', e)
+			return None
+	else:
+		df_coords = get_gene_from_mysql(ensemble, gene_table_names[0], methylation_type, clustering, tsne_type, grouping, max_points)
+		if df_coords is None:
+			return None
 
-	df_avg_methylation = df_all.groupby(by='cell_id', as_index=False)[[methylation_type, context]].mean()
-	df_coords.update(df_avg_methylation)
+		averager = CellAverager(df_coords['cell_id'], [methylation_type, context])
+		averager.add_rows(df_coords)
+		if len(gene_table_names) > 1:
+			query = " UNION ALL ".join(gene_values_query(ensemble, gene_table_name, [methylation_type, context], max_points)
+				for gene_table_name in gene_table_names[1:])
+			try:
+				df_all = pd.read_sql(query, db.get_engine(current_app, 'methylation_data'))
+			except exc.ProgrammingError as e:
+				now = datetime.datetime.now()
+				print("[{}] ERROR in app(get_mult_gene_methylation): {}".format(str(now), e))
+				sys.stdout.flush()
+				return None
+			averager.add_rows(df_all, len(gene_table_names)-1)
 
+	for column in [methylation_type, context]:
+		df_coords[column] = averager.mean(column)
 
 	if df_coords[context].isnull().all(): # If no data in column, return None
 		return None
@@ -1147,7 +1799,7 @@ def get_mult_gene_methylation(ensemble, methylation_type, genes, grouping, clust
 
 @cache.memoize(timeout=1800)
 def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query, level, grouping,
-	clustering, ptile_start, ptile_end, tsne_outlier_bool, max_points='10000'):
+	clustering, ptile_start, ptile_end, tsne_outlier_bool, max_points='10000', output='html'):
 	"""Generate scatter plot and gene body reads scatter plot using tSNE coordinates from snATAC-seq data.
 
 	Arguments:
@@ -1161,13 +1813,18 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
 		ptile_start (float): Lower end of color percentile. [0, 1].
 		ptile_end (float): Upper end of color percentile. [0, 1].
 		tsne_outlier_bool (bool): Whether or not to change X and Y axes range to hide outliers. True = do show outliers.
+		output (str): 'html' for a Plot.ly div, 'json' for the figure data (see render_figure).
 
 	Returns:
-		str: HTML generated by Plot.ly.
+		str: HTML generated by Plot.ly, or dict for output='json'.
 	"""
 
 	genes = genes_query.split()
 
+	# Raster mode plots every cell as pixels (see raster_scatter).
+	raster = max_points == 'raster' and 'ndim2' in tsne_type
+	max_points = 'all' if raster else point_sample(max_points)
+
 	gene_name_str = ""
 	x, y, text, mch = list(), list(), list(), list()
 
@@ -1218,6 +1875,7 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
 	symbols = ['circle', 'square', 'cross', 'triangle-up', 'triangle-down', 'octagon', 'star', 'diamond']
 
 	traces_tsne = OrderedDict()
+	hover_tsne = OrderedDict()
 
 	legend_x = -.17
 	layout_width = 1100
@@ -1252,6 +1910,18 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
 
 	context = methylation_type[1:]
 
+	if raster:
+		if grouping_clustering.startswith('cluster'):
+			group_names = ['cluster_' + str(group) for group in unique_groups]
+		elif grouping_clustering == "dataset":
+			group_names = ["_".join(group.split('_')[1:]) for group in unique_groups]
+		else:
+			group_names = [str(group) for group in unique_groups]
+		return raster_scatter(points, 'tsne_x_'+tsne_type, 'tsne_y_'+tsne_type, ((bottom_x, top_x), (bottom_y, top_y)),
+							  'grouping', unique_groups, group_names, colors,
+							  methylation_type + '/' + context + '_' + level, level.capitalize() + ' ' + methylation_type,
+							  ptile_start, ptile_end, title, grouping, output)
+
 	## 2D tSNE coordinates ##
 	if 'ndim2' in tsne_type:
 		for i, group in enumerate(unique_groups):
@@ -1293,49 +1963,37 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
 					   #'symbol': symbols[datasets.index(dataset)],
 				},
 				hoverinfo='text'))
-			trace2d['x'] = points_group['tsne_x_'+tsne_type].values.tolist()
-			trace2d['y'] = points_group['tsne_y_'+tsne_type].values.tolist()
-			trace2d['text'] = [build_hover_text(OrderedDict([('Annotation', point[4]),
-														  ('Cluster', point[2]),
-														  ('RS2 Target Region', point[3]),
-														  ('Dataset', point[1]),
-														  ('<b>'+grouping+'</b>', point[7]),]))
-							   for point in points_group.itertuples(index=False)]
+			trace2d['x'] = points_group['tsne_x_'+tsne_type].values
+			trace2d['y'] = points_group['tsne_y_'+tsne_type].values
+			hover_tsne[color_num] = set_hover(trace2d, points_group, [('Annotation', points.columns[4]),
+																	  ('Cluster', points.columns[2]),
+																	  ('RS2 Target Region', points.columns[3]),
+																	  ('Dataset', points.columns[1]),
+																	  ('<b>'+grouping+'</b>', points.columns[7]),], output)
 
 		### METHYLATION SCATTER ###
-		x = points['tsne_x_' + tsne_type].tolist()
-		y = points['tsne_y_' + tsne_type].tolist()
+		x = points['tsne_x_' + tsne_type].values
+		y = points['tsne_y_' + tsne_type].values
 		mch = points[methylation_type + '/' + context + '_' + level]
-		text_methylation = [build_hover_text(OrderedDict([('Annotation', point[4]),
-														  ('Cluster', point[2]),
-														  ('RS2 Target Region', point[3]),
-														  ('Dataset', point[1]),
-														  ('<b>'+level.title()+' '+methylation_type+'</b>', round(point[5], 6)),]))
-							for point in points.itertuples(index=False)]
-
-
-		mch_dataframe = pd.DataFrame(mch)
-		start = mch_dataframe.dropna().quantile(ptile_start)[0].tolist()
-		end = mch_dataframe.dropna().quantile(ptile_end).values[0].tolist()
-		end = max(end,start+0.01)
-		mch_colors = [set_color_by_percentile(x, start, end) for x in mch]
-
-		colorbar_tickval = list(arange(start, end, (end - start) / 4))
-		colorbar_tickval[0] = start
-		colorbar_tickval.append(end)
-		colorbar_ticktext = [
-			str(round(x, num_sigfigs_ticklabels)) for x in arange(start, end, (end - start) / 4)
-		]
-		colorbar_ticktext[0] = '<' + str(round(start, num_sigfigs_ticklabels))
-		colorbar_ticktext.append('>' + str(round(end, num_sigfigs_ticklabels)))
+		hover_fields = [('Annotation', points.columns[4]),
+						('Cluster', points.columns[2]),
+						('RS2 Target Region', points.columns[3]),
+						('Dataset', points.columns[1]),
+						('<b>'+level.title()+' '+methylation_type+'</b>', points.columns[5], 6),]
+
+
+		mch_colors, start, end = percentile_colors(mch, ptile_start, ptile_end)
+		missing = np.isnan(mch_colors)
+		colorbar_tickval, colorbar_ticktext = colorbar_ticks(start, end)
 
 		trace_methylation = Scatter(
 			mode='markers',
 			x=x,
 			y=y,
-			text=text_methylation,
 			marker={
 				'color': mch_colors,
+				'cmin': start,
+				'cmax': end,
 				'colorscale': 'Viridis',
 				'size': marker_size,
 				'colorbar': {
@@ -1432,8 +2090,13 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
 				subplot_titles=("tSNE colored by "+grouping, title),
 				)
 
+		trace_missing = split_missing_points(trace_methylation, missing)
+		hover_missing = set_hover(trace_missing, points[missing], hover_fields, output)
+		hover_methylation = set_hover(trace_methylation, points[~missing], hover_fields, output)
+
 		for trace in traces_tsne.items():
 			fig.append_trace(trace[1], 1,1)
+		fig.append_trace(trace_missing, 1,2)
 		fig.append_trace(trace_methylation, 1,2)
 
 		fig['layout'].update(layout)
@@ -1493,49 +2156,37 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
 					   #'symbol': symbols[datasets.index(dataset)],
 				},
 				hoverinfo='text'))
-			trace3d['x'] = points_group['tsne_x_'+tsne_type].values.tolist()
-			trace3d['y'] = points_group['tsne_y_'+tsne_type].values.tolist()
-			trace3d['z'] = points_group['tsne_z_'+tsne_type].values.tolist()
-			trace3d['text'] = [build_hover_text(OrderedDict([('Dataset', point[2]),
-															 ('Annotation', point[4]),
-															 ('Cluster', point[5]),]))
-							   for point in points_group.itertuples(index=False)]
+			trace3d['x'] = points_group['tsne_x_'+tsne_type].values
+			trace3d['y'] = points_group['tsne_y_'+tsne_type].values
+			trace3d['z'] = points_group['tsne_z_'+tsne_type].values
+			hover_tsne[color_num] = set_hover(trace3d, points_group, [('Dataset', points.columns[2]),
+																	  ('Annotation', points.columns[4]),
+																	  ('Cluster', points.columns[5]),], output)
 
 		### METHYLATION SCATTER ###
-		x = points['tsne_x_' + tsne_type].tolist()
-		y = points['tsne_y_' + tsne_type].tolist()
-		z = points['tsne_z_' + tsne_type].tolist()
+		x = points['tsne_x_' + tsne_type].values
+		y = points['tsne_y_' + tsne_type].values
+		z = points['tsne_z_' + tsne_type].values
 		mch = points[methylation_type + '/' + context + '_' + level]
-		text_methylation = [build_hover_text(OrderedDict([('Annotation', point[4]),
-														  ('Cluster', point[5]),
-														  ('<b>'+methylation_type+'</b>', round(point[-1], 6)),]))
-							for point in points.itertuples(index=False)]
-
-
-		mch_dataframe = pd.DataFrame(mch)
-		start = mch_dataframe.dropna().quantile(ptile_start)[0].tolist()
-		end = mch_dataframe.dropna().quantile(ptile_end).values[0].tolist()
-		end = max(end,start+0.01)
-		mch_colors = [set_color_by_percentile(x, start, end) for x in mch]
-
-		colorbar_tickval = list(arange(start, end, (end - start) / 4))
-		colorbar_tickval[0] = start
-		colorbar_tickval.append(end)
-		colorbar_ticktext = [
-			str(round(x, num_sigfigs_ticklabels)) for x in arange(start, end, (end - start) / 4)
-		]
-		colorbar_ticktext[0] = '<' + str(round(start, num_sigfigs_ticklabels))
-		colorbar_ticktext.append('>' + str(round(end, num_sigfigs_ticklabels)))
+		hover_fields = [('Annotation', points.columns[4]),
+						('Cluster', points.columns[5]),
+						('<b>'+methylation_type+'</b>', points.columns[-1], 6),]
+
+
+		mch_colors, start, end = percentile_colors(mch, ptile_start, ptile_end)
+		missing = np.isnan(mch_colors)
+		colorbar_tickval, colorbar_ticktext = colorbar_ticks(start, end)
 
 		trace_methylation = Scatter3d(
 			mode='markers',
 			x=x,
 			y=y,
 			z=z,
-			text=text_methylation,
 			scene='scene2',
 			marker={
 				'color': mch_colors,
+				'cmin': start,
+				'cmax': end,
 				'colorscale': 'Viridis',
 				'size': marker_size,
 				'colorbar': {
@@ -1637,8 +2288,13 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
 								  subplot_titles=("tSNE", "Methylation"),
 								  specs=[[{'is_3d':True}, {'is_3d':True}]])
 
+		trace_missing = split_missing_points(trace_methylation, missing)
+		hover_missing = set_hover(trace_missing, points[missing], hover_fields, output)
+		hover_methylation = set_hover(trace_methylation, points[~missing], hover_fields, output)
+
 		for trace in traces_tsne.items():
 			fig.append_trace(trace[1], 1,1)
+		fig.append_trace(trace_missing, 1,2)
 		fig.append_trace(trace_methylation, 1,2)
 
 		fig['layout'].update(layout)
@@ -1657,17 +2313,13 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
 															  'color': 'gray',})])
 		fig['layout']['annotations']=annotations
 
-	return plotly.offline.plot(
-		figure_or_data=fig,
-		output_type='div',
-		show_link=False,
-			include_plotlyjs=False)
+	return render_figure(fig, output, float32=True, hover=list(hover_tsne.values())+[hover_missing, hover_methylation])
 
 @cache.memoize(timeout=3600)
 def get_boxplot(ensemble, gene, grouping, outliers, modality='methylation', 
 	methylation_type='mcg', clustering='lv', level='normalized', 
 	smoothing=False,
-	max_points='10000'):
+	max_points='10000', output='html'):
 	"""Generate box plot.
 
 	Traces are grouped by cluster.
@@ -1680,11 +2332,13 @@ def get_boxplot(ensemble, gene, grouping, outliers, modality='methylation',
 		grouping (str): Variable to group cells by. "cluster", "annotation".
 		level (str): "original" or "normalized" methylation values.
 		outliers (bool): Whether if outliers should be displayed.
+		output (str): 'html' for a Plot.ly div, 'json' for the figure data (see render_figure).
 
 	Returns:
-		str: HTML generated by Plot.ly.
+		str: HTML generated by Plot.ly, or dict for output='json'.
 	"""
 	modalityu = modality.replace('snATAC','ATAC').replace('snRNA','RNA')
+	max_points = point_sample(max_points)
 	
 	with open(log_file,'a') as f:
 		print(' Checkpoint 1: modality=%s grouping=%s' % (modality, grouping), file=f) 
@@ -1879,17 +2533,14 @@ def get_boxplot(ensemble, gene, grouping, outliers, modality='methylation',
 		showlegend=False,
 	)
 
-	return plotly.offline.plot(
+	return render_figure(
 		{
 			'data': data,
 			'layout': layout
-		},
-		output_type='div',
-		show_link=False,
-		include_plotlyjs=False,) 
+		}, output)
 
 @cache.memoize(timeout=3600)
-def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, ptile_start, ptile_end, normalize_row, query):
+def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, ptile_start, ptile_end, normalize_row, query, output='html'):
 	"""Generate mCH heatmap comparing multiple genes.
 
 	Arguments:
@@ -1901,9 +2552,10 @@ def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pti
 		ptile_end (float): Upper end of color percentile. [0, 1].
 		normalize_row (bool): Whether to normalize by each row (gene).
 		query ([str]): Ensembl IDs of genes to display.
+		output (str): 'html' for a Plot.ly div, 'json' for the figure data (see render_figure).
 
 	Returns:
-		str: HTML generated by Plot.ly
+		str: HTML generated by Plot.ly, or dict for output='json'.
 	"""
 	tsne_type = 'mCH_ndim2_perp20'
 
@@ -1922,15 +2574,18 @@ def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pti
 	gene_labels = list()
 	gene_info_df = pd.DataFrame()
 	gene_infos = get_gene_by_id(genes)
+	summaries = get_cluster_summaries(ensemble, [gene['gene_id'] for gene in gene_infos], grouping, 'methylation',
+		methylation_type, clustering, level)
 	for i, gene in enumerate(gene_infos):
 		gene_name = gene['gene_name']
 		gene_labels.append(gene_name)
 		if i > 0 and i % 10 == 0:
 			title += "<br>"
 		title += gene_name + "+"
-		gene_info_df[gene_name] = median_cluster_mch(get_gene_methylation(ensemble, methylation_type, gene['gene_id'], grouping, clustering, level, True), grouping, clustering)
-		if gene_info_df[gene_name].empty:
+		summary = summaries[gene['gene_id']]
+		if summary is None or summary.empty:
 			raise FailToGraphException
+		gene_info_df[gene_name] = summary['median']
 
 	title = title[:-1] # Gets rid of last '+'
 
@@ -2206,10 +2861,7 @@ def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pti
 
 	figure['layout'] = layout
 
-	return plotly.offline.plot(figure,
-		output_type='div',
-		show_link=False,
-		include_plotlyjs=False)
+	return render_figure(figure, output)
 
 @cache.memoize(timeout=3600)
 def get_clusters(ensemble, grouping, clustering):
@@ -2290,7 +2942,7 @@ def get_clusters(ensemble, grouping, clustering):
 	return df
 
 @cache.memoize(timeout=3600)
-def get_clusters_bar(ensemble, grouping, clustering, normalize):
+def get_clusters_bar(ensemble, grouping, clustering, normalize, output='html'):
 	"""Generate clusters bar plot showing number of cells in each cluster.
 
 	Traces are grouped by modality (mch, ATAC).
@@ -2300,9 +2952,10 @@ def get_clusters_bar(ensemble, grouping, clustering, normalize):
 		clustering (str): Different clustering algorithms and parameters. 'lv' = Louvain clustering.
 		grouping (str): Variable to group cells by. "cluster", "annotation".
 		outliers (bool): Whether if outliers should be displayed.
+		output (str): 'html' for a Plot.ly div, 'json' for the figure data (see render_figure).
 
 	Returns:
-		str: HTML generated by Plot.ly.
+		str: HTML generated by Plot.ly, or dict for output='json'.
 	"""
 	if grouping not in ['cluster','annotation','dataset','NeuN']:
 		grouping = 'cluster'
@@ -2385,14 +3038,11 @@ def get_clusters_bar(ensemble, grouping, clustering, normalize):
 	        'mirror': True,
 	    },
 	)
-	return plotly.offline.plot(
+	return render_figure(
 		{
 			'data': data,
 			'layout': layout
-		},
-		output_type='div',
-		show_link=False,
-		include_plotlyjs=False)
+		}, output)
 
 ### TODO: Refactor the code to combine the ATAC and RNA into one set of functions...
 ### snATAC
@@ -2420,40 +3070,47 @@ def get_gene_snATAC(ensemble, gene, grouping, outliers, smoothing=False, max_poi
 	if ";" in ensemble or ";" in grouping:
 		return None
 
-	# This query is just to fix gene id's missing the ensemble version number.
-	# Necessary because the table name must match exactly with whats on the MySQL database.
-	# Ex. ENSMUSG00000026787 is fixed to ENSMUSG00000026787.3 -> gene_ENSMUSG00000026787_3 (table name in MySQL)
-	result = db.get_engine(current_app, modality+'_data').execute("SELECT gene_id FROM genes WHERE gene_id LIKE %s", (gene+"%",)).fetchone()
-	gene_table_name = 'gene_' + result['gene_id'].replace('.','_')
-
 	if smoothing and (modalityu=='ATAC'):
 		counts_type='smoothed_normalized_counts'
 	else:
 		counts_type='normalized_counts'
 
-	query = "SELECT cells.cell_id, cells.cell_name, cells.dataset, \
-		%(ensemble)s.annotation_%(modality)s, %(ensemble)s.cluster_%(modality)s, \
-		%(ensemble)s.tsne_x_%(modality)s, %(ensemble)s.tsne_y_%(modality)s, \
-		%(gene_table_name)s.%(counts_type)s as normalized_counts, \
-		datasets.target_region \
-		FROM cells \
-		INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
-		LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id \
-		LEFT JOIN datasets ON cells.dataset = datasets.dataset" % {'ensemble': ensemble,
-																'gene_table_name': gene_table_name,
-																'counts_type': counts_type,
-																'modality': modalityu}
+	store = open_ensemble(ensemble, modality)
+	if store is not None and store.has_gene(gene):
+		try:
+			df = gene_counts_from_store(store, gene, counts_type, modalityu, max_points=max_points)
+		except (KeyError, exc.ProgrammingError) as e:
+			_store_error('get_gene_snATAC', e)
+			return None
+	else:
+		# Gene ids may be missing the Ensembl version number, which the table name must include.
+		# Ex. ENSMUSG00000026787 -> gene_ENSMUSG00000026787_3 (table name in MySQL)
+		gene_table_name = gene_index(modality).table_name(gene)
+		if gene_table_name is None:
+			return None
+
+		query = "SELECT cells.cell_id, cells.cell_name, cells.dataset, \
+			%(ensemble)s.annotation_%(modality)s, %(ensemble)s.cluster_%(modality)s, \
+			%(ensemble)s.tsne_x_%(modality)s, %(ensemble)s.tsne_y_%(modality)s, \
+			%(gene_table_name)s.%(counts_type)s as normalized_counts, \
+			datasets.target_region \
+			FROM cells \
+			INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
+			LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id \
+			LEFT JOIN datasets ON cells.dataset = datasets.dataset" % {'ensemble': ensemble,
+																	'gene_table_name': gene_table_name,
+																	'counts_type': counts_type,
+																	'modality': modalityu}
 
-	if max_points.isdigit():
-		query = query+" ORDER BY RAND() LIMIT %(max_points)s" % {'max_points': max_points}
+		query = query+sample_clause(ensemble, max_points, modality)
 
-	try:
-		df = pd.read_sql(query, db.get_engine(current_app, '%s_data' % modality))
-	except exc.ProgrammingError as e:
-		now = datetime.datetime.now()
-		print("[{}] ERROR in app(get_gene_snATAC): {}".format(str(now), e))
-		sys.stdout.flush()
-		return None
+		try:
+			df = pd.read_sql(query, db.get_engine(current_app, '%s_data' % modality))
+		except exc.ProgrammingError as e:
+			now = datetime.datetime.now()
+			print("[{}] ERROR in app(get_gene_snATAC): {}".format(str(now), e))
+			sys.stdout.flush()
+			return None
 
 	if df.empty: # If no data in column, return None
 		now = datetime.datetime.now()
@@ -2474,15 +3131,25 @@ def get_gene_snATAC(ensemble, gene, grouping, outliers, smoothing=False, max_poi
 	return df
 
 def get_gene_snatac_from_mysql(ensemble, gene_table_name, counts_type, tsne_type, max_points='10000', modality='snATAC'):
-	"""Helper function to fetch a gene's snatac information from mysql.
+	"""Helper function to fetch a gene's snatac information from mysql,
+	or from the matrix store when the ensemble has been exported.
 
 	Returns:
 		DataFrame
 	"""
 
+	store = open_ensemble(ensemble, modality)
+	gene = gene_table_name.split('_')[1]
+	if store is not None and store.has_gene(gene):
+		try:
+			return gene_counts_from_store(store, gene, counts_type, modality.replace('snATAC','ATAC'), tsne=(tsne_type!='noTSNE'), max_points=max_points)
+		except (KeyError, exc.ProgrammingError) as e:
+			_store_error('get_gene_snatac_from_mysql', e)
+			return None
+
 	t0=datetime.datetime.now()
 	if tsne_type=='noTSNE':
-		query = "SELECT %(gene_table_name)s.%(counts_type)s as normalized_counts \
+		query = "SELECT %(ensemble)s.cell_id, %(gene_table_name)s.%(counts_type)s as normalized_counts \
 			FROM %(ensemble)s  \
 			LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id " % {'ensemble': ensemble, 
 			   'gene_table_name': gene_table_name,
@@ -2499,9 +3166,8 @@ def get_gene_snatac_from_mysql(ensemble, gene_table_name, counts_type, tsne_type
 			LEFT JOIN datasets ON cells.dataset = datasets.dataset" % {'ensemble': ensemble,
 																	   'gene_table_name': gene_table_name,
 																	   'counts_type': counts_type,
-																	   'modality': modality,}
-	if max_points.isdigit():
-		query = query+" ORDER BY RAND() LIMIT %(max_points)s" % {'max_points': max_points}
+																	   'modality': modality.replace('snATAC','ATAC'),}
+	query = query+sample_clause(ensemble, max_points, modality)
 
 	try:
 		df = pd.read_sql(query, db.get_engine(current_app, modality+'_data'))
@@ -2536,45 +3202,30 @@ def get_mult_gene_snATAC(ensemble, genes, grouping, smoothing=False, max_points=
 	if ";" in ensemble or ";" in grouping:
 		return None
 
-	genes = [gene+"%" for gene in genes]
-
-	# This query is just to fix gene id's missing the ensemble version number.
-	# Necessary because the table name must match exactly with whats on the MySQL database.
-	# Ex. ENSMUSG00000026787 is fixed to ENSMUSG00000026787.3
-	first_query = "SELECT gene_id FROM genes WHERE gene_id LIKE %s" + " OR gene_id LIKE %s" * (len(genes)-1)
-	result = db.get_engine(current_app, 'methylation_data').execute(first_query, (genes,)).fetchall()
-
-	gene_table_names = ['gene_' + gene_id[0].replace('.','_') for gene_id in result]
-
-	df_all = pd.DataFrame()
+	# Add the Ensembl version number the table names need. Ex. ENSMUSG00000026787 -> ENSMUSG00000026787.3
+	gene_ids = gene_index(modality).resolve(genes)
+	if not gene_ids:
+		return None
 
 	if smoothing:
 		counts_type='smoothed_normalized_counts'
 	else:
 		counts_type='normalized_counts'
 
-	t0=datetime.datetime.now()
-	df_list = []
-	df = get_gene_snatac_from_mysql(ensemble, gene_table_names[0], counts_type, 'TSNE', max_points)
-	df_all = df_all.append(df)
-	df_coords = df;
-	for gene_table_name in gene_table_names[1:]:
-		df_all = df_all.append(get_gene_snatac_from_mysql(ensemble, gene_table_name, counts_type, 'noTSNE', max_points))
-
-	t1=datetime.datetime.now()
-
-	t1=datetime.datetime.now()
+	store = open_store(ensemble, modality)
+	if store is None or not all(store.has_gene(gene_id) for gene_id in gene_ids):
+		store = None
+	df_coords = get_gene_snatac_from_mysql(ensemble, 'gene_'+gene_ids[0].replace('.','_'), counts_type, 'TSNE', max_points, modality)
 
-	if df_all.empty: # If no data in column, return None
+	if df_coords is None or df_coords.empty: # If no data in column, return None
 		now = datetime.datetime.now()
 		print("[{}] ERROR in app(get_gene_snATAC): No snATAC data for {}".format(str(now), ensemble))
 		sys.stdout.flush()
 		return None
 
-	df_all['normalized_counts'].fillna(0, inplace=True)
-
-	df_avg_methylation = df_all.groupby(by='cell_id', as_index=False)['normalized_counts'].mean()
-	df_coords.update(df_avg_methylation)
+	df_coords = average_gene_counts(df_coords, ensemble, gene_ids, counts_type, modality, max_points, store)
+	if df_coords is None:
+		return None
 
 	if grouping == 'annotation':
 		df_coords.fillna({'annotation_ATAC': 'None'}, inplace=True)
@@ -2586,7 +3237,7 @@ def get_mult_gene_snATAC(ensemble, genes, grouping, smoothing=False, max_points=
 	return df_coords
 
 @cache.memoize(timeout=1800)
-def get_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsne_outlier_bool, smoothing=False, max_points='10000', modality='mch'):
+def get_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsne_outlier_bool, smoothing=False, max_points='10000', modality='mch', output='html'):
 	"""Generate scatter plot of gene body features for any modality using tSNE coordinates
 
 	Arguments:
@@ -2598,9 +3249,10 @@ def get_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsne_ou
 		ptile_start (float): Lower end of color percentile. [0, 1].
 		ptile_end (float): Upper end of color percentile. [0, 1].
 		tsne_outlier_bool (bool): Whether or not to change X and Y axes range to hide outliers. True = show outliers.
+		output (str): 'html' for a Plot.ly div, 'json' for the figure data (see render_figure).
 
 	Returns:
-		str: HTML generated by Plot.ly.
+		str: HTML generated by Plot.ly, or dict for output='json'.
 	"""	
 	modalityu = modality.replace('snATAC','ATAC').replace('snRNA','RNA')
 
@@ -2610,6 +3262,11 @@ def get_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsne_ou
 
 	genes = genes_query.split()
 
+	# Raster mode plots every cell as pixels (see raster_scatter).
+	raster = max_points == 'raster'
+	if raster:
+		max_points = 'all'
+
 	gene_name_str = ""
 	x, y, text, mch = list(), list(), list(), list()
 
@@ -2665,6 +3322,7 @@ def get_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsne_ou
 	symbols = ['circle', 'square', 'cross', 'triangle-up', 'triangle-down', 'octagon', 'star', 'diamond']
 
 	traces_tsne = OrderedDict()
+	hover_tsne = OrderedDict()
 
 	legend_x = -.17
 	layout_width = 1100;
@@ -2699,6 +3357,17 @@ def get_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsne_ou
 	else:
 		marker_size = 4
 
+	if raster:
+		if grouping_clustering.startswith('cluster'):
+			group_names = ['cluster_' + str(group) for group in unique_groups]
+		elif grouping_clustering == "dataset":
+			group_names = [group.strip('CEMBA_') for group in unique_groups]
+		else:
+			group_names = [str(group) for group in unique_groups]
+		return raster_scatter(points, 'tsne_x_'+modalityu, 'tsne_y_'+modalityu, ((bottom_x, top_x), (bottom_y, top_y)),
+							  grouping_clustering, unique_groups, group_names, colors,
+							  'normalized_counts', 'Normalized Counts', ptile_start, ptile_end, title, grouping, output)
+
 	## 2D tSNE coordinates ##
 	for i, group in enumerate(unique_groups):
 	
@@ -2731,8 +3400,8 @@ def get_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsne_ou
 				   #'symbol': symbols[datasets.index(dataset)],
 			},
 			hoverinfo='text'))
-		trace2d['x'] = points_group['tsne_x_'+modalityu].values.tolist()
-		trace2d['y'] = points_group['tsne_y_'+modalityu].values.tolist()
+		trace2d['x'] = points_group['tsne_x_'+modalityu].values
+		trace2d['y'] = points_group['tsne_y_'+modalityu].values
 		# for point in points_group.itertuples(index=False):  # Maybe there's a more elegant way to do this... EAM
 		# 	text = OrderedDict([('Cluster', point[4]),('Dataset', point[2]),])
 		# 	if point[3]!='Null':
@@ -2740,46 +3409,34 @@ def get_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsne_ou
 		# 	if point[-1]!='None':
 		# 		text['RS2 Target Region'] = point[-1]
 		# 	trace2d['text'] = [build_hover_text(OrderedDict(text))]
-		trace2d['text'] = [build_hover_text(OrderedDict([('Annotation', point[3]),
-														 ('Cluster', point[4]),
-														 ('RS2 Target Region', point[-1]),
-														 ('Dataset', point[2]),]))
-						   for point in points_group.itertuples(index=False)]
+		hover_tsne[color_num] = set_hover(trace2d, points_group, [('Annotation', points.columns[3]),
+																  ('Cluster', points.columns[4]),
+																  ('RS2 Target Region', points.columns[-1]),
+																  ('Dataset', points.columns[2]),], output)
 
 	### snATAC normalized counts scatter plot ###
-	x = points['tsne_x_'+modalityu].tolist()
-	y = points['tsne_y_'+modalityu].tolist()
+	x = points['tsne_x_'+modalityu].values
+	y = points['tsne_y_'+modalityu].values
 	ATAC_counts = points['normalized_counts'].copy()
-	text_ATAC = [build_hover_text(OrderedDict([('Annotation', point[3]),
-											   ('Cluster', point[4]),
-											   ('RS2 Target Region', point[-1]),
-											   ('Dataset', point[2]),
-											   ('<b>Normalized Counts</b>', round(point[-2], 5)),]))
-				 for point in points.itertuples(index=False)]
+	hover_fields = [('Annotation', points.columns[3]),
+					('Cluster', points.columns[4]),
+					('RS2 Target Region', points.columns[-1]),
+					('Dataset', points.columns[2]),
+					('<b>Normalized Counts</b>', points.columns[-2], 5),]
 
 
-	ATAC_dataframe = pd.DataFrame(ATAC_counts)
-	start = ATAC_dataframe.dropna().quantile(ptile_start)[0].tolist()
-	end = ATAC_dataframe.dropna().quantile(ptile_end).values[0].tolist()
-	end = max(end,start+0.01)
-	ATAC_colors = [set_color_by_percentile(x, start, end) for x in ATAC_counts]
-
-	colorbar_tickval = list(arange(start, end, (end - start) / 4))
-	colorbar_tickval[0] = start
-	colorbar_tickval.append(end)
-	colorbar_ticktext = [
-		str(round(x, num_sigfigs_ticklabels)) for x in arange(start, end, (end - start) / 4)
-	]
-	colorbar_ticktext[0] = '<' + str(round(start, num_sigfigs_ticklabels))
-	colorbar_ticktext.append('>' + str(round(end, num_sigfigs_ticklabels)))
+	ATAC_colors, start, end = percentile_colors(ATAC_counts, ptile_start, ptile_end)
+	missing = np.isnan(ATAC_colors)
+	colorbar_tickval, colorbar_ticktext = colorbar_ticks(start, end)
 
 	trace_ATAC = Scatter(
 		mode='markers',
 		x=x,
 		y=y,
-		text=text_ATAC,
 		marker={
 			'color': ATAC_colors,
+			'cmin': start,
+			'cmax': end,
 			'colorscale': 'Viridis',
 			'size': marker_size,
 			'colorbar': {
@@ -2874,22 +3531,91 @@ def get_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsne_ou
 			subplot_titles=("tSNE colored by "+grouping, title),
 			)
 
+	trace_missing = split_missing_points(trace_ATAC, missing)
+	hover_missing = set_hover(trace_missing, points[missing], hover_fields, output)
+	hover_ATAC = set_hover(trace_ATAC, points[~missing], hover_fields, output)
+
 	for trace in traces_tsne.items():
 		fig.append_trace(trace[1], 1,1)
+	fig.append_trace(trace_missing, 1,2)
 	fig.append_trace(trace_ATAC, 1,2)
 
 	with open(log_file,'a') as f:
 		print(trace_ATAC, file=f)
 
 	fig['layout'].update(layout)
-	return plotly.offline.plot(
-		figure_or_data=fig,
-		output_type='div',
-		show_link=False,
-		include_plotlyjs=False)
+	return render_figure(fig, output, float32=True, hover=list(hover_tsne.values())+[hover_missing, hover_ATAC])
+
+def get_scatter_viewport(ensemble, tsne_type, genes_query, x_range=None, y_range=None, budget=10000, modality='methylation',
+	methylation_type='mCH', level='original', clustering='mCH_lv_npc50_k5', smoothing=False):
+	"""Cells of a 2D tSNE inside a box, up to a point budget, with their gene values (see spatial_index.py).
+
+	Arguments:
+		ensemble (str): Name of ensemble.
+		tsne_type (str): tSNE column suffix. ie. mCH_ndim2_perp20 for methylation, ATAC or RNA otherwise.
+		genes_query (str): Ensembl ID of gene(s) separated by spaces, averaged. Empty for no gene values.
+		x_range, y_range (tuple): (low, high) of the box. None for the whole embedding.
+		budget (int): Maximum number of cells returned.
+		modality (str): 'methylation', 'snATAC' or 'RNA'.
+		methylation_type (str): For methylation. "mCH", "mCG", or "mCA".
+		level (str): For methylation. "original" or "normalized" methylation values.
+		clustering (str): For methylation. Clustering the cells are labelled with.
+		smoothing (bool): For snATAC. Use smoothed normalized counts.
+
+	Returns:
+		dict: {'n_in_view', 'x', 'y', 'values', 'hoverdata'} with arrays encoded as in figure_json,
+			or None if the ensemble or tSNE type cannot be read.
+	"""
+	if ";" in ensemble or ";" in tsne_type or ";" in clustering:
+		return None
+	store, index = spatial_index(ensemble, tsne_type, modality)
+	if index is None:
+		return None
+	rows, n_in_view = index.query(x_range, y_range, budget)
+
+	if modality == 'methylation':
+		cluster_column, annotation_column = 'cluster_'+clustering, 'annotation_'+clustering
+	else:
+		cluster_column, annotation_column = 'cluster_'+tsne_type, 'annotation_'+tsne_type
+	context = methylation_type[1:]
+
+	values = []
+	try:
+		for gene in genes_query.split():
+			if not store.has_gene(gene):
+				continue
+			if modality == 'methylation':
+				gene_frame = cell_gene_values(store, gene, [methylation_type, context])
+				with np.errstate(invalid='ignore', divide='ignore'):
+					gene_values = gene_frame[methylation_type][rows] / gene_frame[context][rows]
+				if level != 'original':
+					gene_values = gene_values / store.cell_column('global_'+methylation_type, rows)
+			elif smoothing and modality == 'snATAC':
+				gene_values = cell_gene_values(store, gene, ['smoothed_normalized_counts'])['smoothed_normalized_counts'][rows]
+			else:
+				gene_values = cell_gene_values(store, gene, ['normalized_counts'])['normalized_counts'][rows]
+			values.append(gene_values)
+	except (KeyError, exc.ProgrammingError) as e:
+		_store_error('get_scatter_viewport', e)
+		return None
+
+	points = pd.DataFrame(OrderedDict((column, store.cell_column(column, rows))
+		for column in [cluster_column, annotation_column, 'dataset'] if column in store.meta['columns']))
+	fields = [(label, column) for label, column in [('Cluster', cluster_column), ('Annotation', annotation_column), ('Dataset', 'dataset')]
+		if column in points.columns]
+	result = {'n_in_view': int(n_in_view),
+			  'x': index.x[rows],
+			  'y': index.y[rows],
+			  'values': None,
+			  'hoverdata': hover_data(points, fields)}
+	if values:
+		with np.errstate(invalid='ignore', divide='ignore'):
+			result['values'] = np.nanmean(np.vstack(values), axis=0) if len(values) > 1 else values[0]
+	# Short arrays stay lists, whose NaN the Plot.ly encoder writes as null.
+	return json.loads(json.dumps(_encode_arrays(result, float32=True), cls=plotly.utils.PlotlyJSONEncoder))
 
 @cache.memoize(timeout=3600)
-def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row, query):
+def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row, query, output='html'):
 	"""Generate ATAC heatmap comparing multiple genes.
 
 	Arguments:
@@ -2899,9 +3625,10 @@ def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row
 		ptile_end (float): Upper end of color percentile. [0, 1].
 		normalize_row (bool): Whether to normalize by each row (gene).
 		query ([str]): Ensembl IDs of genes to display.
+		output (str): 'html' for a Plot.ly div, 'json' for the figure data (see render_figure).
 
 	Returns:
-		str: HTML generated by Plot.ly
+		str: HTML generated by Plot.ly, or dict for output='json'.
 	"""
 
 	if normalize_row:
@@ -2914,12 +3641,16 @@ def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row
 
 	gene_info_df = pd.DataFrame()
 	gene_infos = get_gene_by_id(genes)
+	summaries = get_cluster_summaries(ensemble, [gene['gene_id'] for gene in gene_infos], grouping, 'snATAC')
 	for i, gene in enumerate(gene_infos):
 		gene_name = gene['gene_name']
 		if i > 0 and i % 10 == 0:
 			title += "<br>"
 		title += gene_name + "+"
-		gene_info_df[gene_name] = mean_cluster(get_gene_snATAC(ensemble, gene['gene_id'], grouping, True), grouping, 'ATAC')
+		summary = summaries[gene['gene_id']]
+		if summary is None:
+			raise FailToGraphException
+		gene_info_df[gene_name] = summary['mean']
 
 	title = title[:-1] # Gets rid of last '+'
 
@@ -3124,14 +3855,11 @@ def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row
 												   'color': 'black',})])
 
 
-	return plotly.offline.plot(
+	return render_figure(
 		{
 			'data': [trace],
 			'layout': layout
-		},
-		output_type='div',
-		show_link=False,
-		include_plotlyjs=False)
+		}, output)
 
 ### RNA
 @cache.memoize(timeout=3600)
@@ -3156,32 +3884,39 @@ def get_gene_RNA(ensemble, gene, grouping, outliers, max_points='10000', smoothi
 	if ";" in ensemble or ";" in grouping:
 		return None
 
-	# This query is just to fix gene id's missing the ensemble version number.
-	# Necessary because the table name must match exactly with whats on the MySQL database.
-	# Ex. ENSMUSG00000026787 is fixed to ENSMUSG00000026787.3 -> gene_ENSMUSG00000026787_3 (table name in MySQL)
-	result = db.get_engine(current_app, 'RNA_data').execute("SELECT gene_id FROM genes WHERE gene_id LIKE %s", (gene+"%",)).fetchone()
-	gene_table_name = 'gene_' + result['gene_id'].replace('.','_')
-
-	query = "SELECT cells.cell_id, cells.cell_name, cells.dataset, \
-		%(ensemble)s.annotation_RNA, %(ensemble)s.cluster_RNA, \
-		%(ensemble)s.tsne_x_RNA, %(ensemble)s.tsne_y_RNA, \
-		%(gene_table_name)s.normalized_counts, \
-		datasets.target_region \
-		FROM cells \
-		INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
-		LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id \
-		LEFT JOIN datasets ON cells.dataset = datasets.dataset" % {'ensemble': ensemble,
-																   'gene_table_name': gene_table_name}
-	if max_points.isdigit():
-		query = query+" ORDER BY RAND() LIMIT %(max_points)s" % {'max_points': max_points}
+	store = open_ensemble(ensemble, 'RNA')
+	if store is not None and store.has_gene(gene):
+		try:
+			df = gene_counts_from_store(store, gene, 'normalized_counts', 'RNA', max_points=max_points)
+		except (KeyError, exc.ProgrammingError) as e:
+			_store_error('get_gene_RNA', e)
+			return None
+	else:
+		# Gene ids may be missing the Ensembl version number, which the table name must include.
+		# Ex. ENSMUSG00000026787 -> gene_ENSMUSG00000026787_3 (table name in MySQL)
+		gene_table_name = gene_index('RNA').table_name(gene)
+		if gene_table_name is None:
+			return None
 
-	try:
-		df = pd.read_sql(query, db.get_engine(current_app, 'RNA_data'))
-	except exc.ProgrammingError as e:
-		now = datetime.datetime.now()
-		print("[{}] ERROR in app(get_gene_RNA): {}".format(str(now), e))
-		sys.stdout.flush()
-		return None
+		query = "SELECT cells.cell_id, cells.cell_name, cells.dataset, \
+			%(ensemble)s.annotation_RNA, %(ensemble)s.cluster_RNA, \
+			%(ensemble)s.tsne_x_RNA, %(ensemble)s.tsne_y_RNA, \
+			%(gene_table_name)s.normalized_counts, \
+			datasets.target_region \
+			FROM cells \
+			INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
+			LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id \
+			LEFT JOIN datasets ON cells.dataset = datasets.dataset" % {'ensemble': ensemble,
+																	   'gene_table_name': gene_table_name}
+		query = query+sample_clause(ensemble, max_points, 'RNA')
+
+		try:
+			df = pd.read_sql(query, db.get_engine(current_app, 'RNA_data'))
+		except exc.ProgrammingError as e:
+			now = datetime.datetime.now()
+			print("[{}] ERROR in app(get_gene_RNA): {}".format(str(now), e))
+			sys.stdout.flush()
+			return None
 
 	if df.empty: # If no data in column, return None
 		now = datetime.datetime.now()
@@ -3222,20 +3957,20 @@ def get_mult_gene_RNA(ensemble, genes, grouping, max_points='10000'):
 	if ";" in ensemble or ";" in grouping:
 		return None
 
-	genes = [gene+"%" for gene in genes]
-
-	# This query is just to fix gene id's missing the ensemble version number.
-	# Necessary because the table name must match exactly with whats on the MySQL database.
-	# Ex. ENSMUSG00000026787 is fixed to ENSMUSG00000026787.3
-	first_query = "SELECT gene_id FROM genes WHERE gene_id LIKE %s" + " OR gene_id LIKE %s" * (len(genes)-1)
-	result = db.get_engine(current_app, 'methylation_data').execute(first_query, (genes,)).fetchall()
-
-	gene_table_names = ['gene_' + gene_id[0].replace('.','_') for gene_id in result]
-
-	df_all = pd.DataFrame()
+	# Add the Ensembl version number the table names need. Ex. ENSMUSG00000026787 -> ENSMUSG00000026787.3
+	gene_ids = gene_index('RNA').resolve(genes)
+	if not gene_ids:
+		return None
 
-	first = True
-	for gene_table_name in gene_table_names:
+	store = open_store(ensemble, 'RNA')
+	if store is not None and all(store.has_gene(gene_id) for gene_id in gene_ids):
+		try:
+			df_coords = gene_counts_from_store(store, gene_ids[0], 'normalized_counts', 'RNA', max_points=max_points)
+		except KeyError as e:
+			_store_error('get_mult_gene_RNA', e)
+			return None
+	else:
+		store = None
 		query = "SELECT cells.cell_id, cells.cell_name, cells.dataset, \
 			%(ensemble)s.annotation_RNA, %(ensemble)s.cluster_RNA, \
 			%(ensemble)s.tsne_x_RNA, %(ensemble)s.tsne_y_RNA, \
@@ -3245,32 +3980,26 @@ def get_mult_gene_RNA(ensemble, genes, grouping, max_points='10000'):
 			INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
 			LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id \
 			LEFT JOIN datasets ON cells.dataset = datasets.dataset" % {'ensemble': ensemble,
-																	   'gene_table_name': gene_table_name}
-		if max_points.isdigit():
-			query = query+" ORDER BY RAND() LIMIT %(max_points)s()" % {'max_points': max_points}
+																	   'gene_table_name': 'gene_'+gene_ids[0].replace('.','_')}
+		query = query+sample_clause(ensemble, max_points, 'RNA')
 
 		try:
-			df_all = df_all.append(pd.read_sql(query, db.get_engine(current_app, 'RNA_data')))
+			df_coords = pd.read_sql(query, db.get_engine(current_app, 'RNA_data'))
 		except exc.ProgrammingError as e:
 			now = datetime.datetime.now()
 			print("[{}] ERROR in app(get_mult_gene_RNA): {}".format(str(now), e))
 			sys.stdout.flush()
 			return None
 
-		if first:
-			df_coords = df_all
-		first = False
-
-	if df_all.empty: # If no data in column, return None
+	if df_coords.empty: # If no data in column, return None
 		now = datetime.datetime.now()
 		print("[{}] ERROR in app(get_gene_RNA): No RNA data for {}".format(str(now), ensemble))
 		sys.stdout.flush()
 		return None
 
-	df_all['normalized_counts'].fillna(0, inplace=True)
-
-	df_avg_methylation = df_all.groupby(by='cell_id', as_index=False)['normalized_counts'].mean()
-	df_coords.update(df_avg_methylation)
+	df_coords = average_gene_counts(df_coords, ensemble, gene_ids, 'normalized_counts', 'RNA', max_points, store)
+	if df_coords is None:
+		return None
 
 	if grouping == 'annotation':
 		df_coords.fillna({'annotation_RNA': 'None'}, inplace=True)
@@ -3282,7 +4011,7 @@ def get_mult_gene_RNA(ensemble, genes, grouping, max_points='10000'):
 	return df_coords
 
 @cache.memoize(timeout=1800)
-def get_RNA_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsne_outlier_bool, max_points='10000'):
+def get_RNA_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsne_outlier_bool, max_points='10000', output='html'):
 	"""Generate RNA scatter plot using tSNE coordinates from methylation(snmC-seq) data.
 
 	Arguments:
@@ -3294,12 +4023,14 @@ def get_RNA_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsn
 		ptile_start (float): Lower end of color percentile. [0, 1].
 		ptile_end (float): Upper end of color percentile. [0, 1].
 		tsne_outlier_bool (bool): Whether or not to change X and Y axes range to hide outliers. True = show outliers.
+		output (str): 'html' for a Plot.ly div, 'json' for the figure data (see render_figure).
 
 	Returns:
-		str: HTML generated by Plot.ly.
+		str: HTML generated by Plot.ly, or dict for output='json'.
 	"""
 
 	genes = genes_query.split()
+	max_points = point_sample(max_points)
 
 	gene_name_str = ""
 	x, y, text, mch = list(), list(), list(), list()
@@ -3353,6 +4084,7 @@ def get_RNA_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsn
 	symbols = ['circle', 'square', 'cross', 'triangle-up', 'triangle-down', 'octagon', 'star', 'diamond']
 
 	traces_tsne = OrderedDict()
+	hover_tsne = OrderedDict()
 
 	legend_x = -.17
 	layout_width = 1100;
@@ -3414,48 +4146,36 @@ def get_RNA_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsn
 				   #'symbol': symbols[datasets.index(dataset)],
 			},
 			hoverinfo='text'))
-		trace2d['x'] = points_group['tsne_x_RNA'].values.tolist()
-		trace2d['y'] = points_group['tsne_y_RNA'].values.tolist()
-		trace2d['text'] = [build_hover_text(OrderedDict([('Annotation', point[3]),
-														 ('Cluster', point[4]),
-														 ('RS2 Target Region', point[-1]),
-														 ('Dataset', point[2]),]))
-						   for point in points_group.itertuples(index=False)]
+		trace2d['x'] = points_group['tsne_x_RNA'].values
+		trace2d['y'] = points_group['tsne_y_RNA'].values
+		hover_tsne[color_num] = set_hover(trace2d, points_group, [('Annotation', points.columns[3]),
+																  ('Cluster', points.columns[4]),
+																  ('RS2 Target Region', points.columns[-1]),
+																  ('Dataset', points.columns[2]),], output)
 
 	### RNA normalized counts scatter plot ###
-	x = points['tsne_x_RNA'].tolist()
-	y = points['tsne_y_RNA'].tolist()
+	x = points['tsne_x_RNA'].values
+	y = points['tsne_y_RNA'].values
 	RNA_counts = points['normalized_counts'].copy()
-	text_RNA = [build_hover_text(OrderedDict([('Annotation', point[3]),
-											   ('Cluster', point[4]),
-											   ('RS2 Target Region', point[-1]),
-											   ('Dataset', point[2]),
-											   ('<b>Normalized Counts</b>', round(point[-2], 5)),]))
-				 for point in points.itertuples(index=False)]
+	hover_fields = [('Annotation', points.columns[3]),
+					('Cluster', points.columns[4]),
+					('RS2 Target Region', points.columns[-1]),
+					('Dataset', points.columns[2]),
+					('<b>Normalized Counts</b>', points.columns[-2], 5),]
 
 
-	RNA_dataframe = pd.DataFrame(RNA_counts)
-	start = RNA_dataframe.dropna().quantile(ptile_start)[0].tolist()
-	end = RNA_dataframe.dropna().quantile(ptile_end).values[0].tolist()
-	end = max(end,start+0.01)
-	RNA_colors = [set_color_by_percentile(x, start, end) for x in RNA_counts]
-
-	colorbar_tickval = list(arange(start, end, (end - start) / 4))
-	colorbar_tickval[0] = start
-	colorbar_tickval.append(end)
-	colorbar_ticktext = [
-		str(round(x, num_sigfigs_ticklabels)) for x in arange(start, end, (end - start) / 4)
-	]
-	colorbar_ticktext[0] = '<' + str(round(start, num_sigfigs_ticklabels))
-	colorbar_ticktext.append('>' + str(round(end, num_sigfigs_ticklabels)))
+	RNA_colors, start, end = percentile_colors(RNA_counts, ptile_start, ptile_end)
+	missing = np.isnan(RNA_colors)
+	colorbar_tickval, colorbar_ticktext = colorbar_ticks(start, end)
 
 	trace_RNA = Scatter(
 		mode='markers',
 		x=x,
 		y=y,
-		text=text_RNA,
 		marker={
 			'color': RNA_colors,
+			'cmin': start,
+			'cmax': end,
 			'colorscale': 'Viridis',
 			'size': marker_size,
 			'colorbar': {
@@ -3550,8 +4270,13 @@ def get_RNA_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsn
 			subplot_titles=("tSNE", "Normalized Counts"),
 			)
 
+	trace_missing = split_missing_points(trace_RNA, missing)
+	hover_missing = set_hover(trace_missing, points[missing], hover_fields, output)
+	hover_RNA = set_hover(trace_RNA, points[~missing], hover_fields, output)
+
 	for trace in traces_tsne.items():
 		fig.append_trace(trace[1], 1,1)
+	fig.append_trace(trace_missing, 1,2)
 	fig.append_trace(trace_RNA, 1,2)
 
 	fig['layout'].update(layout)
@@ -3578,14 +4303,10 @@ def get_RNA_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsn
 														  'color': 'black',})])
 	fig['layout']['annotations']=annotations
 
-	return plotly.offline.plot(
-		figure_or_data=fig,
-		output_type='div',
-		show_link=False,
-		include_plotlyjs=False)
+	return render_figure(fig, output, float32=True, hover=list(hover_tsne.values())+[hover_missing, hover_RNA])
 
 @cache.memoize(timeout=3600)
-def get_RNA_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row, query):
+def get_RNA_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row, query, output='html'):
 	"""Generate RNA heatmap comparing multiple genes.
 
 	Arguments:
@@ -3595,9 +4316,10 @@ def get_RNA_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row, q
 		ptile_end (float): Upper end of color percentile. [0, 1].
 		normalize_row (bool): Whether to normalize by each row (gene).
 		query ([str]): Ensembl IDs of genes to display.
+		output (str): 'html' for a Plot.ly div, 'json' for the figure data (see render_figure).
 
 	Returns:
-		str: HTML generated by Plot.ly
+		str: HTML generated by Plot.ly, or dict for output='json'.
 	"""
 
 	if normalize_row:
@@ -3610,12 +4332,16 @@ def get_RNA_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row, q
 
 	gene_info_df = pd.DataFrame()
 	gene_infos = get_gene_by_id(genes)
+	summaries = get_cluster_summaries(ensemble, [gene['gene_id'] for gene in gene_infos], grouping, 'RNA')
 	for i, gene in enumerate(gene_infos):
 		gene_name = gene['gene_name']
 		if i > 0 and i % 10 == 0:
 			title += "<br>"
 		title += gene_name + "+"
-		gene_info_df[gene_name] = mean_cluster(get_gene_RNA(ensemble, gene['gene_id'], grouping, True), grouping, 'RNA')
+		summary = summaries[gene['gene_id']]
+		if summary is None:
+			raise FailToGraphException
+		gene_info_df[gene_name] = summary['mean']
 
 	title = title[:-1] # Gets rid of last '+'
 
@@ -3820,12 +4546,9 @@ def get_RNA_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row, q
 												   'color': 'black',})])
 
 
-	return plotly.offline.plot(
+	return render_figure(
 		{
 			'data': [trace],
 			'layout': layout
-		},
-		output_type='div',
-		show_link=False,
-		include_plotlyjs=False)
+		}, output)
 
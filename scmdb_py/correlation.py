@@ -0,0 +1,130 @@
+"""On-demand gene-gene correlation over an ensemble's cluster summaries.
+
+Ensembles without a precomputed {ensemble}_correlated_genes table get their
+correlated genes from the {ensemble}_cluster_summary table written by
+precompute.build_cluster_summary: the median normalized mCH of every gene in
+every cluster is read once per process into a (genes, clusters) float32
+matrix whose rows are centered and scaled to unit length. The Pearson
+correlation of one gene with all others is then a single matrix-vector
+product, and the top k are picked with argpartition instead of a full sort.
+Spearman correlation uses the same product on per-gene cluster ranks.
+
+Matrices are reloaded when DATA_VERSION changes.
+"""
+import datetime
+import sys
+
+import numpy as np
+import pandas as pd
+from flask import current_app
+from sqlalchemy import exc
+
+from . import db
+from .matrix_store import versionless
+from .table_catalog import table_catalog
+
+# Summary the correlations are computed over, as written by build_cluster_summary.
+CORRELATION_MEASURE = 'mCH/CH_normalized'
+
+_matrices = {}
+
+
+def _unit_rows(values):
+    """Center each row and scale it to unit length, so row dot products are Pearson correlations.
+
+    Missing values (clusters without cells) count as the row mean. Constant rows become zero
+    and correlate 0 with every gene.
+    """
+    values = np.array(values, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        values -= np.nanmean(values, axis=1)[:, None]
+    values[np.isnan(values)] = 0
+    norms = np.sqrt((values ** 2).sum(axis=1))
+    norms[norms == 0] = 1
+    return (values / norms[:, None]).astype(np.float32)
+
+
+class CorrelationMatrix(object):
+    """Genes by clusters matrix of an ensemble, prepared for correlation queries.
+
+    Arguments:
+        gene_ids ([str]): Gene of each row.
+        values (array): (n_genes, n_clusters) summary values. NaN for clusters without cells.
+    """
+
+    def __init__(self, gene_ids, values):
+        self.gene_ids = list(gene_ids)
+        self.rows = {}
+        for i, gene_id in enumerate(self.gene_ids):
+            self.rows[gene_id] = i
+            self.rows.setdefault(versionless(gene_id), i)
+        self.matrices = {'pearson': _unit_rows(values),
+                         'spearman': _unit_rows(pd.DataFrame(values).rank(axis=1).values)}
+
+    def __len__(self):
+        return len(self.gene_ids)
+
+    def correlated(self, gene_id, limit=50, min_correlation=None, method='pearson'):
+        """Genes most correlated with a gene, highest correlation first.
+
+        Arguments:
+            gene_id (str): Versioned or versionless gene id.
+            limit (int): Maximum number of genes returned.
+            min_correlation (float): Only return genes correlated at least this much.
+            method (str): 'pearson' or 'spearman'.
+
+        Returns:
+            list: (gene_id, correlation) pairs. Empty for an unknown gene.
+        """
+        row = self.rows.get(gene_id)
+        if row is None or len(self) < 2:
+            return []
+        matrix = self.matrices[method]
+        corr = matrix.dot(matrix[row])
+        corr[row] = -np.inf
+
+        k = min(int(limit), len(self) - 1)
+        if k <= 0:
+            return []
+        top = np.argpartition(-corr, k - 1)[:k]
+        top = top[np.argsort(-corr[top], kind='mergesort')]
+        if min_correlation is not None:
+            top = top[corr[top] >= min_correlation]
+        return [(self.gene_ids[i], float(min(corr[i], 1.0))) for i in top]
+
+
+def correlation_matrix(ensemble):
+    """Correlation matrix of an ensemble's methylation cluster summaries, loaded on first use.
+
+    Reads the clustering with the most clusters. Returns None when the ensemble has no
+    cluster summary table.
+    """
+    version = current_app.config.get('DATA_VERSION')
+    cached = _matrices.get(ensemble)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    if ';' in ensemble or not table_catalog('methylation').has_table(ensemble + '_cluster_summary'):
+        return None
+
+    engine = db.get_engine(current_app, 'methylation_data')
+    try:
+        group_column = engine.execute("SELECT group_column FROM {}_cluster_summary \
+            WHERE measure = %s AND group_column LIKE 'cluster\\_%%' \
+            GROUP BY group_column ORDER BY COUNT(DISTINCT group_label) DESC LIMIT 1".format(ensemble),
+            (CORRELATION_MEASURE,)).fetchone()
+        if group_column is None:
+            return None
+        summary = pd.read_sql("SELECT gene_id, group_label, median FROM {}_cluster_summary \
+            WHERE measure = %s AND group_column = %s".format(ensemble), engine,
+            params=[CORRELATION_MEASURE, group_column[0]])
+    except exc.ProgrammingError as e:
+        now = datetime.datetime.now()
+        print("[{}] ERROR in app(correlation_matrix): {}".format(str(now), e))
+        sys.stdout.flush()
+        return None
+
+    values = summary.pivot(index='gene_id', columns='group_label', values='median')
+    matrix = CorrelationMatrix(values.index, values.values)
+    _matrices[ensemble] = (version, matrix)
+    return matrix
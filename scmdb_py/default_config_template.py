@@ -32,6 +32,55 @@ MYSQL_SERVER_NAME = 'localhost'
 SQLALCHEMY_BINDS = {'methylation_data': 'mysql://' + MYSQL_USER + ':' + MYSQL_PW + '@' + MYSQL_SERVER_NAME + '/' + MYSQL_DB_methylation,
                     'snATAC_data': 'mysql://' + MYSQL_USER + ':' + MYSQL_PW + '@' + MYSQL_SERVER_NAME + '/' + MYSQL_DB_snATAC}
 
+# Directory of the columnar gene matrix store (see scmdb_py/matrix_store.py).
+# Leave blank to always query MySQL. Build with `python manage.py build_matrix_store <ensemble>`.
+MATRIX_STORE_DIR = ''
+
+# Ensembles not in the matrix store keep their cell metadata in memory (see scmdb_py/cell_cache.py),
+# so a gene query only reads the gene table. At most CELL_METADATA_ENSEMBLES per process.
+CELL_METADATA_CACHE = True
+CELL_METADATA_ENSEMBLES = 8
+# Directory writable by the web server where the cell metadata is published once and
+# memory-mapped by every WSGI worker. Leave blank to keep a copy per worker process.
+CELL_METADATA_DIR = ''
+
+# Pixels along each side of the grid that 'All cells (density)' scatter plots bin cells into
+# (see scmdb_py/raster.py).
+RASTER_SIZE = 200
+
+# Largest point budget accepted by /api/scatter/viewport/ (see scmdb_py/spatial_index.py).
+VIEWPORT_MAX_POINTS = 50000
+
+# Directory of the pre-rendered tSNE tile pyramids served under /tiles/ (see scmdb_py/tiles.py).
+# Build with `python manage.py build_tiles <ensemble> -t <tsne_type>`. Tiles are sent with
+# Cache-Control max-age TILE_CACHE_TIMEOUT seconds.
+TILE_DIR = ''
+TILE_CACHE_TIMEOUT = 31536000
+
+# Directory of the per-ensemble option catalogs (see scmdb_py/catalog.py).
+# Leave blank to introspect ensembles in MySQL. Build with `python manage.py build_catalog <ensemble>`.
+CATALOG_DIR = ''
+
+# Memoized query results are cached per process by default ('simple').
+# To share them between WSGI workers, use a backend from scmdb_py/cache_backends.py:
+#CACHE_TYPE = 'scmdb_py.cache_backends.redis'
+#CACHE_REDIS_URL = 'redis://localhost:6379/1'
+#CACHE_TYPE = 'scmdb_py.cache_backends.filesystem'
+#CACHE_DIR = '/var/cache/scmdb_py'
+CACHE_THRESHOLD = 1000
+
+# Bump after reloading the MySQL databases so cached results are not reused.
+DATA_VERSION = 1
+
+# Seconds before the in-process list of tables and ensembles of each database, and the
+# gene index, are re-read (see scmdb_py/table_catalog.py and scmdb_py/gene_index.py).
+# Bumping DATA_VERSION also reloads them.
+CATALOG_REFRESH = 600
+
+# Seed for ORDER BY RAND() when an ensemble has no precomputed sample_rank column
+# (`python manage.py build_sample_rank <ensemble>`).
+SAMPLE_SEED = 0
+
 # Enable protection agains *Cross-site Request Forgery (CSRF)*
 CSRF_ENABLED = True
 
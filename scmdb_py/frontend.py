@@ -9,7 +9,7 @@ import datetime
 
 import dominate
 from dominate.tags import img
-from flask import Blueprint, render_template, jsonify, request, redirect, current_app, flash, abort, url_for
+from flask import Blueprint, render_template, jsonify, request, redirect, current_app, flash, abort, url_for, send_file
 from flask_login import (current_user, login_required, login_user,
                          logout_user, LoginManager)
 from flask_mail import Mail, Message
@@ -20,6 +20,7 @@ from . import nav, cache, db, mail
 from .content import *
 from .decorators import admin_required
 from .email import send_email
+from .tiles import tile_file, tile_meta
 from .forms import LoginForm, ChangeUserEmailForm, ChangeAccountTypeForm, InviteUserForm, CreatePasswordForm, NewUserForm, RequestResetPasswordForm, ResetPasswordForm, ChangePasswordForm
 from .user import User, Role
 
@@ -32,6 +33,20 @@ frontend = Blueprint('frontend', __name__, template_folder="templates", static_f
 def favicon():
     return ('', 204)
 
+def plot_response(result, output):
+    """Return a plot function's result: the HTML div as is, or the figure JSON for /api/ routes.
+
+    A tuple rather than a Response so that memoized views can cache it.
+    """
+    if output == 'json':
+        return (json.dumps(result, separators=(',', ':')), 200, {'Content-Type': 'application/json'})
+    return result
+
+def plot_error(message, output):
+    if output == 'json':
+        return (json.dumps({'error': message}), 500, {'Content-Type': 'application/json'})
+    return message
+
 #Visitor routes
 @frontend.route('/')
 def index():
@@ -55,9 +70,10 @@ def ensemble(ensemble_id='Ens218'):
     if ensemble_id=='MOp_MiniAtlas_SCF':
         ensemble_id='Ens218'
     ensemble_info = get_ensemble_info(ensemble_id=ensemble_id)
-    snATAC_included = ensemble_exists(ensemble_info['ensemble_id'], modality='snATAC')
-    methylation_included = ensemble_exists(ensemble_info['ensemble_id'], modality='methylation')
-    RNA_included = ensemble_exists(ensemble_info['ensemble_id'],modality='RNA')
+    modalities = ensemble_modalities(ensemble_info['ensemble_id'])
+    snATAC_included = modalities['snATAC']
+    methylation_included = modalities['methylation']
+    RNA_included = modalities['RNA']
     ensemble_name = str(ensemble_info['ensemble_name'])
     RS2_included = 0
     if 'RS2' in ensemble_info['datasets']:
@@ -140,8 +156,9 @@ def nav_bar_screen():
 
 
 # API routes
-@frontend.route('/plot/methylation/scatter/<ensemble>/<tsne_type>/<methylation_type>/<level>/<grouping>/<clustering>/<ptile_start>/<ptile_end>/<tsne_outlier>/<max_points>')
-def plot_methylation_scatter(ensemble, tsne_type, methylation_type, level, grouping, clustering, ptile_start, ptile_end, tsne_outlier, max_points):
+@frontend.route('/plot/methylation/scatter/<ensemble>/<tsne_type>/<methylation_type>/<level>/<grouping>/<clustering>/<ptile_start>/<ptile_end>/<tsne_outlier>/<max_points>', defaults={'output': 'html'})
+@frontend.route('/api/methylation/scatter/<ensemble>/<tsne_type>/<methylation_type>/<level>/<grouping>/<clustering>/<ptile_start>/<ptile_end>/<tsne_outlier>/<max_points>', defaults={'output': 'json'})
+def plot_methylation_scatter(ensemble, tsne_type, methylation_type, level, grouping, clustering, ptile_start, ptile_end, tsne_outlier, max_points, output='html'):
 
     genes = request.args.get('q', 'MustHaveAQueryString')
     if tsne_type == 'null':
@@ -156,7 +173,7 @@ def plot_methylation_scatter(ensemble, tsne_type, methylation_type, level, group
         tsne_outlier_bool = True
 
     try:
-        return get_methylation_scatter(ensemble,
+        return plot_response(get_methylation_scatter(ensemble,
                                        tsne_type,
                                        methylation_type,
                                        genes,
@@ -166,13 +183,15 @@ def plot_methylation_scatter(ensemble, tsne_type, methylation_type, level, group
                                        float(ptile_start),
                                        float(ptile_end),
                                        tsne_outlier_bool,
-                                       max_points)
+                                       max_points,
+                                       output=output), output)
     except FailToGraphException:
-        return "Failed to generate methylation tsne scatter plots for {}, please contact maintainer".format(ensemble)
+        return plot_error("Failed to generate methylation tsne scatter plots for {}, please contact maintainer".format(ensemble), output)
 
 
-@frontend.route('/plot/snATAC/scatter/<ensemble>/<grouping>/<ptile_start>/<ptile_end>/<tsne_outlier>/<smoothing>/<max_points>')
-def plot_snATAC_scatter(ensemble, grouping, ptile_start, ptile_end, tsne_outlier, smoothing, max_points):
+@frontend.route('/plot/snATAC/scatter/<ensemble>/<grouping>/<ptile_start>/<ptile_end>/<tsne_outlier>/<smoothing>/<max_points>', defaults={'output': 'html'})
+@frontend.route('/api/snATAC/scatter/<ensemble>/<grouping>/<ptile_start>/<ptile_end>/<tsne_outlier>/<smoothing>/<max_points>', defaults={'output': 'json'})
+def plot_snATAC_scatter(ensemble, grouping, ptile_start, ptile_end, tsne_outlier, smoothing, max_points, output='html'):
 
     genes_query = request.args.get('q', 'MustHaveAQueryString')
     if grouping == 'NaN' or grouping == 'null':
@@ -187,7 +206,7 @@ def plot_snATAC_scatter(ensemble, grouping, ptile_start, ptile_end, tsne_outlier
         smoothing_bool = True
 
     try:
-        return get_scatter(ensemble,
+        return plot_response(get_scatter(ensemble,
                                   genes_query,
                                   grouping,
                                   float(ptile_start),
@@ -195,13 +214,15 @@ def plot_snATAC_scatter(ensemble, grouping, ptile_start, ptile_end, tsne_outlier
                                   tsne_outlier_bool=tsne_outlier_bool,
                                   smoothing=smoothing_bool,
                                   max_points=max_points,
-                                  modality='snATAC')
+                                  modality='snATAC',
+                                  output=output), output)
     except FailToGraphException:
-        return "Failed to load snATAC-seq data for {}, please contact maintainer".format(ensemble)
+        return plot_error("Failed to load snATAC-seq data for {}, please contact maintainer".format(ensemble), output)
 
 
-@frontend.route('/plot/RNA/scatter/<ensemble>/<grouping>/<ptile_start>/<ptile_end>/<tsne_outlier>/<max_points>')
-def plot_RNA_scatter(ensemble, grouping, ptile_start, ptile_end, tsne_outlier, max_points):
+@frontend.route('/plot/RNA/scatter/<ensemble>/<grouping>/<ptile_start>/<ptile_end>/<tsne_outlier>/<max_points>', defaults={'output': 'html'})
+@frontend.route('/api/RNA/scatter/<ensemble>/<grouping>/<ptile_start>/<ptile_end>/<tsne_outlier>/<max_points>', defaults={'output': 'json'})
+def plot_RNA_scatter(ensemble, grouping, ptile_start, ptile_end, tsne_outlier, max_points, output='html'):
 
     genes_query = request.args.get('q', 'MustHaveAQueryString')
     if grouping == 'NaN' or grouping == 'null':
@@ -212,7 +233,7 @@ def plot_RNA_scatter(ensemble, grouping, ptile_start, ptile_end, tsne_outlier, m
         tsne_outlier_bool = True
 
     try:
-        return get_scatter(ensemble,
+        return plot_response(get_scatter(ensemble,
                             genes_query,
                             grouping,
                             float(ptile_start),
@@ -220,13 +241,59 @@ def plot_RNA_scatter(ensemble, grouping, ptile_start, ptile_end, tsne_outlier, m
                             smoothing=False,
                             tsne_outlier_bool=tsne_outlier_bool,
                             max_points=max_points,
-                            modality='snRNA')
+                            modality='snRNA',
+                            output=output), output)
     except FailToGraphException:
-        return "Failed to load RNA-seq data for {}, please contact maintainer".format(ensemble)
+        return plot_error("Failed to load RNA-seq data for {}, please contact maintainer".format(ensemble), output)
+
+@frontend.route('/api/scatter/viewport/<modality>/<ensemble>/<tsne_type>')
+def scatter_viewport(modality, ensemble, tsne_type):
+    """Cells of a 2D tSNE inside the box x0..x1, y0..y1 (whole embedding if omitted), at most budget of them."""
+    if modality not in ['methylation', 'snATAC', 'RNA']:
+        abort(404)
+    x0, x1 = request.args.get('x0', type=float), request.args.get('x1', type=float)
+    y0, y1 = request.args.get('y0', type=float), request.args.get('y1', type=float)
+    budget = min(max(request.args.get('budget', 10000, type=int), 0),
+                 current_app.config.get('VIEWPORT_MAX_POINTS', 50000))
+
+    result = get_scatter_viewport(ensemble,
+                                  tsne_type,
+                                  request.args.get('q', ''),
+                                  (x0, x1) if x0 is not None and x1 is not None else None,
+                                  (y0, y1) if y0 is not None and y1 is not None else None,
+                                  budget,
+                                  modality=modality,
+                                  methylation_type=request.args.get('methylation_type', 'mCH'),
+                                  level=request.args.get('level', 'original'),
+                                  clustering=request.args.get('clustering', 'mCH_lv_npc50_k5'),
+                                  smoothing=request.args.get('smoothing') == 'true')
+    if result is None:
+        return plot_error("Failed to load {} tSNE {} for {}, please contact maintainer".format(modality, tsne_type, ensemble), 'json')
+    return plot_response(result, 'json')
+
+
+@frontend.route('/tiles/<ensemble>/<tsne_type>/meta.json')
+def tsne_tiles_meta(ensemble, tsne_type):
+    meta = tile_meta(ensemble, tsne_type)
+    if meta is None:
+        abort(404)
+    return jsonify(meta)
+
+
+@frontend.route('/tiles/<ensemble>/<tsne_type>/<int:z>/<int:x>/<int:y>')
+@frontend.route('/tiles/<ensemble>/<tsne_type>/<int:z>/<int:x>/<int:y>.png')
+def tsne_tile(ensemble, tsne_type, z, x, y):
+    # Tiles only change when the pyramid is rebuilt, and clients then request them with a new ?v=.
+    path = tile_file(ensemble, tsne_type, z, x, y)
+    if path is None:
+        abort(404)
+    return send_file(path, mimetype='image/png', conditional=True,
+                     cache_timeout=current_app.config.get('TILE_CACHE_TIMEOUT', 31536000))
 
-@frontend.route('/plot/methylation/box/<ensemble>/<methylation_type>/<gene>/<grouping>/<clustering>/<level>/<outliers_toggle>/<max_points>')
+@frontend.route('/plot/methylation/box/<ensemble>/<methylation_type>/<gene>/<grouping>/<clustering>/<level>/<outliers_toggle>/<max_points>', defaults={'output': 'html'})
+@frontend.route('/api/methylation/box/<ensemble>/<methylation_type>/<gene>/<grouping>/<clustering>/<level>/<outliers_toggle>/<max_points>', defaults={'output': 'json'})
 @cache.memoize(timeout=3600)
-def plot_mch_box(ensemble, methylation_type, gene, grouping, clustering, level, outliers_toggle, max_points):
+def plot_mch_box(ensemble, methylation_type, gene, grouping, clustering, level, outliers_toggle, max_points, output='html'):
 
     if outliers_toggle == 'outliers':
         outliers = True
@@ -236,16 +303,19 @@ def plot_mch_box(ensemble, methylation_type, gene, grouping, clustering, level,
         clustering = 'mCH_lv_npc50_k5'
     if grouping == 'NaN' or grouping == 'null':
         grouping = 'annotation'
+    # Box plots have no density mode; 'All cells (density)' shows the default sample.
+    max_points = point_sample(max_points)
 
     try:
         # return get_mch_box(ensemble, methylation_type, gene, grouping, clustering, level, outliers, max_points)
-        return get_boxplot(ensemble=ensemble, gene=gene, grouping=grouping, outliers=outliers, modality='methylation', 
+        return plot_response(get_boxplot(ensemble=ensemble, gene=gene, grouping=grouping, outliers=outliers, modality='methylation', 
             methylation_type=methylation_type, clustering=clustering, level=level, 
-            max_points=max_points, smoothing=False)
+            max_points=max_points, smoothing=False,
+            output=output), output)
     except (FailToGraphException, ValueError) as e:
         with open(log_file,'a') as f:
             print("ERROR (plot_mch_box): {}".format(e), file=f)
-        return 'Failed to produce mCH levels box plot. Contact maintainer.'
+        return plot_error('Failed to produce mCH levels box plot. Contact maintainer.', output)
 
 # @frontend.route('/plot/clusters/bar/<ensemble>/<grouping>/<clustering>/<outliers_toggle>')
 # @cache.memoize(timeout=3600)
@@ -266,9 +336,10 @@ def plot_mch_box(ensemble, methylation_type, gene, grouping, clustering, level,
 #         print("ERROR (plot_mch_box): {}".format(e))
 #         return 'Failed to produce mCH levels box plot. Contact maintainer.'
 
-@frontend.route('/plot/clusters/bar/<ensemble>/<grouping>/<clustering>/<normalize>')
+@frontend.route('/plot/clusters/bar/<ensemble>/<grouping>/<clustering>/<normalize>', defaults={'output': 'html'})
+@frontend.route('/api/clusters/bar/<ensemble>/<grouping>/<clustering>/<normalize>', defaults={'output': 'json'})
 @cache.memoize(timeout=3600)
-def plot_clusters_bar(ensemble, grouping, clustering, normalize):
+def plot_clusters_bar(ensemble, grouping, clustering, normalize, output='html'):
 
     if clustering == 'null':
         clustering = 'mCH_lv_npc50_k5'
@@ -276,16 +347,17 @@ def plot_clusters_bar(ensemble, grouping, clustering, normalize):
         grouping = 'annotation'
 
     try:
-        return get_clusters_bar(ensemble, grouping, clustering, normalize) # EAM - testing
+        return plot_response(get_clusters_bar(ensemble, grouping, clustering, normalize, output=output), output) # EAM - testing
     except (FailToGraphException, ValueError) as e:
         with open(log_file,'a') as f:
             print("ERROR (plot_clusters_bar): {}".format(e),file=f)
-        return 'Failed to produce clusters bar plot. Contact maintainer.'
+        return plot_error('Failed to produce clusters bar plot. Contact maintainer.', output)
 
 
-@frontend.route('/plot/snATAC/box/<ensemble>/<gene>/<grouping>/<outliers_toggle>')
+@frontend.route('/plot/snATAC/box/<ensemble>/<gene>/<grouping>/<outliers_toggle>', defaults={'output': 'html'})
+@frontend.route('/api/snATAC/box/<ensemble>/<gene>/<grouping>/<outliers_toggle>', defaults={'output': 'json'})
 @cache.memoize(timeout=3600)
-def plot_snATAC_box(ensemble, gene, grouping, outliers_toggle):
+def plot_snATAC_box(ensemble, gene, grouping, outliers_toggle, output='html'):
 
     outliers = (outliers_toggle=='outliers')
     if grouping == 'NaN' or grouping == 'null':
@@ -293,16 +365,18 @@ def plot_snATAC_box(ensemble, gene, grouping, outliers_toggle):
 
     try:
         # return get_snATAC_box(ensemble, gene, grouping, outliers)
-        return get_boxplot(ensemble=ensemble, gene=gene, grouping=grouping, 
-            outliers=outliers, modality='snATAC', clustering='lv')
+        return plot_response(get_boxplot(ensemble=ensemble, gene=gene, grouping=grouping, 
+            outliers=outliers, modality='snATAC', clustering='lv',
+            output=output), output)
     except (FailToGraphException, ValueError) as e:
         with open(log_file,'a') as f:
             print("ERROR (plot_snATAC_box): {}".format(e),file=f)
-        return 'Failed to produce snATAC normalized counts box plot. Contact maintainer.'
+        return plot_error('Failed to produce snATAC normalized counts box plot. Contact maintainer.', output)
 
-@frontend.route('/plot/RNA/box/<ensemble>/<gene>/<grouping>/<outliers_toggle>')
+@frontend.route('/plot/RNA/box/<ensemble>/<gene>/<grouping>/<outliers_toggle>', defaults={'output': 'html'})
+@frontend.route('/api/RNA/box/<ensemble>/<gene>/<grouping>/<outliers_toggle>', defaults={'output': 'json'})
 @cache.memoize(timeout=3600)
-def plot_RNA_box(ensemble, gene, grouping, outliers_toggle):
+def plot_RNA_box(ensemble, gene, grouping, outliers_toggle, output='html'):
 
     outliers = (outliers_toggle=='outliers')
     if grouping == 'NaN' or grouping == 'null':
@@ -310,11 +384,11 @@ def plot_RNA_box(ensemble, gene, grouping, outliers_toggle):
 
     try:
         # return get_RNA_box(ensemble, gene, grouping, outliers)
-        return get_boxplot(ensemble, gene, grouping, outliers, modality='RNA')
+        return plot_response(get_boxplot(ensemble, gene, grouping, outliers, modality='RNA', output=output), output)
     except (FailToGraphException, ValueError) as e:
         with open(log_file,'a') as f:
             print("ERROR (plot_RNA_box): {}".format(e),file=f)
-        return 'Failed to produce RNA normalized counts box plot. Contact maintainer.'
+        return plot_error('Failed to produce RNA normalized counts box plot. Contact maintainer.', output)
 
 
 # @frontend.route('/plot/box_combined/<methylation_type>/<gene_mmu>/<gene_hsa>/<level>/<outliers_toggle>')
@@ -331,8 +405,9 @@ def plot_RNA_box(ensemble, gene, grouping, outliers_toggle):
 #         return 'Failed to produce mCH levels box plot. Contact maintainer.'
 
 
-@frontend.route('/plot/methylation/heat/<ensemble>/<methylation_type>/<grouping>/<clustering>/<level>/<ptile_start>/<ptile_end>')
-def plot_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, ptile_start, ptile_end):
+@frontend.route('/plot/methylation/heat/<ensemble>/<methylation_type>/<grouping>/<clustering>/<level>/<ptile_start>/<ptile_end>', defaults={'output': 'html'})
+@frontend.route('/api/methylation/heat/<ensemble>/<methylation_type>/<grouping>/<clustering>/<level>/<ptile_start>/<ptile_end>', defaults={'output': 'json'})
+def plot_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, ptile_start, ptile_end, output='html'):
 
     query = request.args.get('q', 'MustHaveAQueryString')
 
@@ -346,14 +421,15 @@ def plot_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pt
     else:
         normalize_row = False
     try:
-        return get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, float(ptile_start), float(ptile_end), normalize_row, query)
+        return plot_response(get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, float(ptile_start), float(ptile_end), normalize_row, query, output=output), output)
     except (FailToGraphException, ValueError) as e:
         print("ERROR (plot_mch_heatmap): {}".format(e))
-        return 'Failed to produce mCH levels heatmap plot. Contact maintainer. '.format(e)
+        return plot_error('Failed to produce mCH levels heatmap plot. Contact maintainer. '.format(e), output)
 
 
-@frontend.route('/plot/snATAC/heat/<ensemble>/<grouping>/<ptile_start>/<ptile_end>')
-def plot_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end):
+@frontend.route('/plot/snATAC/heat/<ensemble>/<grouping>/<ptile_start>/<ptile_end>', defaults={'output': 'html'})
+@frontend.route('/api/snATAC/heat/<ensemble>/<grouping>/<ptile_start>/<ptile_end>', defaults={'output': 'json'})
+def plot_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, output='html'):
 
     query = request.args.get('q', 'MustHaveAQueryString')
 
@@ -365,14 +441,15 @@ def plot_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end):
     else:
         normalize_row = False
     try:
-        return get_snATAC_heatmap(ensemble, grouping, float(ptile_start), float(ptile_end), normalize_row, query)
+        return plot_response(get_snATAC_heatmap(ensemble, grouping, float(ptile_start), float(ptile_end), normalize_row, query, output=output), output)
     except (FailToGraphException, ValueError) as e:
         print("ERROR (plot_snATAC_heatmap): {}".format(e))
-        return 'Failed to produce snATAC normalized counts heatmap plot. Contact maintainer.'
+        return plot_error('Failed to produce snATAC normalized counts heatmap plot. Contact maintainer.', output)
 
 
-@frontend.route('/plot/RNA/heat/<ensemble>/<grouping>/<ptile_start>/<ptile_end>')
-def plot_RNA_heatmap(ensemble, grouping, ptile_start, ptile_end):
+@frontend.route('/plot/RNA/heat/<ensemble>/<grouping>/<ptile_start>/<ptile_end>', defaults={'output': 'html'})
+@frontend.route('/api/RNA/heat/<ensemble>/<grouping>/<ptile_start>/<ptile_end>', defaults={'output': 'json'})
+def plot_RNA_heatmap(ensemble, grouping, ptile_start, ptile_end, output='html'):
 
     query = request.args.get('q', 'MustHaveAQueryString')
 
@@ -384,10 +461,10 @@ def plot_RNA_heatmap(ensemble, grouping, ptile_start, ptile_end):
     else:
         normalize_row = False
     try:
-        return get_RNA_heatmap(ensemble, grouping, float(ptile_start), float(ptile_end), normalize_row, query)
+        return plot_response(get_RNA_heatmap(ensemble, grouping, float(ptile_start), float(ptile_end), normalize_row, query, output=output), output)
     except (FailToGraphException, ValueError) as e:
         print("ERROR (plot_RNA_heatmap): {}".format(e))
-        return 'Failed to produce RNA normalized counts heatmap plot. Contact maintainer.'
+        return plot_error('Failed to produce RNA normalized counts heatmap plot. Contact maintainer.', output)
 
 
 # @frontend.route('/plot/heat_two_ensemble/<ensemble>/<methylation_type>/<level>/<ptile_start>/<ptile_end>')
@@ -410,7 +487,15 @@ def search_gene_by_name():
         return jsonify([])
     else:
         query = query.split(' ')
-        return jsonify(get_gene_by_name(query))
+        # Genes are only greyed out when none of the ensemble's databases has data for them.
+        modalities = None
+        ensemble = request.args.get('ensemble')
+        if ensemble:
+            modalities = [modality for modality, included in ensemble_modalities(ensemble.lower().replace('ens', '')).items()
+                          if included]
+        # Each match is checked against the ensemble's catalogs, so large limits are capped.
+        limit = min(max(request.args.get('limit', 50, type=int), 0), 200)
+        return jsonify(get_gene_by_name(query, limit, modalities))
 
 
 @frontend.route('/gene/names/exact')
@@ -466,9 +551,13 @@ def cluster_specific_marker_genes(ensemble, clustering):
 
 
 @frontend.route('/gene/corr/<ensemble>/<gene_id>')
-@cache.memoize(timeout=3600)
 def correlated_genes(ensemble, gene_id):
-    return jsonify(get_corr_genes(ensemble, gene_id))
+    limit = max(request.args.get('limit', 50, type=int), 0)
+    min_correlation = request.args.get('min_correlation', None, type=float)
+    method = request.args.get('method', 'pearson')
+    if method not in ['pearson', 'spearman']:
+        return jsonify([])
+    return jsonify(get_corr_genes(ensemble, gene_id, limit, min_correlation, method))
 
 
 @frontend.route('/plot/delete_cache/<ensemble>/<grouping>')
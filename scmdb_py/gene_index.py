@@ -0,0 +1,159 @@
+"""In-process index of the genes table.
+
+Gene ids from the client usually lack the Ensembl version number
+(ENSMUSG00000026787) while gene tables are named after the versioned id
+(gene_ENSMUSG00000026787_3). Rather than a `gene_id LIKE 'ENSMUSG...%'` query
+per request, each database's genes table is read once per process into a dict
+keyed by both the versioned and the versionless id.
+
+The same index serves gene name search for the select2 autocomplete: a sorted
+array of lowercased names for exact and prefix matches and a trigram index for
+substring matches.
+
+Indexes are reloaded after CATALOG_REFRESH seconds (default 600), like the
+table catalog, or when DATA_VERSION changes.
+"""
+import datetime
+import sys
+import time
+from bisect import bisect_left
+
+import pandas as pd
+from flask import current_app
+from sqlalchemy import exc
+
+from . import db
+from .matrix_store import versionless
+
+_indexes = {}
+
+
+class GeneIndex(object):
+    """Genes table rows by gene id.
+
+    Arguments:
+        genes (DataFrame): The genes table. Columns are gene_id, gene_name, chr, start, end, strand, gene_type.
+    """
+
+    def __init__(self, genes):
+        self.records = genes.to_dict('records')
+        self.by_id = {}
+        for record in self.records:
+            self.by_id[record['gene_id']] = record
+        for record in self.records:
+            self.by_id.setdefault(versionless(record['gene_id']), record)
+
+        # Name search. Rows are positions in self.records.
+        self.names = [str(record.get('gene_name') or '').lower() for record in self.records]
+        self.by_name = {}
+        self.trigrams = {}
+        for i, name in enumerate(self.names):
+            if not name:
+                continue
+            self.by_name.setdefault(name, []).append(i)
+            for trigram in set(name[j:j+3] for j in range(len(name) - 2)):
+                self.trigrams.setdefault(trigram, []).append(i)
+        sorted_names = sorted((name, i) for i, name in enumerate(self.names) if name)
+        self.name_keys = [name for name, i in sorted_names]
+        self.name_rows = [i for name, i in sorted_names]
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, gene_id):
+        """Row of a versioned or versionless gene id, or None."""
+        return self.by_id.get(gene_id)
+
+    def records_for(self, gene_ids):
+        """Rows of the given genes in query order, skipping unknown and repeated ids."""
+        records, seen = [], set()
+        for gene_id in gene_ids:
+            record = self.by_id.get(gene_id)
+            if record is not None and record['gene_id'] not in seen:
+                seen.add(record['gene_id'])
+                records.append(record)
+        return records
+
+    def resolve(self, gene_ids):
+        """Versioned ids of the given genes. See records_for."""
+        return [record['gene_id'] for record in self.records_for(gene_ids)]
+
+    def exact_names(self, names):
+        """Rows of the genes with the given names (case insensitive), in query order."""
+        return [dict(self.records[i]) for name in names for i in self.by_name.get(name.lower(), [])]
+
+    def search_names(self, queries, limit=50):
+        """Genes whose name matches any of the queries, case insensitive.
+
+        Exact matches come first, then names starting with a query (alphabetically), then names
+        containing a query of at least three characters.
+
+        Arguments:
+            queries ([str]): Partial gene names.
+            limit (int): Maximum number of genes returned.
+
+        Returns:
+            list: Rows of the matching genes.
+        """
+        queries = [query.lower() for query in queries if query]
+        found, seen = [], set()
+
+        def add(rows):
+            for i in rows:
+                if len(found) >= limit:
+                    return
+                if i not in seen:
+                    seen.add(i)
+                    found.append(i)
+
+        for query in queries:
+            add(self.by_name.get(query, []))
+        for query in queries:
+            start = bisect_left(self.name_keys, query)
+            end = start
+            while end < len(self.name_keys) and end - start < limit and self.name_keys[end].startswith(query):
+                end += 1
+            add(self.name_rows[start:end])
+        for query in queries:
+            if len(query) < 3 or len(found) >= limit:
+                continue
+            # Every match is in the rows of each of the query's trigrams; scan the shortest list.
+            candidates = min((self.trigrams.get(query[j:j+3], []) for j in range(len(query) - 2)), key=len)
+            add(i for i in candidates if query in self.names[i])
+
+        return [dict(self.records[i]) for i in found]
+
+    def table_name(self, gene_id):
+        """Name of the gene's table, ie. gene_ENSMUSG00000026787_3, or None for an unknown gene."""
+        record = self.by_id.get(gene_id)
+        if record is None:
+            return None
+        return 'gene_' + record['gene_id'].replace('.', '_')
+
+
+def gene_index(modality='methylation'):
+    """Index of the genes table of a modality's database, loaded on first use.
+
+    Arguments:
+        modality (str): Database bind prefix. 'methylation', 'snATAC' or 'RNA'.
+
+    Returns:
+        GeneIndex. Empty if the genes table could not be read.
+    """
+    version = current_app.config.get('DATA_VERSION')
+    cached = _indexes.get(modality)
+    if cached is not None and cached[0] == version and time.time() < cached[1]:
+        return cached[2]
+
+    try:
+        genes = pd.read_sql("SELECT * FROM genes", db.get_engine(current_app, modality+'_data'))
+    except exc.ProgrammingError as e:
+        now = datetime.datetime.now()
+        print("[{}] ERROR in app(gene_index): {}".format(str(now), e))
+        sys.stdout.flush()
+        # Not cached, so the next request tries again.
+        return GeneIndex(pd.DataFrame(columns=['gene_id']))
+
+    index = GeneIndex(genes)
+    _indexes[modality] = (version, time.time() + current_app.config.get('CATALOG_REFRESH', 600), index)
+    return index
@@ -0,0 +1,374 @@
+"""Columnar per-ensemble gene matrix store.
+
+Each ensemble is materialized once per modality as a directory of NumPy
+arrays that are memory-mapped at read time:
+
+    <MATRIX_STORE_DIR>/<modality>/<ensemble>/
+        meta.json                 cell count, gene order, column descriptions
+        cells/<column>.npy        one array per cell metadata column
+        genes/<value>.npy         (n_genes, n_cells) float32, one row per gene
+        correlated/genes.npy      (n, k) int32, top-k correlated genes of each gene
+        correlated/values.npy     (n, k) float32, their correlations
+
+Gene matrices are stored gene-major so that fetching one gene is a single
+contiguous row slice instead of a multi-table JOIN in MySQL.
+
+The store is optional. When MATRIX_STORE_DIR is not configured or an ensemble
+has not been exported, open_store() returns None and content.py falls back to
+querying MySQL.
+"""
+import datetime
+import json
+import os
+import shutil
+import sys
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from flask import current_app
+from sqlalchemy import exc
+
+from . import db
+from .precompute import table_exists
+
+STORE_FORMAT_VERSION = 1
+
+# Per-gene value columns exported for each modality, besides methylation whose
+# columns are discovered from the gene tables themselves (mCH, CH, mCG, ...).
+GENE_VALUE_COLUMNS = {
+    'snATAC': ['normalized_counts', 'smoothed_normalized_counts'],
+    'RNA': ['normalized_counts'],
+}
+
+_open_stores = {}
+
+
+def store_root():
+    """Return the configured store directory, or None if the store is disabled."""
+    return current_app.config.get('MATRIX_STORE_DIR') or None
+
+
+def store_path(ensemble, modality='methylation', root=None):
+    root = root or store_root()
+    if root is None:
+        return None
+    return os.path.join(root, modality, ensemble)
+
+
+def versionless(gene_id):
+    """Strip the Ensembl version suffix. ENSMUSG00000026787.3 -> ENSMUSG00000026787"""
+    return gene_id.split('.')[0]
+
+
+class EnsembleStore(object):
+    """Read-only, memory-mapped view of one ensemble/modality in the store."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.n_cells = self.meta['n_cells']
+        self.gene_rows = {}
+        for i, gene_id in enumerate(self.meta['genes']):
+            self.gene_rows[gene_id] = i
+            self.gene_rows.setdefault(versionless(gene_id), i)
+        self.correlated_rows = {}
+        if 'correlated_genes' in self.meta:
+            for i, gene_id in enumerate(self.meta['correlated_genes']['genes']):
+                self.correlated_rows[gene_id] = i
+                self.correlated_rows.setdefault(versionless(gene_id), i)
+        self._arrays = {}
+
+    def _load(self, *parts):
+        key = os.path.join(*parts)
+        if key not in self._arrays:
+            self._arrays[key] = np.load(os.path.join(self.path, key), mmap_mode='r')
+        return self._arrays[key]
+
+    @property
+    def cell_columns(self):
+        return list(self.meta['columns'].keys())
+
+    @property
+    def gene_columns(self):
+        return self.meta['gene_columns']
+
+    def has_gene(self, gene_id):
+        return gene_id in self.gene_rows
+
+    def cell_column(self, column, rows=None):
+        """Return a cell metadata column, decoding dictionary-encoded strings.
+
+        Arguments:
+            column (str): Column name as it appears in the cells/Ens/datasets tables.
+            rows (slice or array): Optional subset of cell positions.
+
+        Returns:
+            numpy array. String columns are object arrays with None for NULL, like read_sql.
+        """
+        info = self.meta['columns'][column]
+        values = self._load('cells', column + '.npy')
+        if rows is not None:
+            values = values[rows]
+        if info['kind'] == 'categorical':
+            # Code -1 (NULL) picks the trailing None.
+            categories = np.array(info['categories'] + [None], dtype=object)
+            return categories[np.asarray(values)]
+        return np.asarray(values)
+
+    def gene_values(self, gene_id, column, rows=None):
+        """Return one gene's values for every cell (or the given rows) as float32.
+
+        Missing measurements are NaN, mirroring the LEFT JOIN on gene tables.
+        """
+        matrix = self._load('genes', column + '.npy')
+        row = matrix[self.gene_rows[gene_id]]
+        if rows is not None:
+            row = row[rows]
+        return np.asarray(row)
+
+    @property
+    def has_correlated_genes(self):
+        return 'correlated_genes' in self.meta
+
+    def correlated_genes(self, gene_id, limit=None, min_correlation=None):
+        """Genes correlated with a gene, highest correlation first.
+
+        Arguments:
+            gene_id (str): Versioned or versionless gene id.
+            limit (int): Maximum number of genes returned.
+            min_correlation (float): Only return genes correlated at least this much.
+
+        Returns:
+            list: (gene_id, correlation) pairs. Empty for a gene without correlated genes.
+        """
+        row = self.correlated_rows.get(gene_id)
+        if row is None:
+            return []
+        partners = self._load('correlated', 'genes.npy')[row]
+        values = self._load('correlated', 'values.npy')[row]
+        keep = partners >= 0
+        if min_correlation is not None:
+            keep &= values >= min_correlation
+        genes = self.meta['correlated_genes']['genes']
+        pairs = [(genes[partner], float(value)) for partner, value in zip(partners[keep], values[keep])]
+        return pairs[:limit] if limit is not None else pairs
+
+    def frame(self, cell_columns, gene_id=None, gene_columns=(), rows=None):
+        """Assemble a DataFrame of cell metadata followed by one gene's values.
+
+        Arguments:
+            cell_columns ([str]): Cell metadata columns, in output order.
+            gene_id (str): Gene to read values for.
+            gene_columns ([str or (str, str)]): Gene value columns. A (name, source)
+                pair renames the source column, like "SELECT source AS name".
+            rows (slice or array): Optional subset of cell positions.
+
+        Returns:
+            DataFrame
+        """
+        data = [(column, self.cell_column(column, rows)) for column in cell_columns]
+        for column in gene_columns:
+            name, source = column if isinstance(column, tuple) else (column, column)
+            data.append((name, self.gene_values(gene_id, source, rows)))
+        return pd.DataFrame(OrderedDict(data))
+
+
+def open_store(ensemble, modality='methylation'):
+    """Open the store for an ensemble if it has been built.
+
+    Stores are cached per process and re-opened when meta.json changes, so a
+    rebuild is picked up without restarting the server.
+
+    Returns:
+        EnsembleStore or None.
+    """
+    path = store_path(ensemble, modality)
+    if path is None:
+        return None
+    meta_file = os.path.join(path, 'meta.json')
+    try:
+        mtime = os.path.getmtime(meta_file)
+    except OSError:
+        return None
+
+    cached = _open_stores.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    store = EnsembleStore(path)
+    _open_stores[path] = (mtime, store)
+    return store
+
+
+def sample_rows(store, max_points):
+    """Positions of the cells to return for a max_points request.
+
+    Uses the ensemble's sample_rank column when it was exported, and then selects
+    the same cells as content.sample_clause. Otherwise the cells are a permutation
+    seeded with SAMPLE_SEED. That sample is stable across genes and requests, but
+    it differs from MySQL's ORDER BY RAND(SAMPLE_SEED) sample.
+    """
+    if not str(max_points).isdigit() or int(max_points) >= store.n_cells:
+        return None
+    if 'sample_rank' in store.meta['columns']:
+        return np.flatnonzero(store.cell_column('sample_rank') < int(max_points))
+    rng = np.random.RandomState(int(current_app.config.get('SAMPLE_SEED', 0)))
+    return np.sort(rng.permutation(store.n_cells)[:int(max_points)])
+
+
+def _write_column(directory, name, values):
+    """Write one cell metadata column, dictionary-encoding strings."""
+    series = pd.Series(values)
+    if series.dtype == object:
+        categorical = pd.Categorical(series.map(lambda v: None if pd.isnull(v) else str(v)))
+        np.save(os.path.join(directory, name + '.npy'), categorical.codes.astype(np.int32))
+        return {'kind': 'categorical', 'categories': categorical.categories.tolist()}
+    np.save(os.path.join(directory, name + '.npy'), series.values)
+    return {'kind': 'numeric', 'dtype': str(series.dtype)}
+
+
+def _write_correlated_genes(directory, engine, ensemble):
+    """Export {ensemble}_correlated_genes as fixed width arrays, one row per gene1, highest correlation first."""
+    corr = pd.read_sql("SELECT gene1, gene2, correlation FROM {}_correlated_genes \
+        ORDER BY gene1, correlation DESC".format(ensemble), engine)
+    genes = pd.Index(pd.unique(np.concatenate([corr['gene1'].values, corr['gene2'].values])))
+    rows = genes.get_indexer(corr['gene1'])
+    ranks = corr.groupby('gene1', sort=False).cumcount().values
+    k = int(ranks.max()) + 1 if len(corr) else 0
+
+    partners = np.full((len(genes), k), -1, dtype=np.int32)
+    values = np.full((len(genes), k), np.nan, dtype=np.float32)
+    partners[rows, ranks] = genes.get_indexer(corr['gene2'])
+    values[rows, ranks] = corr['correlation'].values
+    np.save(os.path.join(directory, 'genes.npy'), partners)
+    np.save(os.path.join(directory, 'values.npy'), values)
+    return {'genes': genes.tolist(), 'k': k}
+
+
+def cell_metadata(engine, ensemble, modality='methylation'):
+    """All cells of an ensemble with their Ens, cells and datasets columns, ordered by cell_id.
+
+    Same JOINs as the per-gene queries in content.py, done once.
+    """
+    # Only the methylation database carries ABA_regions.
+    if modality == 'methylation':
+        broad_region_column = ", ABA_regions.ABA_broad_acronym AS broad_brain_region"
+        broad_region_join = " LEFT JOIN ABA_regions ON datasets.brain_region = ABA_regions.ABA_acronym"
+    else:
+        broad_region_column = ""
+        broad_region_join = ""
+    query = "SELECT {0}.*, cells.*, datasets.target_region, datasets.sex, datasets.brain_region{1} \
+        FROM cells \
+        INNER JOIN {0} ON cells.cell_id = {0}.cell_id \
+        LEFT JOIN datasets ON cells.dataset = datasets.dataset{2} \
+        ORDER BY cells.cell_id".format(ensemble, broad_region_column, broad_region_join)
+    cells = pd.read_sql(query, engine)
+    return cells.loc[:, ~cells.columns.duplicated(keep='last')]
+
+
+def genes_with_tables(engine):
+    """Versioned ids of the genes in the genes table that have a gene_<id> table."""
+    genes = pd.read_sql("SELECT gene_id FROM genes", engine)['gene_id'].tolist()
+    tables = set(r[0] for r in engine.execute(
+        "SELECT table_name FROM information_schema.tables WHERE table_schema = DATABASE()").fetchall())
+    return [g for g in genes if 'gene_' + g.replace('.', '_') in tables]
+
+
+def build_store(ensemble, modality='methylation', root=None, log=print):
+    """Export an ensemble from the MySQL schema into the columnar store.
+
+    Arguments:
+        ensemble (str): Ensemble table name. ie. Ens218
+        modality (str): 'methylation', 'snATAC' or 'RNA'.
+        root (str): Store directory. Defaults to MATRIX_STORE_DIR.
+
+    Returns:
+        str: Path of the written store.
+    """
+    if ';' in ensemble:
+        raise ValueError('Invalid ensemble name: {}'.format(ensemble))
+    root = root or store_root()
+    if root is None:
+        raise ValueError('MATRIX_STORE_DIR is not configured.')
+
+    engine = db.get_engine(current_app, modality + '_data')
+    cells = cell_metadata(engine, ensemble, modality)
+    cell_index = pd.Index(cells['cell_id'])
+    log('{}: {} cells'.format(ensemble, len(cells)))
+
+    genes = genes_with_tables(engine)
+    if not genes:
+        raise ValueError('No gene tables found for {} ({})'.format(ensemble, modality))
+
+    if modality == 'methylation':
+        first_table = 'gene_' + genes[0].replace('.', '_')
+        columns = pd.read_sql("SELECT * FROM {} LIMIT 0".format(first_table), engine).columns
+        gene_columns = [c for c in columns if c != 'cell_id']
+    else:
+        gene_columns = GENE_VALUE_COLUMNS[modality]
+
+    final_path = store_path(ensemble, modality, root)
+    tmp_path = final_path + '.building'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(os.path.join(tmp_path, 'cells'))
+    os.makedirs(os.path.join(tmp_path, 'genes'))
+
+    column_info = {}
+    for column in cells.columns:
+        column_info[column] = _write_column(os.path.join(tmp_path, 'cells'), column, cells[column])
+
+    matrices = {}
+    for column in gene_columns:
+        matrices[column] = np.lib.format.open_memmap(os.path.join(tmp_path, 'genes', column + '.npy'),
+            mode='w+', dtype=np.float32, shape=(len(genes), len(cells)))
+        matrices[column][:] = np.nan
+
+    for i, gene_id in enumerate(genes):
+        table = 'gene_' + gene_id.replace('.', '_')
+        try:
+            df = pd.read_sql("SELECT cell_id, {} FROM {}".format(', '.join(gene_columns), table), engine)
+        except exc.ProgrammingError as e:
+            now = datetime.datetime.now()
+            print("[{}] ERROR in build_store: {}".format(str(now), e))
+            sys.stdout.flush()
+            continue
+        positions = cell_index.get_indexer(df['cell_id'])
+        found = positions >= 0
+        for column in gene_columns:
+            matrices[column][i, positions[found]] = df[column].values[found]
+        if i % 1000 == 0:
+            log('{}: {}/{} genes'.format(ensemble, i, len(genes)))
+
+    for matrix in matrices.values():
+        matrix.flush()
+    del matrices
+
+    correlated_genes = None
+    if modality == 'methylation' and table_exists(engine, ensemble + '_correlated_genes'):
+        os.makedirs(os.path.join(tmp_path, 'correlated'))
+        correlated_genes = _write_correlated_genes(os.path.join(tmp_path, 'correlated'), engine, ensemble)
+        log('{}: {} genes with correlated genes'.format(ensemble, len(correlated_genes['genes'])))
+
+    meta = {'format': STORE_FORMAT_VERSION,
+            'ensemble': ensemble,
+            'modality': modality,
+            'built': str(datetime.datetime.now()),
+            'n_cells': len(cells),
+            'columns': column_info,
+            'gene_columns': gene_columns,
+            'genes': genes}
+    if correlated_genes is not None:
+        meta['correlated_genes'] = correlated_genes
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    old_path = final_path + '.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(final_path):
+        os.rename(final_path, old_path)
+    os.rename(tmp_path, final_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    log('{}: wrote {}'.format(ensemble, final_path))
+
+    return final_path
@@ -0,0 +1,259 @@
+"""Offline precomputations stored back into the MySQL schema.
+
+These are run from manage.py, never while serving a request.
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from flask import current_app
+
+from . import db
+
+
+def column_exists(engine, table, column):
+    result = engine.execute("SELECT COUNT(*) FROM information_schema.columns \
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s", (table, column)).fetchone()
+    return result[0] > 0
+
+
+def sample_ranks(cells, seed=0, stratify=None):
+    """Random order in which cells are included when plots are limited to max_points.
+
+    With stratify, cells are interleaved so that every prefix of the order keeps the
+    cluster proportions of the whole ensemble: the j-th cell (after shuffling) of a
+    cluster with n cells is placed at (j + u) / n, u ~ U(0, 1).
+
+    Arguments:
+        cells (DataFrame): One row per cell, with the stratify column if given.
+        seed (int): Seed for the random permutation.
+        stratify (str): Optional column to stratify by. ie. cluster_mCH_lv_npc50_k30
+
+    Returns:
+        numpy array of ranks 0..n-1, aligned with cells.
+    """
+    rng = np.random.RandomState(seed)
+    n = len(cells)
+    if stratify is None:
+        keys = rng.permutation(n)
+    else:
+        keys = np.empty(n)
+        codes, _ = pd.factorize(cells[stratify])  # cells without a cluster are coded -1
+        for _, positions in pd.Series(codes).groupby(codes).indices.items():
+            order = rng.permutation(len(positions))
+            keys[positions] = (order + rng.uniform(size=len(positions))) / len(positions)
+    ranks = np.empty(n, dtype=np.int64)
+    ranks[np.argsort(keys, kind='mergesort')] = np.arange(n)
+    return ranks
+
+
+def build_sample_rank(ensemble, modality='methylation', seed=0, stratify=None, log=print):
+    """Add an indexed sample_rank column to an ensemble table.
+
+    Queries limited to max_points then select "WHERE sample_rank < max_points", an
+    index range scan returning the same cells for every gene and request, instead of
+    sorting the whole joined result with ORDER BY RAND().
+
+    Arguments:
+        ensemble (str): Ensemble table name. ie. Ens218
+        modality (str): 'methylation', 'snATAC' or 'RNA'.
+        seed (int): Seed for the random permutation.
+        stratify (str): Optional cluster column to stratify the sample by.
+    """
+    if ';' in ensemble or (stratify is not None and ';' in stratify):
+        raise ValueError('Invalid ensemble or column name.')
+    engine = db.get_engine(current_app, modality + '_data')
+
+    columns = 'cell_id' if stratify is None else 'cell_id, ' + stratify
+    cells = pd.read_sql("SELECT {} FROM {} ORDER BY cell_id".format(columns, ensemble), engine)
+    ranks = sample_ranks(cells, seed, stratify)
+
+    if not column_exists(engine, ensemble, 'sample_rank'):
+        engine.execute("ALTER TABLE {} ADD COLUMN sample_rank INT, ADD INDEX sample_rank_idx (sample_rank)".format(ensemble))
+    engine.execute("UPDATE {} SET sample_rank = %s WHERE cell_id = %s".format(ensemble),
+                   list(zip(ranks.tolist(), cells['cell_id'].tolist())))
+    log('{}: ranked {} cells'.format(ensemble, len(cells)))
+
+
+def table_exists(engine, table):
+    result = engine.execute("SELECT COUNT(*) FROM information_schema.tables \
+        WHERE table_schema = DATABASE() AND table_name = %s", (table,)).fetchone()
+    return result[0] > 0
+
+
+def table_versions(engine, tables):
+    """Create and update times of the given tables, in the order given.
+
+    Changes whenever a table is reloaded or modified, so it can key cached results
+    derived from the tables. Tables that do not exist are reported as None.
+    """
+    rows = engine.execute("SELECT table_name, create_time, update_time FROM information_schema.tables \
+        WHERE table_schema = DATABASE() AND table_name IN (" + ", ".join(["%s"] * len(tables)) + ")",
+        tuple(tables)).fetchall()
+    times = dict((row[0], (str(row[1]), str(row[2]))) for row in rows)
+    return [times.get(table) for table in tables]
+
+
+def cell_digest(engine, table, where='', params=()):
+    """Fingerprint of the set of cell_ids in a table, computed by MySQL in one aggregate query.
+
+    The number of cells, the XOR of the first 64 bits of each cell_id's MD5 and the sum of
+    their CRC32s. None of them depend on row order, so two tables hold the same cells
+    exactly when (barring hash collisions) their digests are equal.
+
+    Arguments:
+        table (str): Table with a cell_id column. ie. Ens218 or cells
+        where (str): Optional condition, with %s placeholders for params.
+        params (tuple): Values of the placeholders in where.
+
+    Returns:
+        str: ie. "5834-9c1d0e2f3a4b5c6d-12542329981203"
+    """
+    query = "SELECT COUNT(*), BIT_XOR(CAST(CONV(LEFT(MD5(cell_id), 16), 16, 10) AS UNSIGNED)), \
+        COALESCE(SUM(CRC32(cell_id)), 0) FROM {}".format(table)
+    if where:
+        query += " WHERE " + where
+    count, xor, crc_sum = engine.execute(query, tuple(params)).fetchone()
+    return '{}-{:016x}-{}'.format(int(count), int(xor), int(crc_sum))
+
+
+def build_cell_digests(log=print):
+    """Store the cell_digest of every ensemble in the ensembles table.
+
+    Used by content.check_ensemble_similarities to detect requests duplicating an
+    existing ensemble without reading either ensemble's cells.
+    """
+    engine = db.get_engine(current_app, 'methylation_data')
+    if not column_exists(engine, 'ensembles', 'cell_digest'):
+        engine.execute("ALTER TABLE ensembles ADD COLUMN cell_digest VARCHAR(64)")
+    for (ensemble_id,) in engine.execute("SELECT ensemble_id FROM ensembles").fetchall():
+        table = 'Ens{}'.format(ensemble_id)
+        if not table_exists(engine, table):
+            log('{}: no ensemble table, skipped'.format(table))
+            continue
+        digest = cell_digest(engine, table)
+        engine.execute("UPDATE ensembles SET cell_digest = %s WHERE ensemble_id = %s", (digest, ensemble_id))
+        log('{}: {}'.format(table, digest))
+
+
+def _gene_chunk(engine, store, cell_index, gene_ids, columns):
+    """Values of a few genes for every cell of cell_index, as {column: (cells, genes) array}."""
+    if store is not None:
+        return dict((column, np.column_stack([store.gene_values(g, column) for g in gene_ids]))
+                    for column in columns)
+
+    chunk = dict((column, np.full((len(cell_index), len(gene_ids)), np.nan)) for column in columns)
+    for i, gene_id in enumerate(gene_ids):
+        table = 'gene_' + gene_id.replace('.', '_')
+        df = pd.read_sql("SELECT cell_id, {} FROM {}".format(', '.join(columns), table), engine)
+        positions = cell_index.get_indexer(df['cell_id'])
+        found = positions >= 0
+        for column in columns:
+            chunk[column][positions[found], i] = pd.to_numeric(df[column]).values[found]
+    return chunk
+
+
+def _summarize(values, groups, gene_ids):
+    """Long-format median/mean/quartiles/count of each gene's values per group of cells."""
+    codes, labels = pd.factorize(groups)
+    keep = codes >= 0
+    grouped = pd.DataFrame(values[keep]).groupby(codes[keep])
+    stats = OrderedDict([('median', grouped.median()),
+                         ('mean', grouped.mean()),
+                         ('q25', grouped.quantile(0.25)),
+                         ('q75', grouped.quantile(0.75)),
+                         ('n_cells', grouped.count())])
+    group_codes = stats['median'].index
+    columns = [('gene_id', np.tile([gene_id.split('.')[0] for gene_id in gene_ids], len(group_codes))),
+               ('group_label', np.repeat([str(labels[code]) for code in group_codes], len(gene_ids)))]
+    columns += [(name, stat.values.ravel()) for name, stat in stats.items()]
+    return pd.DataFrame(OrderedDict(columns))
+
+
+def build_cluster_summary(ensemble, modality='methylation', groupings=('cluster', 'annotation'),
+                          methylation_types=('mCH', 'mCG'), chunk_size=500, log=print):
+    """Write per-group summaries of every gene to the {ensemble}_cluster_summary table.
+
+    One row per (measure, group_column, gene, group) with the median, mean,
+    quartiles and number of cells, over all cells of the ensemble. Methylation
+    measures are the per-cell ratios of get_gene_methylation (ie. mCH/CH_original,
+    mCH/CH_normalized) for every clustering of the ensemble; counts are
+    normalized_counts with missing cells counted as 0, as in get_gene_snATAC/get_gene_RNA.
+    Genes are read from the matrix store when it has been built.
+
+    Arguments:
+        ensemble (str): Ensemble table name. ie. Ens218
+        modality (str): 'methylation', 'snATAC' or 'RNA'.
+        groupings ([str]): Groupings to summarize, as in content.cell_groups.
+        methylation_types ([str]): Methylation contexts to summarize.
+    """
+    from .content import cell_groups
+    from .matrix_store import cell_metadata, genes_with_tables, open_store
+
+    if ';' in ensemble:
+        raise ValueError('Invalid ensemble name: {}'.format(ensemble))
+    engine = db.get_engine(current_app, modality + '_data')
+
+    store = open_store(ensemble, modality)
+    if store is not None:
+        cells = store.frame(store.cell_columns)
+        genes = [gene_id for gene_id in store.meta['genes']]
+    else:
+        cells = cell_metadata(engine, ensemble, modality)
+        genes = genes_with_tables(engine)
+    cell_index = pd.Index(cells['cell_id'])
+
+    if modality == 'methylation':
+        suffixes = [column[len('cluster_'):] for column in cells.columns if column.startswith('cluster_')]
+        columns = []
+        for methylation_type in methylation_types:
+            columns += [methylation_type, methylation_type[1:]]
+    else:
+        suffixes = [modality.replace('snATAC', 'ATAC')]
+        columns = ['normalized_counts']
+
+    group_columns = OrderedDict()
+    for suffix in suffixes:
+        for grouping in groupings:
+            groups = cell_groups(cells, grouping, suffix, modality)
+            if groups is not None:
+                group_columns[groups.name] = groups.values
+
+    table = ensemble + '_cluster_summary'
+    engine.execute("DROP TABLE IF EXISTS {}_building".format(table))
+    engine.execute("CREATE TABLE {}_building ( \
+        measure VARCHAR(64) NOT NULL, group_column VARCHAR(255) NOT NULL, \
+        gene_id VARCHAR(255) NOT NULL, group_label VARCHAR(255), \
+        median DOUBLE, mean DOUBLE, q25 DOUBLE, q75 DOUBLE, n_cells INT, \
+        INDEX summary_idx (measure, group_column, gene_id))".format(table))
+
+    for start in range(0, len(genes), chunk_size):
+        gene_ids = genes[start:start+chunk_size]
+        chunk = _gene_chunk(engine, store, cell_index, gene_ids, columns)
+
+        measures = OrderedDict()
+        if modality == 'methylation':
+            for methylation_type in methylation_types:
+                context = methylation_type[1:]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    ratio = chunk[methylation_type] / chunk[context]
+                    measures[methylation_type+'/'+context+'_original'] = ratio
+                    measures[methylation_type+'/'+context+'_normalized'] = \
+                        ratio / cells['global_'+methylation_type].values.astype(float)[:, None]
+        else:
+            measures['normalized_counts'] = np.nan_to_num(chunk['normalized_counts'])
+
+        for measure, values in measures.items():
+            for group_column, groups in group_columns.items():
+                summary = _summarize(values, groups, gene_ids)
+                summary.insert(0, 'measure', measure)
+                summary.insert(1, 'group_column', group_column)
+                summary.to_sql(table + '_building', engine, if_exists='append', index=False, chunksize=10000)
+        log('{}: {}/{} genes'.format(ensemble, start + len(gene_ids), len(genes)))
+
+    if table_exists(engine, table):
+        engine.execute("RENAME TABLE {0} TO {0}_old, {0}_building TO {0}".format(table))
+        engine.execute("DROP TABLE {}_old".format(table))
+    else:
+        engine.execute("RENAME TABLE {0}_building TO {0}".format(table))
+    log('{}: wrote {}'.format(ensemble, table))
@@ -0,0 +1,116 @@
+"""Density rasterization of tSNE scatters.
+
+Scatter plots of every cell of a 100k+ cell ensemble are too large to send to
+the browser, so the scatter routes normally show a max_points subsample. With
+max_points = 'raster' all cells are read instead and binned into a fixed grid
+of pixels over the plot range, each pixel holding
+
+    counts      number of cells in the pixel
+    means       mean gene value of the cells in the pixel with a value
+    majority    most frequent group (cluster, annotation, ...) in the pixel
+
+which are plotted as heatmaps. Binning is a few np.bincount calls over the
+coordinate arrays, and the payload depends only on the grid size
+(RASTER_SIZE pixels a side, default 200), not on the number of cells.
+"""
+import numpy as np
+
+RASTER_SIZE = 200
+
+
+class Raster(object):
+    """Cells binned into a rows x cols grid over [x_min, x_max] x [y_min, y_max].
+
+    Row 0 is the bottom of the plot (lowest y), as Plot.ly draws heatmaps.
+
+    Arguments:
+        bounds (tuple): ((x_min, x_max), (y_min, y_max)).
+        counts (array): (rows, cols) int64 cells per pixel.
+        means (array): (rows, cols) float64 mean value per pixel, NaN where no cell has a value. Or None.
+        majority (array): (rows, cols) int64 most frequent group code per pixel, -1 where empty. Or None.
+    """
+
+    def __init__(self, bounds, counts, means=None, majority=None):
+        self.bounds = bounds
+        self.counts = counts
+        self.means = means
+        self.majority = majority
+        self.rows, self.cols = counts.shape
+
+    @property
+    def dx(self):
+        return (self.bounds[0][1] - self.bounds[0][0]) / self.cols
+
+    @property
+    def dy(self):
+        return (self.bounds[1][1] - self.bounds[1][0]) / self.rows
+
+    @property
+    def x0(self):
+        """x of the center of the first column, for Heatmap(x0=..., dx=...)."""
+        return self.bounds[0][0] + self.dx / 2
+
+    @property
+    def y0(self):
+        return self.bounds[1][0] + self.dy / 2
+
+
+def rasterize(x, y, bounds, shape=(RASTER_SIZE, RASTER_SIZE), values=None, groups=None, n_groups=None):
+    """Bin points into a grid of pixels.
+
+    Points outside bounds or without coordinates are left out.
+
+    Arguments:
+        x, y (array): Point coordinates.
+        bounds (tuple): ((x_min, x_max), (y_min, y_max)) covered by the grid.
+        shape (tuple): (rows, cols) of the grid.
+        values (array): Value of each point, NaN if missing. Averaged per pixel.
+        groups (array): Integer group code of each point, negative if missing. Majority per pixel.
+        n_groups (int): Number of group codes. Defaults to the largest code + 1.
+
+    Returns:
+        Raster.
+    """
+    rows, cols = shape
+    (x_min, x_max), (y_min, y_max) = bounds
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    inside = np.isfinite(x) & np.isfinite(y) & (x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max)
+    ix = np.zeros(len(x), dtype=np.int64)
+    iy = np.zeros(len(y), dtype=np.int64)
+    if x_max > x_min and y_max > y_min:
+        ix[inside] = np.minimum(((x[inside] - x_min) / (x_max - x_min) * cols).astype(np.int64), cols - 1)
+        iy[inside] = np.minimum(((y[inside] - y_min) / (y_max - y_min) * rows).astype(np.int64), rows - 1)
+    pixels = iy * cols + ix
+    n_pixels = rows * cols
+
+    counts = np.bincount(pixels[inside], minlength=n_pixels).reshape(rows, cols)
+
+    means = None
+    if values is not None:
+        values = np.asarray(values, dtype=np.float64)
+        present = inside & ~np.isnan(values)
+        sums = np.bincount(pixels[present], weights=values[present], minlength=n_pixels)
+        n_values = np.bincount(pixels[present], minlength=n_pixels)
+        means = np.full(n_pixels, np.nan)
+        means[n_values > 0] = sums[n_values > 0] / n_values[n_values > 0]
+        means = means.reshape(rows, cols)
+
+    majority = None
+    if groups is not None:
+        groups = np.asarray(groups, dtype=np.int64)
+        if n_groups is None:
+            n_groups = int(groups.max()) + 1 if len(groups) else 0
+        grouped = inside & (groups >= 0) & (groups < n_groups)
+        if n_groups > 0:
+            group_counts = np.bincount(pixels[grouped] * n_groups + groups[grouped],
+                                       minlength=n_pixels * n_groups).reshape(n_pixels, n_groups)
+            # Ties go to the lowest group code.
+            majority = group_counts.argmax(axis=1)
+            majority[group_counts.max(axis=1) == 0] = -1
+        else:
+            majority = np.full(n_pixels, -1, dtype=np.int64)
+        majority = majority.reshape(rows, cols)
+
+    return Raster(((x_min, x_max), (y_min, y_max)), counts, means, majority)
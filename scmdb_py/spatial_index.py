@@ -0,0 +1,164 @@
+"""Grid bucket index of tSNE coordinates for viewport scatter queries.
+
+Scatter plots load a max_points sample of an ensemble up front, so zooming
+in only magnifies that sample. The viewport API instead asks for the cells
+inside the visible box, up to a point budget. To answer that without a scan
+of every cell, the coordinates of each ensemble and tSNE type are bucketed
+once into a square grid (about 8 cells per bucket); a query reads the
+buckets overlapping the box and filters their cells exactly.
+
+When more cells are in view than the budget allows, the cells with the
+lowest sample priority are returned: the ensemble's sample_rank when it was
+exported, otherwise a permutation seeded with SAMPLE_SEED (as in
+matrix_store.sample_rows). The same cells therefore stay on screen while
+panning, and zooming in only adds cells.
+
+Indexes are built from the matrix store or the cached cell metadata (see
+cell_cache.open_ensemble) and rebuilt when DATA_VERSION changes. Like the
+cell metadata, at most CELL_METADATA_ENSEMBLES indexes are kept per process.
+
+Panning and zooming ask for the same genes over and over. For ensembles
+without a matrix store each gene is one query of its gene table, so the
+values of the last VIEWPORT_GENES genes for every cell are kept as well.
+"""
+from collections import OrderedDict
+
+import numpy as np
+from flask import current_app
+
+from .cell_cache import CachedEnsemble, open_ensemble
+
+CELLS_PER_BUCKET = 8
+VIEWPORT_GENES = 16
+
+_indexes = OrderedDict()
+_gene_values = OrderedDict()
+
+
+class GridIndex(object):
+    """Cells bucketed by their position in a resolution x resolution grid.
+
+    Arguments:
+        x, y (array): Cell coordinates. Cells without coordinates are never returned.
+        priority (array): Sampling order of the cells, lowest first.
+        resolution (int): Buckets along each side. Defaults to about CELLS_PER_BUCKET cells per bucket.
+    """
+
+    def __init__(self, x, y, priority, resolution=None):
+        self.x = np.asarray(x, dtype=np.float32)
+        self.y = np.asarray(y, dtype=np.float32)
+        self.priority = np.asarray(priority)
+        valid = np.isfinite(self.x) & np.isfinite(self.y)
+        if resolution is None:
+            resolution = int(np.clip(np.sqrt(valid.sum() / CELLS_PER_BUCKET), 1, 1024))
+        self.resolution = resolution
+
+        if valid.any():
+            self.bounds = ((float(self.x[valid].min()), float(self.x[valid].max())),
+                           (float(self.y[valid].min()), float(self.y[valid].max())))
+        else:
+            self.bounds = ((0.0, 0.0), (0.0, 0.0))
+        cells = np.flatnonzero(valid)
+        buckets = self._bucket(self.x[cells], 0) * resolution + self._bucket(self.y[cells], 1)
+        # Cells ordered by bucket, and by priority within a bucket.
+        order = np.lexsort((self.priority[cells], buckets))
+        self.cells = cells[order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(buckets, minlength=resolution**2))])
+
+    def _bucket(self, values, axis):
+        low, high = self.bounds[axis]
+        width = (high - low) / self.resolution or 1.0
+        return np.clip(((values - low) / width).astype(np.int64), 0, self.resolution - 1)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def query(self, x_range=None, y_range=None, budget=None):
+        """Cells inside a box, at most budget of them.
+
+        Arguments:
+            x_range, y_range (tuple): (low, high) of the box. None for no limit.
+            budget (int): Maximum number of cells returned. None for all.
+
+        Returns:
+            tuple: (positions of the returned cells in ascending order, number of cells in the box).
+        """
+        x_low, x_high = x_range or self.bounds[0]
+        y_low, y_high = y_range or self.bounds[1]
+        if x_low > x_high or y_low > y_high:
+            return np.array([], dtype=np.int64), 0
+
+        first_x, last_x = self._bucket(np.array([x_low, x_high]), 0)
+        first_y, last_y = self._bucket(np.array([y_low, y_high]), 1)
+        columns = np.arange(first_x, last_x + 1) * self.resolution
+        # Buckets of one grid column are contiguous, so each column is one slice of self.cells.
+        candidates = np.concatenate([self.cells[self.offsets[column + first_y]:self.offsets[column + last_y + 1]]
+                                     for column in columns])
+        x, y = self.x[candidates], self.y[candidates]
+        inside = candidates[(x >= x_low) & (x <= x_high) & (y >= y_low) & (y <= y_high)]
+
+        n_inside = len(inside)
+        if budget is not None and n_inside > budget:
+            if budget <= 0:
+                return np.array([], dtype=np.int64), n_inside
+            inside = inside[np.argpartition(self.priority[inside], budget - 1)[:budget]]
+        return np.sort(inside), n_inside
+
+
+def spatial_index(ensemble, tsne_type, modality='methylation'):
+    """Grid index of an ensemble's tSNE coordinates, built on first use.
+
+    Arguments:
+        ensemble (str): Ensemble table name. ie. Ens218
+        tsne_type (str): tSNE column suffix. ie. mCH_ndim2_perp20, or ATAC / RNA.
+        modality (str): 'methylation', 'snATAC' or 'RNA'.
+
+    Returns:
+        tuple: (EnsembleStore or CachedEnsemble, GridIndex), or (None, None) if the cells cannot be read.
+    """
+    store = open_ensemble(ensemble, modality)
+    if store is None or 'tsne_x_' + tsne_type not in store.meta['columns']:
+        return None, None
+
+    key = (modality, ensemble, tsne_type)
+    version = current_app.config.get('DATA_VERSION')
+    cached = _indexes.get(key)
+    # A rebuilt store or reloaded cell cache is a new object whose cells may differ.
+    if cached is not None and cached[0] == version and cached[1] is store:
+        _indexes.move_to_end(key)
+        return store, cached[2]
+
+    if 'sample_rank' in store.meta['columns']:
+        priority = store.cell_column('sample_rank')
+    else:
+        rng = np.random.RandomState(int(current_app.config.get('SAMPLE_SEED', 0)))
+        priority = np.argsort(rng.permutation(store.n_cells))
+    index = GridIndex(store.cell_column('tsne_x_' + tsne_type), store.cell_column('tsne_y_' + tsne_type), priority)
+    _indexes[key] = (version, store, index)
+    while len(_indexes) > current_app.config.get('CELL_METADATA_ENSEMBLES', 8):
+        _indexes.popitem(last=False)
+    return store, index
+
+
+def cell_gene_values(store, gene_id, columns):
+    """Some of a gene's value columns for every cell of an ensemble.
+
+    For a CachedEnsemble all columns are read with one query, and the result is kept for the
+    last VIEWPORT_GENES genes. Matrix store rows are memory-mapped and read as they are.
+
+    Returns:
+        dict: column to float32 array, in the store's cell order.
+    """
+    if not isinstance(store, CachedEnsemble):
+        return OrderedDict((column, store.gene_values(gene_id, column)) for column in columns)
+
+    key = (store.modality, store.ensemble, gene_id, tuple(columns))
+    cached = _gene_values.get(key)
+    if cached is not None and cached[0] is store:
+        _gene_values.move_to_end(key)
+        return cached[1]
+    values = store.gene_frame(gene_id, list(columns))
+    _gene_values[key] = (store, values)
+    while len(_gene_values) > VIEWPORT_GENES:
+        _gene_values.popitem(last=False)
+    return values
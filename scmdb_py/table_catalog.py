@@ -0,0 +1,90 @@
+"""In-process catalog of the tables and ensembles of each modality database.
+
+Existence checks (does gene_<id> have a table, is an ensemble in the snATAC
+database, has build_sample_rank or build_cluster_summary been run) used to be
+information_schema or ensembles queries per call, which are slow on MySQL with
+tens of thousands of gene_* tables. Each database's table names, the columns
+of its non-gene tables and its ensemble ids are instead read once into sets.
+
+Catalogs are reloaded after CATALOG_REFRESH seconds (default 600) or when
+DATA_VERSION changes.
+"""
+import datetime
+import sys
+import time
+
+from flask import current_app
+from sqlalchemy import exc
+
+from . import db
+
+_catalogs = {}
+
+
+class TableCatalog(object):
+    """Tables, columns and ensembles of one modality database.
+
+    Arguments:
+        tables ([str]): Every table name of the database.
+        columns ([(str, str)]): (table, column) of every table except the gene tables.
+        ensemble_ids ([str]): Ensemble ids in the ensembles table.
+    """
+
+    def __init__(self, tables, columns, ensemble_ids):
+        self.tables = set(tables)
+        self.columns = set(columns)
+        self.ensemble_ids = set(str(ensemble_id) for ensemble_id in ensemble_ids)
+
+    def has_table(self, table):
+        return table in self.tables
+
+    def has_column(self, table, column):
+        return (table, column) in self.columns
+
+    def has_ensemble(self, ensemble_id):
+        return str(ensemble_id) in self.ensemble_ids
+
+    def has_gene(self, gene_id):
+        """Whether a versioned gene id has a gene table, ie. gene_ENSMUSG00000026787_3."""
+        return 'gene_' + gene_id.replace('.', '_') in self.tables
+
+
+def table_catalog(modality='methylation'):
+    """Catalog of a modality's database, loaded on first use.
+
+    Arguments:
+        modality (str): Database bind prefix. 'methylation', 'snATAC' or 'RNA'.
+
+    Returns:
+        TableCatalog. Empty if the database could not be read.
+    """
+    version = current_app.config.get('DATA_VERSION')
+    cached = _catalogs.get(modality)
+    if cached is not None and cached[0] == version and time.time() < cached[1]:
+        return cached[2]
+
+    # Ensembles in the snATAC and RNA databases are identified by their methylation ensemble id.
+    if modality == 'methylation':
+        ensemble_column = 'ensemble_id'
+    else:
+        ensemble_column = 'snmc_ensemble_id'
+
+    try:
+        engine = db.get_engine(current_app, modality+'_data')
+        tables = [row[0] for row in engine.execute(
+            "SELECT table_name FROM information_schema.tables WHERE table_schema = DATABASE()").fetchall()]
+        columns = [(row[0], row[1]) for row in engine.execute(
+            "SELECT table_name, column_name FROM information_schema.columns \
+            WHERE table_schema = DATABASE() AND table_name NOT LIKE 'gene\\_%%'").fetchall()]
+        ensemble_ids = [row[0] for row in engine.execute(
+            "SELECT {} FROM ensembles".format(ensemble_column)).fetchall()]
+    except exc.ProgrammingError as e:
+        now = datetime.datetime.now()
+        print("[{}] ERROR in app(table_catalog): {}".format(str(now), e))
+        sys.stdout.flush()
+        # Not cached, so the next request tries again.
+        return TableCatalog([], [], [])
+
+    catalog = TableCatalog(tables, columns, ensemble_ids)
+    _catalogs[modality] = (version, time.time() + current_app.config.get('CATALOG_REFRESH', 600), catalog)
+    return catalog
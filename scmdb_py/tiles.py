@@ -0,0 +1,229 @@
+"""Pre-rendered tile pyramids of cluster-colored tSNE embeddings.
+
+Whole-ensemble embeddings are rendered offline, once per ensemble and tSNE
+type, into 256x256 PNG tiles in the usual z/x/y layout of map viewers:
+
+    <TILE_DIR>/<ensemble>/<tsne_type>/
+        meta.json        bounds, zoom levels, clusters and colors, build version
+        empty.png        served for tiles without cells
+        <z>/<x>/<y>.png  tile x (left to right), y (top to bottom) of zoom z
+
+Zoom z splits the square around the embedding into 2^z x 2^z tiles. Each
+pixel is colored by the most frequent cluster of its cells (see raster.py).
+Only tiles with cells are written. The /tiles/ routes in frontend.py serve
+the files with long cache headers, so panning and zooming never reach MySQL
+or Plot.ly; clients add ?v=<version> from meta.json to pick up rebuilds.
+
+Rendering requires Pillow. Build with
+
+    python manage.py build_tiles Ens218 -t mCH_ndim2_perp20
+"""
+import datetime
+import json
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from flask import current_app
+
+from .cluster_color_scale import CLUSTER_COLORS
+from .raster import rasterize
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+TILE_FORMAT_VERSION = 1
+TILE_SIZE = 256
+
+_metas = {}
+
+
+def tile_root(ensemble, tsne_type, root=None):
+    root = root or current_app.config.get('TILE_DIR') or None
+    if root is None or not ensemble or not tsne_type:
+        return None
+    if os.path.sep in ensemble + tsne_type or ensemble.startswith('.') or tsne_type.startswith('.'):
+        return None
+    return os.path.join(root, ensemble, tsne_type)
+
+
+def tile_meta(ensemble, tsne_type):
+    """meta.json of a tile pyramid if it has been built, cached per process until the file changes.
+
+    Returns:
+        dict or None.
+    """
+    directory = tile_root(ensemble, tsne_type)
+    if directory is None:
+        return None
+    path = os.path.join(directory, 'meta.json')
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+
+    cached = _metas.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(path) as f:
+        meta = json.load(f, object_pairs_hook=OrderedDict)
+    if meta.get('format') != TILE_FORMAT_VERSION:
+        return None
+    _metas[path] = (mtime, meta)
+    return meta
+
+
+def tile_file(ensemble, tsne_type, z, x, y):
+    """Path of a tile, empty.png for tiles without cells, or None if the pyramid or tile does not exist."""
+    meta = tile_meta(ensemble, tsne_type)
+    if meta is None or not 0 <= z <= meta['max_zoom'] or not (0 <= x < 2**z and 0 <= y < 2**z):
+        return None
+    directory = tile_root(ensemble, tsne_type)
+    path = os.path.join(directory, str(z), str(x), '{}.png'.format(y))
+    if os.path.isfile(path):
+        return path
+    return os.path.join(directory, 'empty.png')
+
+
+def _palette(n_groups):
+    """RGBA color of each group code, from CLUSTER_COLORS."""
+    palette = np.zeros((n_groups, 4), dtype=np.uint8)
+    for i in range(n_groups):
+        color = CLUSTER_COLORS[i % len(CLUSTER_COLORS)].lstrip('#')
+        palette[i] = [int(color[0:2], 16), int(color[2:4], 16), int(color[4:6], 16), 255]
+    return palette
+
+
+def square_bounds(x, y, padding=0.05):
+    """Square ((x_min, x_max), (y_min, y_max)) around the points, so tiles have square pixels."""
+    x_min, x_max = np.nanmin(x), np.nanmax(x)
+    y_min, y_max = np.nanmin(y), np.nanmax(y)
+    half = max(x_max - x_min, y_max - y_min, 1e-6) * (0.5 + padding)
+    x_center, y_center = (x_min + x_max) / 2, (y_min + y_max) / 2
+    return ((float(x_center - half), float(x_center + half)), (float(y_center - half), float(y_center + half)))
+
+
+def render_tiles(x, y, codes, n_groups, bounds, max_zoom, directory, tile_size=TILE_SIZE, log=print):
+    """Write the PNG tiles of every zoom level from 0 to max_zoom.
+
+    Points are sorted by tile once per zoom level, so each tile only bins its own points.
+
+    Returns:
+        int: Number of tiles written.
+    """
+    palette = _palette(n_groups)
+    (x_min, x_max), (y_min, y_max) = bounds
+    extent = x_max - x_min
+    written = 0
+    for z in range(max_zoom + 1):
+        n = 2**z
+        width = extent / n
+        with np.errstate(invalid='ignore'):
+            tile_x = np.clip(np.floor((x - x_min) / width), 0, n - 1)
+            # Tile rows count down from the top, like map tiles.
+            tile_y = np.clip(np.floor((y_max - y) / width), 0, n - 1)
+        valid = np.isfinite(tile_x) & np.isfinite(tile_y)
+        keys = (tile_y[valid] * n + tile_x[valid]).astype(np.int64)
+        points = np.flatnonzero(valid)[np.argsort(keys, kind='mergesort')]
+        keys = np.sort(keys, kind='mergesort')
+        tile_keys, starts = np.unique(keys, return_index=True)
+        ends = np.append(starts[1:], len(keys))
+
+        for key, start, end in zip(tile_keys, starts, ends):
+            ty, tx = divmod(int(key), n)
+            rows = points[start:end]
+            tile_bounds = ((x_min + tx * width, x_min + (tx + 1) * width),
+                           (y_max - (ty + 1) * width, y_max - ty * width))
+            raster = rasterize(x[rows], y[rows], tile_bounds, (tile_size, tile_size),
+                               groups=codes[rows], n_groups=n_groups)
+            image = np.zeros((tile_size, tile_size, 4), dtype=np.uint8)
+            filled = raster.majority >= 0
+            image[filled] = palette[raster.majority[filled]]
+            # Raster row 0 is the bottom of the tile, image row 0 its top.
+            image = np.flipud(image)
+
+            path = os.path.join(directory, str(z), str(tx))
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            Image.fromarray(image, 'RGBA').save(os.path.join(path, '{}.png'.format(ty)))
+            written += 1
+        log('zoom {}: {} tiles'.format(z, len(tile_keys)))
+    return written
+
+
+def build_tiles(ensemble, tsne_type, modality='methylation', group_column=None, max_zoom=5, root=None, log=print):
+    """Render the tile pyramid of an ensemble's tSNE embedding and replace the previous one.
+
+    Arguments:
+        ensemble (str): Ensemble table name. ie. Ens218
+        tsne_type (str): tSNE column suffix. ie. mCH_ndim2_perp20, or ATAC / RNA.
+        modality (str): 'methylation', 'snATAC' or 'RNA'.
+        group_column (str): Column the cells are colored by. Defaults to cluster_mCH_lv_npc50_k5
+            for methylation and cluster_<tsne_type> otherwise.
+        max_zoom (int): Highest zoom level.
+        root (str): Tile directory. Defaults to TILE_DIR.
+
+    Returns:
+        str: Directory of the pyramid.
+    """
+    from .cell_cache import open_ensemble
+
+    if Image is None:
+        raise ValueError('Rendering tiles requires Pillow (pip install Pillow).')
+    if ';' in ensemble:
+        raise ValueError('Invalid ensemble name: {}'.format(ensemble))
+    directory = tile_root(ensemble, tsne_type, root)
+    if directory is None:
+        raise ValueError('TILE_DIR is not configured.')
+    if group_column is None:
+        group_column = 'cluster_mCH_lv_npc50_k5' if modality == 'methylation' else 'cluster_' + tsne_type
+
+    store = open_ensemble(ensemble, modality)
+    if store is None:
+        raise ValueError('Could not read the cells of {} ({})'.format(ensemble, modality))
+    x = store.cell_column('tsne_x_' + tsne_type).astype(np.float64)
+    y = store.cell_column('tsne_y_' + tsne_type).astype(np.float64)
+    codes, groups = pd.factorize(store.cell_column(group_column), sort=True)
+    bounds = square_bounds(x, y)
+    log('{}: {} cells, {} groups in {}'.format(ensemble, len(x), len(groups), group_column))
+
+    tmp_path = '{}.building.{}'.format(directory, os.getpid())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    written = render_tiles(x, y, codes, len(groups), bounds, max_zoom, tmp_path, log=log)
+    Image.fromarray(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8), 'RGBA').save(
+        os.path.join(tmp_path, 'empty.png'))
+
+    built = datetime.datetime.now()
+    palette = _palette(len(groups))
+    meta = OrderedDict([
+        ('format', TILE_FORMAT_VERSION),
+        ('ensemble', ensemble),
+        ('modality', modality),
+        ('tsne_type', tsne_type),
+        ('group_column', group_column),
+        ('groups', [str(group) for group in groups]),
+        ('colors', ['#{:02x}{:02x}{:02x}'.format(*color[:3]) for color in palette]),
+        ('bounds', bounds),
+        ('tile_size', TILE_SIZE),
+        ('max_zoom', max_zoom),
+        ('n_cells', len(x)),
+        ('built', str(built)),
+        ('version', built.strftime('%Y%m%d%H%M%S')),
+    ])
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    # Swap the new pyramid in; tiles requested during the two renames are briefly missing.
+    old_path = '{}.old.{}'.format(directory, os.getpid())
+    if os.path.isdir(directory):
+        os.rename(directory, old_path)
+    os.rename(tmp_path, directory)
+    shutil.rmtree(old_path, ignore_errors=True)
+    log('{}: wrote {} tiles to {}'.format(ensemble, written, directory))
+
+    return directory